@@ -1,6 +1,7 @@
 import numpy as np
 from Tectonic_Utils.geodesy import insar_vector_functions as ivs
 from elastic_stresses_py.PyCoulomb.disp_points_object.disp_points_object import Displacement_points
+from .. import general_utils
 
 
 class Insar1dObject:
@@ -104,6 +105,21 @@ class Insar1dObject:
                                      endtime=self.endtime)
         return newInSAR_obj
 
+    def project_enu_into_los(self, enu, sign=1):
+        """
+        Project modeled ENU displacements into the LOS of each pixel, with general_utils.project_enu_into_los.
+        A stack of arrays, such as the ENU Green's functions of many fault patches, is projected in the same call.
+
+        :param enu: array of shape (n_pixels, 3), or a stack of shape (k, n_pixels, 3)
+        :param sign: +1 or -1, multiplies the LOS values. -1 flips the sign convention.
+        :returns: LOS displacements, array of shape (n_pixels,) or (k, n_pixels)
+        """
+        enu = np.asarray(enu, dtype=float)
+        if np.shape(enu)[-2:] != (len(self.lkv_E), 3):
+            raise ValueError("Error! ENU array has shape %s but InSAR object has %d pixels." % (np.shape(enu),
+                                                                                             len(self.lkv_E)))
+        return sign * general_utils.project_enu_into_los(enu, self.lkv_E, self.lkv_N, self.lkv_U)
+
     def get_coordinate_tuples(self):
         """
         Return a list of tuples containing (lon, lat) for each pixel in the 1d list of pixels.
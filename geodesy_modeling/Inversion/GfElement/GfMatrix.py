@@ -0,0 +1,181 @@
+import numpy as np
+from elastic_stresses_py.PyCoulomb.disp_points_object.disp_points_object import Displacement_points
+from .GfElement import GfElement
+
+
+class GfMatrix:
+    """
+    GfMatrix is an array-backed collection of GfElements that all share the same observation points.
+    Instead of one list of Displacement_points per model parameter, it holds one dense array of modeled
+    displacements, with shape (n_points, 3, n_params) for the E, N, U response to unit activation of each parameter.
+    The per-parameter metadata is held in parallel arrays, one entry for each column of the Green's matrix.
+
+    :param lons: longitudes of the modeled points
+    :type lons: np.array, length n_points
+    :param lats: latitudes of the modeled points
+    :type lats: np.array, length n_points
+    :param disps: modeled E, N, U displacements due to unit activation of each model parameter
+    :type disps: np.array, shape (n_points, 3, n_params)
+    :param param_names: param_name of each model parameter
+    :type param_names: np.array of strings, length n_params
+    :param upper_bounds: highest allowed value of each model parameter
+    :type upper_bounds: np.array, length n_params
+    :param lower_bounds: lowest allowed value of each model parameter
+    :type lower_bounds: np.array, length n_params
+    :param slip_penalties: numbers that will be attached to minimum-norm smoothing in the G matrix
+    :type slip_penalties: np.array, length n_params
+    :param units: what units is each 'unit activation' in?
+    :type units: np.array of strings, length n_params
+    :param fault_dict_lists: list of fault_slip_objects for each model parameter
+    :type fault_dict_lists: list, length n_params
+    :param points: coordinates of surface trace of fault for each model parameter, if provided
+    :type points: list, length n_params
+    :param meas_types: meas_type of each modeled point
+    :type meas_types: np.array of strings, length n_points
+    :param names: name of each modeled point
+    :type names: np.array of strings, length n_points
+    """
+
+    def __init__(self, lons, lats, disps, param_names=None, upper_bounds=None, lower_bounds=None,
+                 slip_penalties=None, units=None, fault_dict_lists=None, points=None, meas_types=None, names=None):
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self.disps = np.asarray(disps, dtype=float)  # (n_points, 3, n_params); kept as a view when possible
+        n_points, n_params = len(self.lons), np.shape(self.disps)[2]
+        if np.shape(self.disps) != (n_points, 3, n_params) or len(self.lats) != n_points:
+            raise ValueError("Error! GfMatrix displacements must have shape (n_points, 3, n_params).")
+        self.param_names = _param_array(param_names, n_params, '', dtype=object)
+        self.upper_bounds = _param_array(upper_bounds, n_params, 0, dtype=float)
+        self.lower_bounds = _param_array(lower_bounds, n_params, 0, dtype=float)
+        self.slip_penalties = _param_array(slip_penalties, n_params, 0, dtype=float)
+        self.units = _param_array(units, n_params, '', dtype=object)
+        self.fault_dict_lists = list(fault_dict_lists) if fault_dict_lists is not None else [() for _i in
+                                                                                              range(n_params)]
+        self.points = list(points) if points is not None else [() for _i in range(n_params)]
+        self.meas_types = _param_array(meas_types, n_points, None, dtype=object)
+        self.names = _param_array(names, n_points, None, dtype=object)
+
+    def __len__(self):
+        return self.n_params
+
+    @property
+    def n_points(self):
+        return len(self.lons)
+
+    @property
+    def n_params(self):
+        return np.shape(self.disps)[2]
+
+    @property
+    def fault_patches(self):
+        """The first fault object of each model parameter, as used for smoothing between neighboring patches."""
+        return [x[0] if len(x) > 0 else None for x in self.fault_dict_lists]
+
+    def set_param_names(self, param_names):
+        self.param_names = _param_array(param_names, self.n_params, '', dtype=object)
+
+    def set_lower_bounds(self, lower_bounds):
+        self.lower_bounds = _param_array(lower_bounds, self.n_params, 0, dtype=float)
+
+    def set_upper_bounds(self, upper_bounds):
+        self.upper_bounds = _param_array(upper_bounds, self.n_params, 0, dtype=float)
+
+    def set_units(self, units):
+        self.units = _param_array(units, self.n_params, '', dtype=object)
+
+    def set_slip_penalties(self, slip_penalties):
+        self.slip_penalties = _param_array(slip_penalties, self.n_params, 0, dtype=float)
+
+    def select_params(self, selection):
+        """
+        Return a new GfMatrix holding only some of the model parameters (columns).
+
+        :param selection: boolean mask or integer indices over the model parameters
+        """
+        idx = _selection_to_indices(selection, self.n_params)
+        return GfMatrix(lons=self.lons, lats=self.lats, disps=self.disps[:, :, idx],
+                        param_names=self.param_names[idx], upper_bounds=self.upper_bounds[idx],
+                        lower_bounds=self.lower_bounds[idx], slip_penalties=self.slip_penalties[idx],
+                        units=self.units[idx], fault_dict_lists=[self.fault_dict_lists[i] for i in idx],
+                        points=[self.points[i] for i in idx], meas_types=self.meas_types, names=self.names)
+
+    def select_points(self, selection):
+        """
+        Return a new GfMatrix holding only some of the modeled points (rows), in the order given.
+
+        :param selection: boolean mask or integer indices over the modeled points
+        """
+        idx = _selection_to_indices(selection, self.n_points)
+        return GfMatrix(lons=self.lons[idx], lats=self.lats[idx], disps=self.disps[idx, :, :],
+                        param_names=self.param_names, upper_bounds=self.upper_bounds,
+                        lower_bounds=self.lower_bounds, slip_penalties=self.slip_penalties, units=self.units,
+                        fault_dict_lists=self.fault_dict_lists, points=self.points, meas_types=self.meas_types[idx],
+                        names=self.names[idx])
+
+    def get_gf_element(self, i):
+        """Build one GfElement (the old object API) for model parameter i."""
+        disp_points = []
+        for j in range(self.n_points):
+            disp_points.append(Displacement_points(lon=self.lons[j], lat=self.lats[j], dE_obs=self.disps[j, 0, i],
+                                                   dN_obs=self.disps[j, 1, i], dU_obs=self.disps[j, 2, i],
+                                                   Se_obs=0, Sn_obs=0, Su_obs=0, meas_type=self.meas_types[j],
+                                                   name=self.names[j]))
+        return GfElement(disp_points=disp_points, param_name=self.param_names[i], upper_bound=self.upper_bounds[i],
+                         lower_bound=self.lower_bounds[i], slip_penalty=self.slip_penalties[i], units=self.units[i],
+                         fault_dict_list=self.fault_dict_lists[i], points=self.points[i])
+
+    def iter_gf_elements(self):
+        """Build GfElements one at a time, only as they are requested."""
+        for i in range(self.n_params):
+            yield self.get_gf_element(i)
+
+    def to_gf_elements(self):
+        """Adapter to the list-of-GfElement API, for drivers that have not yet migrated."""
+        return list(self.iter_gf_elements())
+
+
+def gf_matrix_from_gf_elements(gf_elements):
+    """
+    Adapter from the list-of-GfElement API into one GfMatrix.
+    The assumption is that all gf_elements have same points inside them (because we take first one as representative)
+
+    :param gf_elements: a list of gf_elements with all the same points inside them
+    :returns: GfMatrix
+    """
+    reference_pts = gf_elements[0].disp_points
+    disps = np.zeros((len(reference_pts), 3, len(gf_elements)))
+    for i, gf_el in enumerate(gf_elements):
+        if len(gf_el.disp_points) != len(reference_pts):
+            raise ValueError("Error! Not all gf_elements have the same number of points.")
+        disps[:, :, i] = [[pt.dE_obs, pt.dN_obs, pt.dU_obs] for pt in gf_el.disp_points]
+    return GfMatrix(lons=[pt.lon for pt in reference_pts], lats=[pt.lat for pt in reference_pts], disps=disps,
+                    param_names=[x.param_name for x in gf_elements], upper_bounds=[x.upper_bound for x in gf_elements],
+                    lower_bounds=[x.lower_bound for x in gf_elements],
+                    slip_penalties=[x.slip_penalty for x in gf_elements], units=[x.units for x in gf_elements],
+                    fault_dict_lists=[x.fault_dict_list for x in gf_elements],
+                    points=[x.points for x in gf_elements], meas_types=[pt.meas_type for pt in reference_pts],
+                    names=[pt.name for pt in reference_pts])
+
+
+def _param_array(values, length, default, dtype):
+    """Broadcast a scalar or a sequence into a 1d array of the given length."""
+    if values is None:
+        values = default
+    if np.ndim(values) == 0:
+        array = np.empty((length,), dtype=dtype)
+        array[:] = values
+        return array
+    array = np.array(values, dtype=dtype)
+    if len(array) != length:
+        raise ValueError("Error! Expected %d values, received %d." % (length, len(array)))
+    return array
+
+
+def _selection_to_indices(selection, length):
+    """Turn a boolean mask or a list of integers into an array of integer indices."""
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        if len(selection) != length:
+            raise ValueError("Error! Boolean mask has length %d, expected %d." % (len(selection), length))
+        return np.flatnonzero(selection)
+    return selection.astype(int)
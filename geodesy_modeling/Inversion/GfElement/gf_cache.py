@@ -0,0 +1,100 @@
+import glob
+import hashlib
+import os
+import numpy as np
+from .rw_insar_gfs import patch_geometry_hash
+
+
+class GfCache:
+    """
+    Content-addressed, on-disk cache of Green's function columns, one .npy file per fault patch.
+    Each column is keyed on the patch geometry, the elastic parameters, the observation coordinates,
+    and the look vectors, so a column is only recomputed when something that affects it has changed.
+    Least-recently-used columns are evicted when the cache grows past max_size_mb.
+
+    :param cache_dir: directory where the columns are stored
+    :type cache_dir: string
+    :param max_size_mb: optional upper limit on the total size of the cache, in MB
+    :type max_size_mb: float
+    """
+
+    def __init__(self, cache_dir, max_size_mb=None):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def set_max_size_mb(self, max_size_mb):
+        self.max_size_mb = max_size_mb
+
+    def get_column_filename(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        """Return the cached column for this key, or None. A hit counts as a use for LRU eviction."""
+        filename = self.get_column_filename(key)
+        if not os.path.isfile(filename):
+            return None
+        os.utime(filename)
+        return np.load(filename)
+
+    def put(self, key, column):
+        """Store one column. Written to a temporary file first, so parallel writers never leave a partial file."""
+        filename = self.get_column_filename(key)
+        tmp_filename = filename + ".%d.tmp" % os.getpid()
+        with open(tmp_filename, 'wb') as fp:
+            np.save(fp, np.asarray(column, dtype=float))
+        os.replace(tmp_filename, filename)
+        return
+
+    def get_size_mb(self):
+        return sum(os.path.getsize(x) for x in glob.glob(os.path.join(self.cache_dir, "*.npy"))) / 1e6
+
+    def evict(self):
+        """Delete least-recently-used columns until the cache fits within max_size_mb."""
+        if self.max_size_mb is None:
+            return
+        files = sorted(glob.glob(os.path.join(self.cache_dir, "*.npy")), key=os.path.getmtime)
+        sizes = [os.path.getsize(x) for x in files]
+        total, n_removed = sum(sizes), 0
+        for filename, size in zip(files, sizes):
+            if total <= self.max_size_mb * 1e6:
+                break
+            os.remove(filename)
+            total, n_removed = total - size, n_removed + 1
+        if n_removed > 0:
+            print("Evicted %d Green's function columns from cache %s" % (n_removed, self.cache_dir))
+        return
+
+    def lookup(self, fault_patches, elastic_params, lons, lats, look_vectors=None):
+        """
+        Find the cached columns for a list of fault patches. gf_engine.compute_gf_matrix computes the missing
+        columns, puts them, and evicts.
+
+        :param fault_patches: list of fault_slip_objects or fault_slip_triangles
+        :param elastic_params: dictionary of everything else that changes the GFs (moduli, reference point, code used)
+        :param lons: 1d array of observation longitudes
+        :param lats: 1d array of observation latitudes
+        :param look_vectors: optional tuple of 1d arrays (lkv_E, lkv_N, lkv_U) for LOS observations
+        :returns: list of keys, and list of columns with None for each patch that is not in the cache
+        """
+        obs_hash = get_observation_hash(lons, lats, look_vectors)
+        keys = [get_column_key(patch, elastic_params, obs_hash) for patch in fault_patches]
+        columns = [self.get(key) for key in keys]
+        n_found = len([x for x in columns if x is not None])
+        print("Green's function cache: %d of %d patches found in %s" % (n_found, len(keys), self.cache_dir))
+        return keys, columns
+
+
+def get_observation_hash(lons, lats, look_vectors=None):
+    """Hash of the observation coordinates and, if given, the look vectors at each observation point."""
+    sha = hashlib.sha1()
+    for array in [lons, lats] + (list(look_vectors) if look_vectors is not None else []):
+        sha.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    sha.update(b"los" if look_vectors is not None else b"enu")
+    return sha.hexdigest()
+
+
+def get_column_key(patch, elastic_params, obs_hash):
+    """Content address of one Green's function column."""
+    params = repr(sorted((str(k), repr(v)) for k, v in elastic_params.items()))
+    return hashlib.sha1((patch_geometry_hash(patch) + params + obs_hash).encode()).hexdigest()
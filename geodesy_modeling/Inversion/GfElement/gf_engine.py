@@ -0,0 +1,92 @@
+import concurrent.futures
+import os
+import numpy as np
+
+
+_compute_function = None   # the per-patch GF function, set once inside each worker process
+
+
+def _set_compute_function(compute_function):
+    global _compute_function
+    _compute_function = compute_function
+
+
+def _compute_chunk(patches):
+    """Worker: ENU displacements for a chunk of patches, shape (n_chunk, n_points, 3)."""
+    return np.array([_compute_function(patch) for patch in patches], dtype=float)
+
+
+def compute_gf_matrix(fault_patches, compute_function, lons=None, lats=None, num_workers=None, chunksize=None,
+                      cache=None, elastic_params=None):
+    """
+    Compute the Green's functions of many fault patches, spread over a process pool in chunks.
+    Output ordering always follows fault_patches, regardless of the order in which chunks finish.
+
+    :param fault_patches: list of unit-slip fault_slip_objects or fault_slip_triangles
+    :param compute_function: function(patch) -> ENU displacements at the observation points, shape (n_points, 3).
+        Must be picklable (a module-level function, or a functools.partial of one) when num_workers > 1.
+    :param lons: 1d array of observation longitudes. Required if a cache is used.
+    :param lats: 1d array of observation latitudes. Required if a cache is used.
+    :param num_workers: number of processes. Default is os.cpu_count(). 1 computes in this process
+    :param chunksize: number of patches sent to a worker at once. Default gives each worker about 4 chunks
+    :param cache: optional GfCache. ENU columns are cached, so ascending and descending tracks share them
+    :param elastic_params: dictionary of everything else that changes the GFs, used for the cache key
+    :returns: array of shape (n_points, 3, n_patches). Use general_utils.project_enu_into_los for InSAR.
+    """
+    n_patches = len(fault_patches)
+    if cache is not None:
+        keys, columns = cache.lookup(fault_patches, elastic_params or {}, lons, lats)
+    else:
+        keys, columns = None, [None for _i in range(n_patches)]
+    missing = [i for i, column in enumerate(columns) if column is None]
+
+    if len(missing) > 0:
+        enu_missing = compute_enu_stack([fault_patches[i] for i in missing], compute_function, num_workers,
+                                        chunksize)
+        for j, i in enumerate(missing):
+            columns[i] = enu_missing[j]
+            if cache is not None:
+                cache.put(keys[i], columns[i])
+        if cache is not None:
+            cache.evict()
+
+    enu = np.array(columns, dtype=float)  # shape (n_patches, n_points, 3)
+    return np.transpose(enu, (1, 2, 0))
+
+
+def compute_enu_stack(fault_patches, compute_function, num_workers=None, chunksize=None):
+    """
+    Run compute_function on every patch, in a process pool if num_workers > 1.
+
+    :returns: array of shape (n_patches, n_points, 3), in the order of fault_patches
+    """
+    n_patches = len(fault_patches)
+    num_workers = num_workers or os.cpu_count() or 1
+    num_workers = min(num_workers, n_patches)
+    if num_workers <= 1:
+        results = []
+        for i, patch in enumerate(fault_patches):
+            results.append(compute_function(patch))
+            _report_progress(i + 1, n_patches)
+        return np.array(results, dtype=float)
+
+    chunksize = chunksize or max(1, int(np.ceil(n_patches / (4 * num_workers))))
+    chunk_starts = list(range(0, n_patches, chunksize))
+    results = [None for _i in chunk_starts]
+    n_done = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_set_compute_function,
+                                                initargs=(compute_function,)) as executor:
+        futures = {executor.submit(_compute_chunk, fault_patches[start:start + chunksize]): k
+                   for k, start in enumerate(chunk_starts)}
+        for future in concurrent.futures.as_completed(futures):
+            k = futures[future]
+            results[k] = future.result()
+            n_done += len(results[k])
+            print("Computed Green's functions for %d of %d patches" % (n_done, n_patches))
+    return np.concatenate(results, axis=0)
+
+
+def _report_progress(n_done, n_total):
+    if n_done == n_total or n_done % max(1, n_total // 10) == 0:
+        print("Computed Green's functions for %d of %d patches" % (n_done, n_total))
+    return
@@ -1,9 +1,11 @@
+import numpy as np
 from elastic_stresses_py.PyCoulomb import fault_slip_object as fso
-from elastic_stresses_py.PyCoulomb.disp_points_object.disp_points_object import Displacement_points
 import elastic_stresses_py.PyCoulomb.fault_slip_triangle as fst
-from .GfElement import GfElement
+from .GfMatrix import GfMatrix
 import scipy.io
 
+STATIC1D_FIELD_WIDTHS = (20, 13, 13, 13)  # leading columns, then x, y, z displacements in cm
+
 
 def write_csz_dist_fault_patches(gf_elements, model_results_vector, outfile_gmt, outfile_txt):
     """Write out slip results for a distributed CSZ model into GMT format"""
@@ -28,78 +30,94 @@ def read_distributed_GF_static1d(gf_file, geom_file, latlonfile, latlonbox=(-127
     If unit_slip, we divide by the imposed slip rate to get a 1 cm/yr Green's Function.
     Returns a list of lists of disp_point objects, and a matching list of fault patches.
     We get into a minimal GfElement object the rest of the way research-specific code in the Humboldt driver.
+    Adapter around read_distributed_GF_static1d_matrix() for code that uses lists of GfElements.
+    """
+    gf_matrix, given_slip = read_distributed_GF_static1d_matrix(gf_file, geom_file, latlonfile, latlonbox, unit_slip)
+    return gf_matrix.to_gf_elements(), given_slip
+
+
+def read_distributed_GF_static1d_matrix(gf_file, geom_file, latlonfile, latlonbox=(-127, -120, 38, 52),
+                                        unit_slip=False):
+    """
+    Read results of Fred's Static1D file (e.g., stat2C.outCascadia) straight into a GfMatrix.
+    We also restrict the range of fault elements using a bounding box
+    If unit_slip, we divide by the imposed slip rate to get a 1 cm/yr Green's Function.
+    Returns a GfMatrix with one model parameter per fault patch, and the list of originally imposed slips.
     """
     fault_patches = fso.file_io.io_static1d.read_stat2C_geometry(geom_file)
     gps_disp_locs = fso.file_io.io_static1d.read_disp_points_from_static1d(latlonfile)
+    disps = read_static1d_disps_array(gf_file, len(fault_patches), len(gps_disp_locs))  # (patches, stations, 3)
+
+    keep = np.array([patch.is_within_bbox(latlonbox) for patch in fault_patches], dtype=bool)  # southern patches
+    kept_patches = [patch for patch, k in zip(fault_patches, keep) if k]
+    given_slip = np.array([patch.slip for patch in kept_patches], dtype=float)  # in mm
+    if unit_slip:
+        norm_factors = 0.010 / given_slip  # normalizing to 1 cm/yr Green's Function
+    else:
+        norm_factors = np.ones(np.shape(given_slip))
+    disps = -disps[keep] * norm_factors[:, None, None]  # negative means backslip
+    fault_slip_patches = [patch.change_fault_slip(patch.slip * norm) for patch, norm in zip(kept_patches,
+                                                                                           norm_factors)]
+    gf_matrix = GfMatrix(lons=[pt.lon for pt in gps_disp_locs], lats=[pt.lat for pt in gps_disp_locs],
+                         disps=np.transpose(disps, (1, 2, 0)), fault_dict_lists=[[x] for x in fault_slip_patches],
+                         meas_types='model')
+    return gf_matrix, list(given_slip)
+
+
+def read_static1d_disps_array(gf_file, n_patches, n_stations):
+    """
+    Fixed-width decoding of a Static1D displacement output file in one pass.
+    The file holds one line per (patch, station) pair, with stations varying fastest.
 
+    :param gf_file: string, filename
+    :param n_patches: int, number of fault patches in the geometry file
+    :param n_stations: int, number of stations in the lon/lat file
+    :returns: array of shape (n_patches, n_stations, 3), east/north/up displacements in meters
+    """
     print("Reading file %s " % gf_file)
-    xdisps, ydisps, zdisps = [], [], []
-    ifile = open(gf_file, 'r')
-    for line in ifile:
-        x = line[20:33]
-        y = line[33:46]
-        z = line[46:59]
-        xdisps.append(float(x)/100)
-        ydisps.append(float(y)/100)
-        zdisps.append(float(z)/100)  # convert from cm to m
-    ifile.close()
-
-    counter = 0
-    norm_factor = 1
-    disp_points_all_patches, all_patches, given_slip = [], [], []
-    GF_elements = []
-    for i in range(len(fault_patches)):
-        if not fault_patches[i].is_within_bbox(latlonbox):  # can restrict to the southern patches if desired
-            counter = counter + len(gps_disp_locs)
-            continue
-        disp_points_one_patch = []
-        for j in range(len(gps_disp_locs)):
-            # Build a list of GF disp_points for each patch in inversion
-            if unit_slip:
-                norm_factor = 0.010 / fault_patches[i].slip  # normalizing to 1 cm/yr Green's Function
-            else:
-                norm_factor = 1
-            disp_point = Displacement_points(lon=gps_disp_locs[j].lon, lat=gps_disp_locs[j].lat,
-                                             dE_obs=-xdisps[counter] * norm_factor,  # negative means backslip
-                                             dN_obs=-ydisps[counter] * norm_factor,
-                                             dU_obs=-zdisps[counter] * norm_factor,
-                                             Se_obs=0, Sn_obs=0, Su_obs=0, meas_type='model')
-            counter = counter + 1
-            disp_points_one_patch.append(disp_point)
-            if counter == len(gps_disp_locs):
-                break
-        fault_slip_patch = fault_patches[i].change_fault_slip(fault_patches[i].slip * norm_factor)
-
-        new_gf = GfElement(fault_dict_list=[fault_slip_patch], disp_points=disp_points_one_patch)
-        GF_elements.append(new_gf)
-        given_slip.append(fault_patches[i].slip)  # in mm
-
-    return GF_elements, given_slip
+    xyz = np.genfromtxt(gf_file, delimiter=STATIC1D_FIELD_WIDTHS, usecols=(1, 2, 3), dtype=float)
+    xyz = np.reshape(xyz, (-1, 3)) / 100  # convert from cm to m
+    if len(xyz) < n_patches * n_stations:
+        raise ValueError("Error! File %s has %d lines, expected %d patches x %d stations." % (gf_file, len(xyz),
+                                                                                            n_patches, n_stations))
+    return np.reshape(xyz[0:n_patches * n_stations], (n_patches, n_stations, 3))
 
 
 def read_GFs_matlab_CSZ(gf_file):
     """
     Read the Green's functions for the CSZ calculated in Materna et al., 2019 by Noel Bartlow.
     Returns a list of Green's Functions elements.
+    Adapter around read_GFs_matlab_CSZ_matrix() for code that uses lists of GfElements.
     """
+    return read_GFs_matlab_CSZ_matrix(gf_file).to_gf_elements()
+
 
+def read_GFs_matlab_CSZ_matrix(gf_file):
+    """
+    Read the Green's functions for the CSZ calculated in Materna et al., 2019 by Noel Bartlow.
+    Returns a GfMatrix whose displacements are a view into the kernel from the .mat file, without copying.
+    """
     print("Reading file %s " % gf_file)
     data_structure = scipy.io.loadmat(gf_file)  # a large dictionary object
     kern = data_structure['Kern']  # 165 x 303 (E, N, U for each grid element)
     fault_patches, nodes = fst.file_io.io_other.read_csz_bartlow_2019(gf_file)
+    unit_patches = [patch.change_fault_slip(1.0, 0, 0) for patch in fault_patches]
+    return GfMatrix(lons=data_structure['Lons'][:, 0], lats=data_structure['Lats'][:, 0],
+                    disps=interleaved_kernel_as_enu_view(kern), param_names=[str(i) for i in range(len(fault_patches))],
+                    units='meters', fault_dict_lists=[[patch] for patch in unit_patches])
+
 
-    num_gf_elements = len(fault_patches)
-    gf_elements = []
-    for patch_number in range(num_gf_elements):
-        model_disp_points = []
-        for i in range(len(data_structure['Lons'])):
-            new_item = Displacement_points(lon=data_structure['Lons'][i][0], lat=data_structure['Lats'][i][0],
-                                           dE_obs=kern[(3*i)][patch_number], dN_obs=kern[(3*i)+1][patch_number],
-                                           dU_obs=kern[(3*i)+2][patch_number])
-            model_disp_points.append(new_item)  # Read model disp_points associated with one fault patch.
-        fault_patches[patch_number] = fault_patches[patch_number].change_fault_slip(1.0, 0, 0)
-
-        one_GF = GfElement(disp_points=model_disp_points, param_name=str(patch_number), units='meters',
-                           fault_dict_list=[fault_patches[patch_number]])
-        gf_elements.append(one_GF)
-    return gf_elements
+def interleaved_kernel_as_enu_view(kern):
+    """
+    Read-only strided view of a kernel with E, N, U rows interleaved for each station.
+    Works for both C-ordered and Fortran-ordered kernels (scipy.io.loadmat gives Fortran order), without copying.
+
+    :param kern: 2d array, shape (3*n_stations, n_patches)
+    :returns: array of shape (n_stations, 3, n_patches)
+    """
+    n_rows, n_patches = np.shape(kern)
+    if n_rows % 3 != 0:
+        raise ValueError("Error! Kernel has %d rows, which is not 3 components per station." % n_rows)
+    row_stride, col_stride = kern.strides
+    return np.lib.stride_tricks.as_strided(kern, shape=(n_rows // 3, 3, n_patches),
+                                           strides=(3 * row_stride, row_stride, col_stride), writeable=False)
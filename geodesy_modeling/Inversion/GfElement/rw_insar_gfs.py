@@ -1,3 +1,6 @@
+import hashlib
+import json
+import os
 import numpy as np
 from elastic_stresses_py.PyCoulomb import disp_points_object as dpo
 from elastic_stresses_py.PyCoulomb.fault_slip_triangle import fault_slip_triangle
@@ -16,34 +19,44 @@ def read_insar_greens_functions(gf_file, fault_patches, param_name='', lower_bou
     :param lower_bound: float
     :param upper_bound: float
     """
-    GF_elements = []
     gf_data_array = np.loadtxt(gf_file)
     lons, lats = gf_data_array[:, 0], gf_data_array[:, 1]
+    return gf_elements_from_los_array(lons, lats, gf_data_array[:, 2:], fault_patches, param_name, lower_bound,
+                                      upper_bound)
+
+
+def gf_elements_from_los_array(lons, lats, los_array, fault_patches, param_name='', lower_bound=0, upper_bound=0):
+    """
+    Package a dense array of LOS Green's functions into a list of GfElements, one per fault patch.
+
+    :param lons: 1d array of InSAR point longitudes
+    :param lats: 1d array of InSAR point latitudes
+    :param los_array: 2d array, shape (n_points, n_patches), LOS displacement due to unit slip on each patch
+    :param fault_patches: list of fault_slip_objects or fault_slip_triangles, same length as columns of los_array
+    :param param_name: string
+    :param lower_bound: float
+    :param upper_bound: float
+    """
+    GF_elements = []
     model_disp_pts = []
     for tlon, tlat in zip(lons, lats):
         model_disp_pts.append(Displacement_points(lon=tlon, lat=tlat, dE_obs=0, dN_obs=0, dU_obs=0, meas_type='insar'))
-
-    if isinstance(fault_patches[0], fault_slip_triangle.TriangleFault):  # triangle version
-        for i, tri in enumerate(fault_patches):
-            changed_slip = tri.change_fault_slip(rtlat=1, dipslip=0, tensile=0)  # triangle-specific
-            changed_slip = changed_slip.change_reference_loc()  # triangle-specific interface
-            index = i+2  # moving to the correct column in the GF file, skipping lon and lat.
-            los_defo = gf_data_array[:, index]
-            model_disp_pts = dpo.utilities.with_easts_as(model_disp_pts, los_defo)
-            GF_elements.append(GfElement(disp_points=model_disp_pts, fault_dict_list=[changed_slip], units='m',
-                                         param_name=param_name, lower_bound=lower_bound, upper_bound=upper_bound))
-
-    else:
-        for i, patch in enumerate(fault_patches):  # Rectangular version
-            changed_slip = patch.change_fault_slip(new_slip=1, new_rake=180, new_tensile=0)
-            index = i+2  # moving to the correct column in the GF file, skipping lon and lat.
-            los_defo = gf_data_array[:, index]
-            model_disp_pts = dpo.utilities.with_easts_as(model_disp_pts, los_defo)
-            GF_elements.append(GfElement(disp_points=model_disp_pts, fault_dict_list=[changed_slip], units='m',
-                                         param_name=param_name, lower_bound=lower_bound, upper_bound=upper_bound))
+    for i, patch in enumerate(fault_patches):
+        changed_slip = unit_slip_patch(patch)
+        model_disp_pts = dpo.utilities.with_easts_as(model_disp_pts, los_array[:, i])
+        GF_elements.append(GfElement(disp_points=model_disp_pts, fault_dict_list=[changed_slip], units='m',
+                                     param_name=param_name, lower_bound=lower_bound, upper_bound=upper_bound))
     return GF_elements
 
 
+def unit_slip_patch(patch):
+    """Return the unit-slip version of a fault patch, matching the convention used when computing InSAR GFs."""
+    if isinstance(patch, fault_slip_triangle.TriangleFault):  # triangle version
+        changed_slip = patch.change_fault_slip(rtlat=1, dipslip=0, tensile=0)  # triangle-specific
+        return changed_slip.change_reference_loc()  # triangle-specific interface
+    return patch.change_fault_slip(new_slip=1, new_rake=180, new_tensile=0)  # Rectangular version
+
+
 def write_insar_greens_functions(GF_elements, outfile):
     """
     Serialize a bunch of InSAR Green's Functions into written text file, in meters, with rows for each InSAR point:
@@ -62,3 +75,159 @@ def write_insar_greens_functions(GF_elements, outfile):
         ofile.write("\n")
     ofile.close()
     return
+
+
+def patch_geometry_hash(patch):
+    """
+    Short, stable hash of all the attributes of a fault patch (geometry and slip).
+    Used to check that a stored GF column still belongs to the patch that is being inverted.
+
+    :param patch: fault_slip_object or fault_slip_triangle
+    :returns: string, hex digest
+    """
+    return hashlib.sha1(_stable_repr(patch).encode()).hexdigest()
+
+
+def _stable_repr(value):
+    """A repr that does not depend on memory addresses, so that hashes are reproducible between runs."""
+    if hasattr(value, '__dict__'):
+        return type(value).__name__ + _stable_repr(vars(value))
+    if isinstance(value, dict):
+        return '{' + ', '.join('%s: %s' % (repr(k), _stable_repr(value[k])) for k in sorted(value, key=str)) + '}'
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return '[' + ', '.join(_stable_repr(x) for x in value) + ']'
+    return repr(value)
+
+
+def write_insar_greens_functions_binary(GF_elements, outfile, look_vectors=None):
+    """
+    Serialize a bunch of InSAR Green's Functions into a binary store: a .npy matrix of LOS displacements in meters,
+    shape (n_points, n_patches), plus a small .json header holding lon, lat, patch hashes, units, and look vectors.
+    The matrix is written in Fortran order, so that one fault patch (one column) is contiguous on disk.
+
+    :param GF_elements: list of GF_elements with InSAR displacements in disp_points.
+    :param outfile: string, filename of the .npy matrix. The header goes next to it with a .json extension.
+    :param look_vectors: optional tuple of 1d arrays (lkv_E, lkv_N, lkv_U) used to project the GFs into LOS
+    """
+    n_points, n_patches = len(GF_elements[0].disp_points), len(GF_elements)
+    print("Writing file %s " % outfile)
+    gf_array = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.float64, shape=(n_points, n_patches),
+                                         fortran_order=True)
+    for i, GF_el in enumerate(GF_elements):
+        gf_array[:, i] = [pt.dE_obs for pt in GF_el.disp_points]
+    gf_array.flush()
+    del gf_array
+    header = {"n_points": n_points, "n_patches": n_patches, "units": GF_elements[0].units,
+              "lon": [pt.lon for pt in GF_elements[0].disp_points],
+              "lat": [pt.lat for pt in GF_elements[0].disp_points],
+              "patch_hashes": [patch_geometry_hash(x.fault_dict_list[0]) if len(x.fault_dict_list) > 0 else None
+                               for x in GF_elements]}
+    if look_vectors is not None:
+        header["lkv_E"], header["lkv_N"], header["lkv_U"] = [np.asarray(x, dtype=float).tolist()
+                                                             for x in look_vectors]
+    write_insar_gf_header(header, _header_filename(outfile))
+    return
+
+
+def write_insar_gf_header(header, header_file):
+    print("Writing file %s " % header_file)
+    with open(header_file, 'w') as fp:
+        json.dump(header, fp)
+    return
+
+
+def read_insar_gf_header(gf_file):
+    """Read the .json header that goes with a binary GF store."""
+    with open(_header_filename(gf_file), 'r') as fp:
+        header = json.load(fp)
+    return header
+
+
+def read_insar_gf_array(gf_file, row_indices=None, col_indices=None, bbox=None):
+    """
+    Read part or all of a binary GF store through a memory map, without loading the full matrix.
+
+    :param gf_file: string, filename of the .npy matrix
+    :param row_indices: optional integer indices of the InSAR points to keep
+    :param col_indices: optional integer indices of the fault patches to keep
+    :param bbox: optional (W, E, S, N) box; keeps only InSAR points inside it. Combined with row_indices if both given
+    :returns: lons, lats, and LOS array of shape (n_selected_points, n_selected_patches)
+    """
+    header = read_insar_gf_header(gf_file)
+    lons, lats = np.array(header["lon"]), np.array(header["lat"])
+    rows = np.arange(len(lons)) if row_indices is None else np.asarray(row_indices, dtype=int)
+    if bbox is not None:
+        rows = rows[(bbox[0] <= lons[rows]) & (lons[rows] <= bbox[1]) &
+                    (bbox[2] <= lats[rows]) & (lats[rows] <= bbox[3])]
+    gf_array = np.load(gf_file, mmap_mode='r')
+    if np.shape(gf_array) != (header["n_points"], header["n_patches"]):
+        raise ValueError("Error! GF store %s does not match its header." % gf_file)
+    cols = np.arange(header["n_patches"]) if col_indices is None else np.asarray(col_indices, dtype=int)
+    los_array = np.empty((len(rows), len(cols)))
+    for j, col in enumerate(cols):  # each column is contiguous on disk
+        los_array[:, j] = gf_array[:, col][rows]
+    return lons[rows], lats[rows], los_array
+
+
+def read_insar_greens_functions_binary(gf_file, fault_patches, param_name='', lower_bound=0, upper_bound=0,
+                                       patch_indices=None, bbox=None):
+    """
+    Read pre-computed green's functions from a binary GF store, optionally only a subset of patches or pixels.
+
+    :param gf_file: string, filename of the .npy matrix
+    :param fault_patches: list of fault_slip_objects or fault_slip_triangles, all the patches used to build the store
+    :param param_name: string
+    :param lower_bound: float
+    :param upper_bound: float
+    :param patch_indices: optional integer indices of the fault patches to keep
+    :param bbox: optional (W, E, S, N) box of InSAR points to keep
+    """
+    header = read_insar_gf_header(gf_file)
+    if len(fault_patches) != header["n_patches"]:
+        raise ValueError("Error! %d fault patches given, but GF store %s holds %d." % (len(fault_patches), gf_file,
+                                                                                        header["n_patches"]))
+    cols = np.arange(len(fault_patches)) if patch_indices is None else np.asarray(patch_indices, dtype=int)
+    selected_patches = [fault_patches[i] for i in cols]
+    for i, patch in zip(cols, selected_patches):
+        stored_hash = header["patch_hashes"][i]
+        if stored_hash is not None and stored_hash != patch_geometry_hash(unit_slip_patch(patch)):
+            raise ValueError("Error! Fault patch %d does not match the geometry stored in %s." % (i, gf_file))
+    lons, lats, los_array = read_insar_gf_array(gf_file, col_indices=cols, bbox=bbox)
+    return gf_elements_from_los_array(lons, lats, los_array, selected_patches, param_name, lower_bound, upper_bound)
+
+
+def read_insar_gf_file(gf_file, fault_patches, param_name='', lower_bound=0, upper_bound=0):
+    """
+    Read pre-computed green's functions from either format, chosen by the file extension.
+    A .txt file is read as text. A .npy file is read from the binary store; if only the matching .txt file exists,
+    it is converted into the binary store first, so existing text GFs keep working.
+
+    :param gf_file: string, filename ending in .txt or .npy
+    :param fault_patches: list of fault_slip_objects or fault_slip_triangles
+    :param param_name: string
+    :param lower_bound: float
+    :param upper_bound: float
+    """
+    if gf_file.endswith('.npy'):
+        text_file = gf_file.rsplit('.npy', 1)[0] + '.txt'
+        if not os.path.exists(gf_file) and os.path.exists(text_file):
+            convert_text_gfs_to_binary(text_file, gf_file)
+        return read_insar_greens_functions_binary(gf_file, fault_patches, param_name, lower_bound, upper_bound)
+    return read_insar_greens_functions(gf_file, fault_patches, param_name, lower_bound, upper_bound)
+
+
+def convert_text_gfs_to_binary(text_file, outfile, units='m'):
+    """One-time conversion of a text GF file (from write_insar_greens_functions) into a binary GF store."""
+    gf_data_array = np.loadtxt(text_file)
+    n_points, n_patches = np.shape(gf_data_array)[0], np.shape(gf_data_array)[1] - 2
+    print("Writing file %s " % outfile)
+    np.save(outfile, np.asfortranarray(gf_data_array[:, 2:]))
+    header = {"n_points": n_points, "n_patches": n_patches, "units": units,
+              "lon": gf_data_array[:, 0].tolist(), "lat": gf_data_array[:, 1].tolist(),
+              "patch_hashes": [None for _i in range(n_patches)]}
+    write_insar_gf_header(header, _header_filename(outfile))
+    return
+
+
+def _header_filename(gf_file):
+    return gf_file.rsplit('.npy', 1)[0] + '.json'
@@ -1,5 +1,7 @@
 
 import numpy as np
+import scipy.sparse
+import scipy.spatial
 from elastic_stresses_py.PyCoulomb.disp_points_object.disp_points_object import Displacement_points
 import elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import elastic_stresses_py.PyCoulomb.fault_slip_object as library
@@ -8,6 +10,44 @@ from .GfElement.GfElement import GfElement
 import os
 
 
+def get_pairing_indices(obs_lons, obs_lats, model_lons, model_lats, tol=0.001):
+    """
+    Find the matching model point for each observation point, using one spatial index over the model coordinates.
+    For each observation, the first model point (in list order) that lies strictly within tol in both lon and lat
+    is selected, which reproduces the result of the original nested-loop search.
+
+    :param obs_lons: 1d array of observation longitudes, length n
+    :param obs_lats: 1d array of observation latitudes, length n
+    :param model_lons: 1d array of model longitudes, length m
+    :param model_lats: 1d array of model latitudes, length m
+    :param tol: tolerance, default 0.001 degrees
+    :returns: array of obs indices, array of matching model indices, with matching lengths p
+    """
+    obs_xy = np.column_stack((np.asarray(obs_lons, dtype=float), np.asarray(obs_lats, dtype=float)))
+    model_xy = np.column_stack((np.asarray(model_lons, dtype=float), np.asarray(model_lats, dtype=float)))
+    if len(obs_xy) == 0 or len(model_xy) == 0:
+        return np.zeros((0,), dtype=int), np.zeros((0,), dtype=int)
+    tree = scipy.spatial.cKDTree(model_xy)
+    candidates = tree.query_ball_point(obs_xy, r=tol, p=np.inf)  # square box of half-width tol around each obs
+    obs_idx, model_idx = [], []
+    for i, neighbors in enumerate(candidates):
+        if len(neighbors) == 0:
+            continue
+        neighbors = np.sort(neighbors)
+        inside = np.all(np.abs(model_xy[neighbors] - obs_xy[i]) < tol, axis=1)  # strict inequality, as before
+        if np.any(inside):
+            obs_idx.append(i)
+            model_idx.append(neighbors[np.argmax(inside)])  # first model point in list order
+    return np.array(obs_idx, dtype=int), np.array(model_idx, dtype=int)
+
+
+def get_disp_points_coords(disp_points):
+    """Return two 1d arrays, lons and lats, for a list of disp_points."""
+    lons = np.array([item.lon for item in disp_points], dtype=float)
+    lats = np.array([item.lat for item in disp_points], dtype=float)
+    return lons, lats
+
+
 def pair_obs_model(obs_disp_pts, model_disp_pts, tol=0.001):
     """
     Filters two lists of disp_points objects, just pairing the objects together where their locations match
@@ -17,13 +57,11 @@ def pair_obs_model(obs_disp_pts, model_disp_pts, tol=0.001):
     :param tol: tolerance, default 0.001 degrees
     :returns: list of disp_point_obj, list of disp_point_obj, with matching lengths p
     """
-    paired_model, paired_obs = [], []
-    for obs_item in obs_disp_pts:
-        for model_item in model_disp_pts:
-            if abs(obs_item.lon - model_item.lon) < tol and abs(obs_item.lat - model_item.lat) < tol:
-                paired_model.append(model_item)
-                paired_obs.append(obs_item)
-                break
+    obs_lons, obs_lats = get_disp_points_coords(obs_disp_pts)
+    model_lons, model_lats = get_disp_points_coords(model_disp_pts)
+    obs_idx, model_idx = get_pairing_indices(obs_lons, obs_lats, model_lons, model_lats, tol=tol)
+    paired_obs = [obs_disp_pts[i] for i in obs_idx]
+    paired_model = [model_disp_pts[i] for i in model_idx]
     return paired_obs, paired_model
 
 
@@ -31,6 +69,7 @@ def pair_gf_elements_with_obs(obs_disp_points, gf_elements, tol=0.001):
     """
     Take list of GF_elements, and list of obs_disp_points. Pare them down to a matching set of points in same order.
     The assumption is that all gf_elements have same points inside them (because we take first one as representative)
+    The pairing index is computed once and reused for every gf_element that shares the same coordinates.
 
     :param obs_disp_points: list of disp_points
     :param gf_elements: a list of gf_elements with all the same points inside them
@@ -38,84 +77,185 @@ def pair_gf_elements_with_obs(obs_disp_points, gf_elements, tol=0.001):
     :returns: paired_obs (list of disp_points), paired_gf_elements (list of gf_elements)
     """
     paired_gf_elements = []  # a list of GfElement objects
-    paired_obs, _ = pair_obs_model(obs_disp_points, gf_elements[0].disp_points, tol=tol)  # get paired obs disp_points
+    obs_lons, obs_lats = get_disp_points_coords(obs_disp_points)
+    ref_lons, ref_lats = get_disp_points_coords(gf_elements[0].disp_points)
+    obs_idx, ref_model_idx = get_pairing_indices(obs_lons, obs_lats, ref_lons, ref_lats, tol=tol)
+    paired_obs = [obs_disp_points[i] for i in obs_idx]  # get paired obs disp_points
     target_len = len(paired_obs)
     for gf_model in gf_elements:
-        _, paired_gf = pair_obs_model(obs_disp_points, gf_model.disp_points, tol=tol)  # one fault or CSZ patch
-        paired_gf_elements.append(GfElement(disp_points=paired_gf, param_name=gf_model.param_name,
-                                            fault_dict_list=gf_model.fault_dict_list, lower_bound=gf_model.lower_bound,
-                                            upper_bound=gf_model.upper_bound,
-                                            slip_penalty=gf_model.slip_penalty, units=gf_model.units,
-                                            points=gf_model.points))
-        if len(paired_gf) != target_len:
+        model_idx = ref_model_idx
+        model_lons, model_lats = get_disp_points_coords(gf_model.disp_points)
+        if not (np.array_equal(model_lons, ref_lons) and np.array_equal(model_lats, ref_lats)):
+            _, model_idx = get_pairing_indices(obs_lons, obs_lats, model_lons, model_lats, tol=tol)  # different pts
+        [paired_gf] = select_gf_element_points([gf_model], model_idx)  # one fault or CSZ patch
+        paired_gf_elements.append(paired_gf)
+        if len(paired_gf.disp_points) != target_len:
             raise ValueError("ERROR! Not all points have green's functions.")
     return paired_obs, paired_gf_elements
 
 
+def select_gf_element_points(gf_elements, point_idx):
+    """
+    Build new GfElements holding only some of the modeled points, in the order given by point_idx.
+
+    :param gf_elements: list of gf_elements
+    :param point_idx: integer indices into the disp_points of each gf_element
+    :returns: list of gf_elements
+    """
+    new_gf_elements = []
+    for gf_model in gf_elements:
+        new_gf_elements.append(GfElement(disp_points=[gf_model.disp_points[i] for i in point_idx],
+                                         param_name=gf_model.param_name, fault_dict_list=gf_model.fault_dict_list,
+                                         lower_bound=gf_model.lower_bound, upper_bound=gf_model.upper_bound,
+                                         slip_penalty=gf_model.slip_penalty, units=gf_model.units,
+                                         points=gf_model.points))
+    return new_gf_elements
+
+
+def pair_gf_matrix_with_obs(obs_disp_points, gf_matrix, tol=0.001):
+    """
+    Array-backed version of pair_gf_elements_with_obs.  Pare a GfMatrix and a list of obs_disp_points down to a
+    matching set of points in same order.
+
+    :param obs_disp_points: list of disp_points
+    :param gf_matrix: a GfMatrix object
+    :param tol: tolerance for pairing station with station, in degrees
+    :returns: paired_obs (list of disp_points), paired_gf_matrix (GfMatrix)
+    """
+    obs_lons, obs_lats = get_disp_points_coords(obs_disp_points)
+    obs_idx, model_idx = get_pairing_indices(obs_lons, obs_lats, gf_matrix.lons, gf_matrix.lats, tol=tol)
+    paired_obs = [obs_disp_points[i] for i in obs_idx]
+    return paired_obs, gf_matrix.select_points(model_idx)
+
+
+# Which components (E, N, U) we model for each type of observation. Anything else uses all three components.
+COMPONENTS_BY_MEAS_TYPE = {
+    "continuous": (True, True, True),
+    "survey": (True, True, False),
+    "leveling": (False, False, True),
+    "tide_gage": (False, False, True),
+    "insar": (True, False, False),
+}
+
+
 def get_displacement_directions(obs_disp_point, model_point):
     """
     Code up the logic for which components we model for each GNSS/leveling/tidegage/insar point, etc
     """
-    if obs_disp_point.meas_type == "continuous":
-        disps = np.array([model_point.dE_obs, model_point.dN_obs, model_point.dU_obs])
-        sigmas = np.array([model_point.Se_obs, model_point.Sn_obs, model_point.Su_obs])
-    elif obs_disp_point.meas_type == "survey":
-        disps = np.array([model_point.dE_obs, model_point.dN_obs])
-        sigmas = np.array([model_point.Se_obs, model_point.Sn_obs])
-    elif obs_disp_point.meas_type == "leveling":
-        disps = np.array([model_point.dU_obs])
-        sigmas = np.array([model_point.Su_obs])
-    elif obs_disp_point.meas_type == "tide_gage":
-        disps = np.array([model_point.dU_obs])
-        sigmas = np.array([model_point.Su_obs])
-    elif obs_disp_point.meas_type == "insar":
-        disps = np.array([model_point.dE_obs])
-        sigmas = np.array([model_point.Se_obs])
-    else:
-        disps = np.array([model_point.dE_obs, model_point.dN_obs, model_point.dU_obs])
-        sigmas = np.array([model_point.Se_obs, model_point.Sn_obs, model_point.Su_obs])
+    mask = np.array(COMPONENTS_BY_MEAS_TYPE.get(obs_disp_point.meas_type, (True, True, True)))
+    disps = np.array([model_point.dE_obs, model_point.dN_obs, model_point.dU_obs])[mask]
+    sigmas = np.array([model_point.Se_obs, model_point.Sn_obs, model_point.Su_obs])[mask]
     return disps, sigmas
 
 
-def unpack_model_pred_vector(model_pred, paired_obs):
+def get_component_mask(obs_disp_points):
+    """
+    Per-point mask of the components that we model, following get_displacement_directions.
+    Flattening an (n, 3) array with this mask gives the row ordering of G, obs, and sigmas.
+
+    :param obs_disp_points: list of disp_points, length n
+    :returns: boolean array, shape (n, 3), for E, N, U
+    """
+    mask = np.ones((len(obs_disp_points), 3), dtype=bool)
+    for i, item in enumerate(obs_disp_points):
+        mask[i] = COMPONENTS_BY_MEAS_TYPE.get(item.meas_type, (True, True, True))
+    return mask
+
+
+def get_row_provenance(obs_disp_points):
+    """
+    Which observation point and which component (0=E, 1=N, 2=U) each row of G, obs, and sigmas came from.
+
+    :param obs_disp_points: list of disp_points, length n
+    :returns: two integer arrays, row_station and row_component, each of length n_rows
+    """
+    row_station, row_component = np.nonzero(get_component_mask(obs_disp_points))  # same row-major order as G
+    return row_station, row_component
+
+
+def get_disps_array(disp_points):
+    """Return an (n, 3) array of dE, dN, dU for a list of disp_points."""
+    return np.array([[item.dE_obs, item.dN_obs, item.dU_obs] for item in disp_points], dtype=float).reshape(-1, 3)
+
+
+def get_sigmas_array(disp_points):
+    """Return an (n, 3) array of Se, Sn, Su for a list of disp_points."""
+    return np.array([[item.Se_obs, item.Sn_obs, item.Su_obs] for item in disp_points], dtype=float).reshape(-1, 3)
+
+
+def build_G_and_obs_vector(paired_obs, paired_gfs):
+    """
+    Build the Green's matrix, observation vector, and sigma vector in one pass.
+    The rows follow the same ordering as get_displacement_directions and unpack_model_pred_vector.
+
+    :param paired_obs: list of disp_points, length n
+    :param paired_gfs: list of paired GfElement objects (one per column), or a paired GfMatrix
+    :returns: G (n_rows x n_params), obs (n_rows), sigmas (n_rows)
+    """
+    mask = get_component_mask(paired_obs)
+    if hasattr(paired_gfs, 'disps'):  # GfMatrix: G assembly is only a reshape
+        if paired_gfs.n_points != len(paired_obs):
+            raise ValueError("Error! Length of modeled and observe vectors do not agree.")
+        G = paired_gfs.disps[mask]
+    else:
+        G = np.zeros((np.sum(mask), len(paired_gfs)))
+        for i, gf in enumerate(paired_gfs):
+            if len(gf.disp_points) != len(paired_obs):
+                raise ValueError("Error! Length of modeled and observe vectors do not agree.")
+            G[:, i] = get_disps_array(gf.disp_points)[mask]
+    obs = get_disps_array(paired_obs)[mask]
+    sigmas = get_sigmas_array(paired_obs)[mask]
+    return G, obs, sigmas
+
+
+def get_row_index_table(obs_disp_points):
+    """
+    Lookup table from each observation point and component to its row in G, obs, and sigmas.
+    Built once from the same component mask as G, so it always matches the row ordering of G.
+
+    :param obs_disp_points: list of disp_points, length n
+    :returns: integer array, shape (n, 3), for E, N, U. -1 where a component is not modeled.
+    """
+    mask = get_component_mask(obs_disp_points)
+    row_index_table = np.full(np.shape(mask), -1, dtype=int)
+    row_index_table[mask] = np.arange(np.sum(mask))
+    return row_index_table
+
+
+def unpack_model_pred_array(model_pred, row_index_table):
+    """
+    Scatter one or several prediction vectors into per-point E, N, U arrays, with NaN for unmodeled components.
+    Any rows beyond the data rows (such as smoothing rows) are ignored.
+
+    :param model_pred: array of shape (n_rows,) or (n_rows, k), following the row ordering of G
+    :param row_index_table: integer array, shape (n, 3), from get_row_index_table
+    :returns: array of shape (n, 3) or (n, 3, k)
+    """
+    model_pred = np.asarray(model_pred, dtype=float)
+    nan_row = np.full((1,) + np.shape(model_pred)[1:], np.nan)
+    padded = np.concatenate((model_pred, nan_row))  # row index -1 picks up the NaN row
+    return padded[row_index_table]
+
+
+def unpack_model_pred_vector(model_pred, paired_obs, row_index_table=None):
     """
     Unpack a model vector into a bunch of disp_point objects. Same logic implemented here as in the functions above.
-    In the future, this can be done with a dictionary or look-up table passed into the function.
 
     :param model_pred: long vector of model parameters, corresponding to each component being used
     :param paired_obs: list of disp_point_objects (shorter than model_pred vector)
+    :param row_index_table: optional, precomputed from get_row_index_table(paired_obs)
     """
-    disp_points_list = []
-    counter = 0
-    for i in range(len(paired_obs)):
-        if paired_obs[i].meas_type == "survey":
-            E = model_pred[counter]
-            N = model_pred[counter+1]
-            U = np.nan
-            counter = counter+2
-        elif paired_obs[i].meas_type == "leveling":
-            E, N = np.nan, np.nan
-            U = model_pred[counter]
-            counter = counter+1
-        elif paired_obs[i].meas_type == "tide_gage":
-            E, N = np.nan, np.nan
-            U = model_pred[counter]
-            counter = counter+1
-        elif paired_obs[i].meas_type == "insar":
-            E = model_pred[counter]
-            N, U = np.nan, np.nan
-            counter = counter+1
-        else:
-            E = model_pred[counter]
-            N = model_pred[counter+1]
-            U = model_pred[counter+2]
-            counter = counter+3
+    if row_index_table is None:
+        row_index_table = get_row_index_table(paired_obs)
+    enu = unpack_model_pred_array(model_pred, row_index_table)
+    return disp_points_from_array(enu, paired_obs)
+
 
-        new_disp_point = Displacement_points(lon=paired_obs[i].lon, lat=paired_obs[i].lat, dE_obs=E, dN_obs=N, dU_obs=U,
-                                             Se_obs=0, Sn_obs=0, Su_obs=0, name=paired_obs[i].name,
-                                             meas_type=paired_obs[i].meas_type, refframe=paired_obs[i].refframe)
-        disp_points_list.append(new_disp_point)
-    return disp_points_list
+def disp_points_from_array(enu, paired_obs):
+    """Build one disp_point per observation point from an (n, 3) array of E, N, U values."""
+    return [Displacement_points(lon=item.lon, lat=item.lat, dE_obs=E, dN_obs=N, dU_obs=U, Se_obs=0, Sn_obs=0,
+                                Su_obs=0, name=item.name, meas_type=item.meas_type, refframe=item.refframe)
+            for item, (E, N, U) in zip(paired_obs, enu.tolist())]
 
 
 def buildG_column(GF_disp_points, obs_disp_points):
@@ -123,12 +263,9 @@ def buildG_column(GF_disp_points, obs_disp_points):
     Green's functions for a single model element at each observation point (i.e., slip on one fault).
     Returns a single column of nx1.
     """
-    GF_col = []
     if len(GF_disp_points) != len(obs_disp_points):
         raise ValueError("Error! Length of modeled and observe vectors do not agree.")
-    for g_item, obs in zip(GF_disp_points, obs_disp_points):
-        new_values, _ = get_displacement_directions(obs, g_item)
-        GF_col = np.concatenate((GF_col, new_values))
+    GF_col = get_disps_array(GF_disp_points)[get_component_mask(obs_disp_points)]
     GF_col = np.reshape(GF_col, (len(GF_col), 1))
     return GF_col
 
@@ -137,21 +274,37 @@ def build_obs_vector(obs_disp_points):
     """
     Build observation 1D-vector.
     """
-    obs, sigmas = [], []
-    for item in obs_disp_points:
-        new_values, new_sigmas = get_displacement_directions(item, item)
-        obs = np.concatenate((obs, new_values), axis=0)
-        sigmas = np.concatenate((sigmas, new_sigmas), axis=0)
+    mask = get_component_mask(obs_disp_points)
+    obs = get_disps_array(obs_disp_points)[mask]
+    sigmas = get_sigmas_array(obs_disp_points)[mask]
     return obs, sigmas
 
 
-def forward_disp_points_predictions(G, m, sigmas, paired_obs):
+def forward_disp_points_predictions(G, m, sigmas, paired_obs, row_index_table=None):
     """Create a convenient list of disp_points from a forward prediction based on G and m and sigma matrices/vectors."""
     model_pred = G.dot(m) * sigmas
-    model_disp_points = unpack_model_pred_vector(model_pred, paired_obs)
+    model_disp_points = unpack_model_pred_vector(model_pred, paired_obs, row_index_table)
     return model_disp_points
 
 
+def forward_disp_points_predictions_batch(G, M, sigmas, paired_obs, row_index_table=None):
+    """
+    Forward predictions for several model vectors at once, with one G @ M product.
+
+    :param G: weighted G matrix, dense or sparse
+    :param M: array of shape (n_params, k), one model vector per column
+    :param sigmas: vector that G was weighted by
+    :param paired_obs: list of disp_points
+    :param row_index_table: optional, precomputed from get_row_index_table(paired_obs)
+    :returns: list of k lists of disp_points
+    """
+    if row_index_table is None:
+        row_index_table = get_row_index_table(paired_obs)
+    model_preds = G.dot(M) * np.asarray(sigmas)[:, None]
+    enu = unpack_model_pred_array(model_preds, row_index_table)  # shape (n, 3, k)
+    return [disp_points_from_array(enu[:, :, j], paired_obs) for j in range(np.shape(M)[1])]
+
+
 def unpack_model_of_target_param(M_vector, parameter_names, target_names=()):
     """
     Simplify a model vector into only those components from particular target_name (string), such as 'CSZ_dist'
@@ -188,8 +341,200 @@ def unpack_model_without_target_param(M_vector, parameter_names, exclude_names=(
     return M_target
 
 
+def build_group_selector(parameter_names, groups):
+    """
+    Sparse selector matrix that picks out named groups of model parameters, e.g. {'CSZ': ['CSZ_dist']}.
+    S[i, j] is 1 if parameter i belongs to group j. A parameter may belong to several groups.
+
+    :param parameter_names: list of parameters names for each model parameter
+    :param groups: dictionary of group name -> list of parameter names in that group
+    :returns: list of group names, and scipy.sparse matrix of shape (n_params, n_groups)
+    """
+    parameter_names = np.asarray(parameter_names)
+    group_names = list(groups.keys())
+    rows, cols = [], []
+    for j, name in enumerate(group_names):
+        idx = np.flatnonzero(np.isin(parameter_names, list(groups[name])))
+        rows.append(idx)
+        cols.append(np.full(len(idx), j))
+    rows, cols = np.concatenate(rows).astype(int), np.concatenate(cols).astype(int)
+    S = scipy.sparse.csc_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(parameter_names), len(group_names)))
+    return group_names, S
+
+
+def unpack_model_of_groups(M_vector, parameter_names, groups):
+    """
+    Model vectors for several groups of parameters at once, the columns of diag(M_vector) @ S.
+    Each column equals unpack_model_of_target_param(M_vector, parameter_names, groups[name]).
+
+    :param M_vector: 1D array of numbers, model parameter values
+    :param parameter_names: list of parameters names for each model parameter
+    :param groups: dictionary of group name -> list of parameter names in that group
+    :returns: list of group names, and array of shape (n_params, n_groups)
+    """
+    group_names, S = build_group_selector(parameter_names, groups)
+    M_groups = (scipy.sparse.diags(np.asarray(M_vector, dtype=float)) @ S).toarray()
+    return group_names, M_groups
+
+
+def forward_group_contributions(G, M_vector, parameter_names, groups):
+    """
+    Forward prediction of each group of parameters, all from a single G @ (diag(m) @ S) product.
+
+    :param G: G matrix, dense or sparse, shape (n_rows, n_params)
+    :param M_vector: 1D array of numbers, model parameter values
+    :param parameter_names: list of parameters names for each model parameter
+    :param groups: dictionary of group name -> list of parameter names in that group
+    :returns: dictionary of group name -> prediction vector of length n_rows
+    """
+    group_names, M_groups = unpack_model_of_groups(M_vector, parameter_names, groups)
+    preds = np.asarray(G.dot(M_groups))
+    return {name: preds[:, j] for j, name in enumerate(group_names)}
+
+
+def forward_disp_points_group_predictions(G, M_vector, sigmas, paired_obs, parameter_names, groups,
+                                          row_index_table=None):
+    """
+    Forward predictions as disp_points for each group of parameters, with one matrix multiply.
+
+    :param groups: dictionary of group name -> list of parameter names in that group
+    :returns: dictionary of group name -> list of disp_points
+    """
+    group_names, M_groups = unpack_model_of_groups(M_vector, parameter_names, groups)
+    group_preds = forward_disp_points_predictions_batch(G, M_groups, sigmas, paired_obs, row_index_table)
+    return dict(zip(group_names, group_preds))
+
+
+def get_param_names(gf_elements):
+    """Parameter names for a list of GfElements or a GfMatrix."""
+    if hasattr(gf_elements, 'param_names'):
+        return list(gf_elements.param_names)
+    return [x.param_name for x in gf_elements]
+
+
+def get_slip_penalties(gf_elements):
+    """Slip penalties for a list of GfElements or a GfMatrix, as an array."""
+    if hasattr(gf_elements, 'slip_penalties'):
+        return np.array(gf_elements.slip_penalties, dtype=float)
+    return np.array([x.slip_penalty for x in gf_elements], dtype=float)
+
+
+def get_fault_patches(gf_elements):
+    """The first fault object of each GfElement (or each column of a GfMatrix), used for distances between patches."""
+    if hasattr(gf_elements, 'fault_patches'):
+        return gf_elements.fault_patches
+    return [x.fault_dict_list[0] if len(x.fault_dict_list) > 0 else None for x in gf_elements]
+
+
+def get_bounds(gf_elements):
+    """Lower and upper bounds for a list of GfElements or a GfMatrix, as two arrays."""
+    if hasattr(gf_elements, 'lower_bounds'):
+        return np.array(gf_elements.lower_bounds, dtype=float), np.array(gf_elements.upper_bounds, dtype=float)
+    lb = np.array([x.lower_bound for x in gf_elements], dtype=float)
+    ub = np.array([x.upper_bound for x in gf_elements], dtype=float)
+    return lb, ub
+
+
+def get_smoothing_critical_distance(fault_patches, smoothing_idx, lengthscale):
+    """
+    Get critical distance, a typical small distance between neighboring fault patches, plus some wiggle room.
+    Operates on the first patch that it finds.
+
+    :param fault_patches: list of fault objects, one per model parameter
+    :param smoothing_idx: indices of the model parameters that are being smoothed
+    :param lengthscale: distance over which fault elements are smooth (i.e., correlated)
+    """
+    first = fault_patches[smoothing_idx[0]]
+    distances = [first.get_fault_element_distance(fault_patches[j]) for j in smoothing_idx[1:]]
+    return sorted(distances)[2] + lengthscale  # smooth adjacent patches with some wiggle room
+
+
+def find_neighboring_patches(fault_patches, smoothing_idx, critical_distance, distance_3d=True, num_pivots=4):
+    """
+    Find all ordered pairs (i, j) of patches closer than critical_distance, without testing every pair.
+    Each patch is embedded by its distances to a few pivot patches. By the triangle inequality, two patches closer
+    than critical_distance are also closer than critical_distance in the embedding (Chebyshev norm), so a KD-tree
+    over the embedding returns a small superset of candidates that is then checked with the exact distance.
+    The pivots are chosen by farthest-point sampling.
+
+    :param fault_patches: list of fault objects, one per model parameter
+    :param smoothing_idx: indices of the model parameters that are being smoothed
+    :param critical_distance: float, patches closer than this are neighbors
+    :param distance_3d: bool, do you compute distance between fault patches in 3d way, YES or NO?
+    :param num_pivots: int, number of pivot patches for the embedding
+    :returns: two arrays of model parameter indices (rows, cols), for each neighboring pair
+    """
+    smoothing_idx = np.asarray(smoothing_idx, dtype=int)
+    patches = [fault_patches[i] for i in smoothing_idx]
+
+    def distances_from(pivot):
+        return np.array([pivot.get_fault_element_distance(x, threedimensional=distance_3d) for x in patches])
+
+    embedding = [distances_from(patches[0])]
+    for _k in range(1, min(num_pivots, len(patches))):
+        next_pivot = int(np.argmax(np.min(embedding, axis=0)))  # farthest from all pivots so far
+        embedding.append(distances_from(patches[next_pivot]))
+    embedding = np.array(embedding).T  # (n_smoothing, num_pivots)
+
+    tree = scipy.spatial.cKDTree(embedding)
+    candidate_pairs = tree.query_pairs(r=critical_distance, p=np.inf, output_type='ndarray')
+    rows, cols = [], []
+    for a, b in candidate_pairs:
+        for i, j in ((a, b), (b, a)):
+            if patches[i].get_fault_element_distance(patches[j], threedimensional=distance_3d) < critical_distance:
+                rows.append(smoothing_idx[i])
+                cols.append(smoothing_idx[j])
+    return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+
+def build_smoothing_matrix(gf_elements, param_name_list, lengthscale, distance_3d=True, laplacian_operator=-1/4):
+    """
+    Sparse Laplacian smoothing matrix with one row and one column for each model parameter (not yet scaled by
+    the smoothing strength). Any gf_element that has param_name will have its immediate neighbors subtracted.
+    Assumes similar-sized patches throughout the slip distribution.
+
+    :param gf_elements: list of gf_element objects, or a GfMatrix
+    :param param_name_list: which fault elements are we smoothing, tuple of strings
+    :param lengthscale: distance over which fault elements are smooth (i.e., correlated)
+    :param distance_3d: bool, do you compute distance between fault patches in 3d way, YES or NO?
+    :param laplacian_operator: how strong do you smooth the neighbor? -1/4 (compared to 1 for base element) is default.
+    :returns: scipy.sparse.csr_matrix, n_params x n_params
+    """
+    param_names = get_param_names(gf_elements)
+    n_params = len(param_names)
+    smoothing_idx = [i for i in range(n_params) if param_names[i] in param_name_list]
+    if len(smoothing_idx) == 0:
+        return scipy.sparse.csr_matrix((n_params, n_params))
+    fault_patches = get_fault_patches(gf_elements)
+    critical_distance = get_smoothing_critical_distance(fault_patches, smoothing_idx, lengthscale)
+    rows, cols = find_neighboring_patches(fault_patches, smoothing_idx, critical_distance, distance_3d=distance_3d)
+    all_rows = np.concatenate((smoothing_idx, rows))
+    all_cols = np.concatenate((smoothing_idx, cols))
+    values = np.concatenate((np.ones((len(smoothing_idx),)), laplacian_operator * np.ones((len(rows),))))
+    return scipy.sparse.coo_matrix((values, (all_rows, all_cols)), shape=(n_params, n_params)).tocsr()
+
+
+def build_slip_penalty_matrix(gf_elements):
+    """
+    Sparse diagonal minimum-norm matrix, with each element's slip_penalty along the diagonal where it is positive
+    (not yet scaled by the overall penalty strength).
+
+    :param gf_elements: list of gf_element objects, or a GfMatrix
+    :returns: scipy.sparse.csr_matrix, n_params x n_params
+    """
+    slip_penalties = get_slip_penalties(gf_elements)
+    return scipy.sparse.diags(np.where(slip_penalties > 0, slip_penalties, 0), format='csr')
+
+
+def stack_regularization(G, G_reg):
+    """Append regularization rows beneath G, keeping G sparse if it is sparse and dense if it is dense."""
+    if scipy.sparse.issparse(G):
+        return scipy.sparse.vstack((G, G_reg), format='csr')
+    return np.vstack((G, G_reg.toarray()))
+
+
 def build_smoothing(gf_elements, param_name_list, strength, lengthscale, G, obs, sigmas, distance_3d=True,
-                    laplacian_operator=-1/4):
+                    laplacian_operator=-1/4, row_ranges=None):
     """
     Make a weighted connectivity matrix that has the same number of columns as G, that can be appended to the bottom.
     Any gf_element that has param_name will have its immediate neighbors subtracted for smoothing.
@@ -201,103 +546,92 @@ def build_smoothing(gf_elements, param_name_list, strength, lengthscale, G, obs,
     :param param_name_list: which fault elements are we smoothing, tuple of strings
     :param strength: lambda parameter in smoothing equation
     :param lengthscale: distance over which fault elements are smooth (i.e., correlated)
-    :param G: already existing G matrix
+    :param G: already existing G matrix (dense or scipy.sparse)
     :param obs: already existing obs vector
     :param sigmas: already existing sigma vector
     :param distance_3d: bool, do you compute distance between fault patches in 3d way, YES or NO?
     :param laplacian_operator: how strong do you smooth the neighbor? -1/4 (compared to 1 for base element) is default.
+    :param row_ranges: optional list. If given, ('smoothing', start, stop) is appended for the new rows
     """
     print("G and obs before smoothing:", np.shape(G), np.shape(obs))
     if strength == 0:
         print("No change, smoothing set to 0")
         return G, obs, sigmas   # returning unaltered G if there is no smoothing
 
-    G_smoothing = np.zeros((len(gf_elements), len(gf_elements)))
-
-    # Get critical distance, a typical small distance between neighboring fault patches.
-    # Operates on the first patch that it finds.
-    distances = []
-    for i in range(len(gf_elements)):
-        if gf_elements[i].param_name in param_name_list:
-            for j in range(i+1, len(gf_elements)):
-                if gf_elements[j].param_name in param_name_list:
-                    distances.append(gf_elements[i].fault_dict_list[0].get_fault_element_distance(
-                        gf_elements[j].fault_dict_list[0]))
-            break
-    critical_distance = sorted(distances)[2] + lengthscale  # smooth adjacent patches with some wiggle room
-
-    # Build the parts of the matrix for smoothing
-    for i in range(len(gf_elements)):
-        if gf_elements[i].param_name in param_name_list:
-            G_smoothing[i][i] = 1
-            for j in range(len(gf_elements)):
-                if gf_elements[j].param_name in param_name_list:
-                    if i != j and gf_elements[i].fault_dict_list[0].get_fault_element_distance(
-                            gf_elements[j].fault_dict_list[0], threedimensional=distance_3d) < critical_distance:
-                        G_smoothing[i][j] = laplacian_operator
-
+    G_smoothing = build_smoothing_matrix(gf_elements, param_name_list, lengthscale, distance_3d=distance_3d,
+                                         laplacian_operator=laplacian_operator)
     G_smoothing = G_smoothing * strength  # multiplying by lambda factor
 
     # observation vector of zeros
-    zero_vector = np.zeros((len(gf_elements),))
+    zero_vector = np.zeros((G_smoothing.shape[0],))
 
-    G_smoothing = np.vstack((G, G_smoothing))    # appending smoothing matrix
+    record_row_range(row_ranges, 'smoothing', G.shape[0], G_smoothing.shape[0])
+    G_smoothing = stack_regularization(G, G_smoothing)    # appending smoothing matrix
     smoothed_obs = np.concatenate((obs, zero_vector))   # appending smoothing components to data
     smoothed_sigmas = np.concatenate((sigmas, zero_vector))  # appending smoothing components to sigmas
     print("G and obs after smoothing:", np.shape(G_smoothing), np.shape(smoothed_obs))
     return G_smoothing, smoothed_obs, smoothed_sigmas
 
 
-def build_slip_penalty(gf_elements, penalty, G, obs, sigmas):
+def build_slip_penalty(gf_elements, penalty, G, obs, sigmas, row_ranges=None):
     """
     Minimum-norm smoothing constraint.
     Build a square diagonal matrix to go at the bottom of G, with 1's along the elements that will be slip-penalized.
     Zeros along obs and sigmas.
     Overwrites old G, obs, and sigma variables.
+    If a row_ranges list is given, ('slip_penalty', start, stop) is appended for the new rows.
     """
     print("G and obs before slip penalty:", np.shape(G), np.shape(obs))
     if penalty == 0:
         print("No change, slip penalty set to 0")
         return G, obs, sigmas   # returning unaltered G if there is no smoothing
 
-    G_penalty = np.zeros((len(gf_elements), len(gf_elements)))
-    for i in range(len(gf_elements)):
-        if gf_elements[i].slip_penalty > 0:
-            G_penalty[i][i] = gf_elements[i].slip_penalty
-
+    G_penalty = build_slip_penalty_matrix(gf_elements)
     G_penalty = G_penalty * penalty  # multiplying by lambda factor
 
     # observation vector of zeros
-    zero_vector = np.zeros((len(gf_elements),))
+    zero_vector = np.zeros((G_penalty.shape[0],))
 
-    G_penalty = np.vstack((G, G_penalty))    # appending smoothing matrix
+    record_row_range(row_ranges, 'slip_penalty', G.shape[0], G_penalty.shape[0])
+    G_penalty = stack_regularization(G, G_penalty)    # appending smoothing matrix
     smoothed_obs = np.concatenate((obs, zero_vector))   # appending smoothing components to data
     smoothed_sigmas = np.concatenate((sigmas, zero_vector))  # appending smoothing components to sigmas
     print("G and obs after penalty:", np.shape(G_penalty), np.shape(smoothed_obs))
     return G_penalty, smoothed_obs, smoothed_sigmas
 
 
-def filter_out_smoothing_lines(pred_vector, obs_vector, sigma_vector, tol=1e-9):
+def record_row_range(row_ranges, label, n_existing_rows, n_new_rows):
+    """Note that rows [n_existing_rows, n_existing_rows + n_new_rows) of G hold the regularization called label."""
+    if row_ranges is not None:
+        row_ranges.append((label, n_existing_rows, n_existing_rows + n_new_rows))
+    return row_ranges
+
+
+def get_data_row_mask(n_rows, row_ranges):
+    """Boolean mask over the rows of G, True for data rows and False for recorded regularization rows."""
+    data_rows = np.ones(n_rows, dtype=bool)
+    for _label, start, stop in row_ranges:
+        data_rows[start:stop] = False
+    return data_rows
+
+
+def filter_out_smoothing_lines(pred_vector, obs_vector, sigma_vector, row_ranges):
     """
     Remove lines of zeros automatically added to obs/sigma vectors for smoothing and slip penalty parameters.
     All inputs are expected to be vectors with the same length.
+    Exactly the regularization rows recorded by build_smoothing/build_slip_penalty or
+    solvers.stack_regularized_system are removed, so a real data row that happens to be zero is kept.
 
     :param pred_vector: array, in m
     :param obs_vector: array, in m
     :param sigma_vector: array, in m
-    :param tol: optional, 1e-9
+    :param row_ranges: list of (label, start, stop) for each block of regularization rows
     """
-    new_pred_vector, new_obs_vector, new_sigma_vector = [], [], []
-    for i in range(len(pred_vector)):
-        if abs(pred_vector[i]) < tol and abs(obs_vector[i]) < tol and abs(sigma_vector[i]) < tol:
-            continue
-        else:
-            new_pred_vector.append(pred_vector[i])
-            new_obs_vector.append(obs_vector[i])
-            new_sigma_vector.append(sigma_vector[i])
+    pred_vector, obs_vector, sigma_vector = np.asarray(pred_vector), np.asarray(obs_vector), np.asarray(sigma_vector)
+    keep = get_data_row_mask(len(pred_vector), row_ranges)
     print("During RMS calc., filter vectors from %d to %d for "
-          "smoothing and penalty" % (len(pred_vector), len(new_pred_vector)))
-    return new_pred_vector, new_obs_vector, new_sigma_vector
+          "smoothing and penalty" % (len(pred_vector), np.sum(keep)))
+    return pred_vector[keep], obs_vector[keep], sigma_vector[keep]
 
 
 def write_fault_traces(M_vector, paired_gf_elements, outfile, ignore_faults=()):
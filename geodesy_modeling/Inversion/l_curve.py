@@ -3,14 +3,17 @@ import glob
 import json
 import os
 import numpy as np
-from . import l_curve_plots
+import scipy.linalg
+from . import l_curve_plots, solvers
 
 
 def glob_and_drive_1d_lcurve(target_dir='.', name_of_printed_config="configs_used.txt", paramname='smoothing',
                              name_of_results_file="model_results_human.txt", misfitname="RMS",
-                             outname="smoothing_curve.png", xlabel="Smoothing", corner_point=None):
+                             outname="smoothing_curve.png", xlabel="Smoothing", corner_point=None,
+                             sweep_results=None):
     """
     Get every smoothing parameter in a directory where smoothing experiment has been run multiple times.
+    If sweep_results from regularization_sweep() are given, use those in-memory curve points instead of globbing.
 
     :param target_dir: directory name
     :param name_of_printed_config: file name
@@ -20,16 +23,166 @@ def glob_and_drive_1d_lcurve(target_dir='.', name_of_printed_config="configs_use
     :param outname: string
     :param xlabel: string
     :param corner_point: float, optional x-location where an annotation will be drawn
+    :param sweep_results: optional dictionary returned by regularization_sweep()
     """
-    config_files = glob.glob(target_dir+"/**/"+name_of_printed_config)
-    results_files = glob.glob(target_dir + "/**/" + name_of_results_file)
-    smoothings = read_param_from_list_of_config_files(config_files, paramname)
-    misfits = read_misfits_from_list_of_files(results_files, misfitname)
+    if sweep_results is not None:
+        smoothings, misfits = sweep_results["lambdas"], sweep_results["misfit_norms"]
+        if corner_point is None:
+            corner_point = sweep_results["corner_lambda"]
+    else:
+        config_files = glob.glob(target_dir+"/**/"+name_of_printed_config)
+        results_files = glob.glob(target_dir + "/**/" + name_of_results_file)
+        smoothings = read_param_from_list_of_config_files(config_files, paramname)
+        misfits = read_misfits_from_list_of_files(results_files, misfitname)
     l_curve_plots.plot_1d_curve(smoothings, misfits, xlabel, outname, corner_point)
     l_curve_plots.write_1d_curve(smoothings, misfits, target_dir+"/lcurve_points.txt")
     return
 
 
+def regularization_sweep(G, d, L=None, lambdas=None, n_lambdas=200, method='auto', rank=None,
+                         size_threshold=2000, seed=0):
+    """
+    Evaluate a Tikhonov L-curve in memory: min ||Gm - d||^2 + lambda^2 ||Lm||^2 over a dense grid of lambda.
+    One decomposition is computed up front, and every lambda afterward is a set of filter factors.
+    With L, this is the generalized eigendecomposition of (G^T G, L^T L), equivalent to the GSVD of (G, L).
+    Without L, it is the SVD of G. For large G, the model is restricted to the leading right singular vectors
+    from a randomized SVD. Lambda plays the role of the smoothing penalty that multiplies L in the stacked G matrix.
+    Bounds are not applied, so this is for choosing lambda, not for the final inversion.
+
+    :param G: weighted Green's matrix, dense array or scipy.sparse matrix, shape (n, p)
+    :param d: weighted data vector, length n
+    :param L: optional regularization matrix, shape (k, p), dense or sparse. Default is the identity (minimum norm)
+    :param lambdas: optional grid of regularization parameters
+    :param n_lambdas: number of log-spaced lambdas in the default grid, which spans the spectrum of the problem
+    :param method: 'auto', 'exact', or 'randomized'
+    :param rank: number of singular vectors kept in the randomized method
+    :param size_threshold: 'auto' uses the randomized method when the number of model parameters exceeds this
+    :param seed: seed for the randomized SVD
+    :returns: dictionary with lambdas, misfit_norms, model_norms, gcv, corner_lambda, gcv_lambda, and method
+    """
+    d = np.asarray(d, dtype=float)
+    n, p = np.shape(G)
+    if method == 'auto':
+        method = 'randomized' if p > size_threshold else 'exact'
+    if method not in ('exact', 'randomized'):
+        raise ValueError("Error! Unrecognized regularization sweep method %s." % method)
+
+    # Express the problem as m = basis @ y, with A = basis^T G^T G basis, b = basis^T G^T d, B = basis^T L^T L basis
+    if method == 'randomized':
+        rank = rank if rank is not None else min(size_threshold, n, p)
+        U, s, Vt = solvers.randomized_svd(G, rank, seed=seed)
+        basis, G_basis = Vt.T, U * s
+    elif L is None:
+        U, s, Vt = np.linalg.svd(solvers._dense(G), full_matrices=False)
+        basis, G_basis = Vt.T, U * s
+    else:
+        basis, G_basis = None, solvers._dense(G)
+    A, b = G_basis.T.dot(G_basis), G_basis.T.dot(d)
+    if L is None:
+        B = np.eye(len(b))
+    else:
+        LB = solvers._dense(L.dot(basis) if basis is not None else L)
+        B = LB.T.dot(LB)
+
+    # Pencil (scale*B, A + scale*B) stays well-conditioned even though L^T L and G^T G are often singular.
+    # With W^T C W = I and W^T (scale*B) W = diag(nu), A + lambda^2 B = W^-T diag(1 - nu + nu*lambda^2/scale) W^-1.
+    scale = np.trace(A) / max(np.trace(B), np.finfo(float).tiny)
+    C = A + scale * B
+    C = C + 1e-12 * np.trace(C) / len(C) * np.eye(len(C))
+    nu, W = scipy.linalg.eigh(scale * B, C)
+    nu = np.clip(nu, 0, 1)
+    c = W.T.dot(b)
+
+    if lambdas is None:  # span the generalized singular values of (G, L)
+        inner = (nu > 1e-12) & (nu < 1 - 1e-12)
+        gammas = np.sqrt(scale * (1 - nu[inner]) / nu[inner])
+        lambdas = np.logspace(np.log10(np.min(gammas)), np.log10(np.max(gammas)), n_lambdas)
+    lambdas = np.asarray(lambdas, dtype=float)
+
+    denominators = (1 - nu)[:, None] + nu[:, None] * lambdas[None, :]**2 / scale  # shape (dim, n_lambdas)
+    Z = c[:, None] / denominators
+    residuals = G_basis.dot(W.dot(Z)) - d[:, None]
+    misfit_norms = np.linalg.norm(residuals, axis=0)
+    model_norms = np.sqrt(np.sum(nu[:, None] * Z**2, axis=0) / scale)
+    trace_H = np.sum((1 - nu)[:, None] / denominators, axis=0)
+    gcv = n * misfit_norms**2 / np.clip(n - trace_H, np.finfo(float).eps, None)**2
+
+    corner_idx = find_lcurve_corner(lambdas, misfit_norms, model_norms)
+    return {"lambdas": lambdas, "misfit_norms": misfit_norms, "model_norms": model_norms, "gcv": gcv,
+            "corner_lambda": lambdas[corner_idx], "gcv_lambda": lambdas[np.argmin(gcv)], "method": method}
+
+
+def bounded_regularization_sweep(G, d, L, lambdas, lb=None, ub=None, P=None, alpha=0, max_iter=1500):
+    """
+    L-curve of the bounded inversion, min ||Gm - d||^2 + lambda^2 ||Lm||^2 + alpha^2 ||Pm||^2 with lb <= m <= ub,
+    over a grid of smoothing strengths lambda and a fixed slip penalty alpha.
+    The normal-equation products are formed once (solvers.NormalEquationsSolver). Each lambda is then one Cholesky
+    factorization, plus a BVLS solve with only n_params rows where the bounds are active.
+
+    :param G: weighted Green's matrix, dense array or scipy.sparse matrix, shape (n, p)
+    :param d: weighted data vector, length n
+    :param L: smoothing matrix, unscaled, shape (k, p), dense or sparse
+    :param lambdas: grid of smoothing strengths
+    :param lb: optional lower bounds
+    :param ub: optional upper bounds
+    :param P: optional slip-penalty matrix, unscaled. Default is the identity
+    :param alpha: slip-penalty strength, fixed across the sweep
+    :param max_iter: maximum number of iterations for each bounded solve
+    :returns: dictionary with lambdas, misfit_norms, model_norms, models, corner_lambda, gcv, gcv_lambda, and method.
+        GCV is not defined for the bounded problem, so gcv is NaN.
+    """
+    lambdas = np.sort(np.asarray(lambdas, dtype=float))
+    solver = solvers.NormalEquationsSolver(G, d, L=L, P=P, lb=lb, ub=ub)
+    responses = solver.solve_many([(lam, alpha) for lam in lambdas], max_iter=max_iter, verbose=False)
+    models = np.array([response.x for response in responses])
+    misfit_norms = np.array([np.linalg.norm(response.fun) for response in responses])
+    model_norms = np.array([np.linalg.norm(L.dot(m)) for m in models])
+    if len(lambdas) >= 3 and lambdas[0] > 0:
+        corner_lambda = lambdas[find_lcurve_corner(lambdas, misfit_norms, model_norms)]
+    else:
+        corner_lambda = np.nan
+    print("Bounded L-curve: %d of %d smoothing values had active bounds" %
+          (sum(response.bounds_active for response in responses), len(lambdas)))
+    return {"lambdas": lambdas, "misfit_norms": misfit_norms, "model_norms": model_norms, "models": models,
+            "corner_lambda": corner_lambda, "gcv": np.full(np.shape(lambdas), np.nan), "gcv_lambda": np.nan,
+            "method": "bounded"}
+
+
+def find_lcurve_corner(lambdas, misfit_norms, model_norms):
+    """
+    Find the corner of an L-curve as the point of maximum curvature of (log misfit, log model norm),
+    parameterized by log lambda.
+
+    :param lambdas: 1d array, increasing
+    :param misfit_norms: 1d array
+    :param model_norms: 1d array
+    :returns: integer index of the corner
+    """
+    if len(lambdas) < 3:
+        raise ValueError("Error! Need at least three points to find the corner of an L-curve.")
+    t = np.log(lambdas)
+    x = np.log(np.clip(misfit_norms, np.finfo(float).tiny, None))
+    y = np.log(np.clip(model_norms, np.finfo(float).tiny, None))
+    dx, dy = np.gradient(x, t), np.gradient(y, t)
+    ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+    curvature = (dx * ddy - ddx * dy) / np.clip((dx**2 + dy**2)**1.5, np.finfo(float).tiny, None)
+    curvature[[0, -1]] = -np.inf  # one-sided differences at the ends are unreliable
+    return int(np.argmax(curvature))
+
+
+def write_regularization_sweep(sweep_results, filename):
+    """Write the in-memory L-curve and GCV values, in case you'd like to have them later."""
+    print("Writing file %s " % filename)
+    with open(filename, 'w') as ofile:
+        ofile.write("# lambda, misfit_norm, model_norm, gcv\n")
+        ofile.write("# corner lambda: %f, gcv lambda: %f \n" % (sweep_results["corner_lambda"],
+                                                                sweep_results["gcv_lambda"]))
+        for lam, misfit, norm, gcv in zip(sweep_results["lambdas"], sweep_results["misfit_norms"],
+                                          sweep_results["model_norms"], sweep_results["gcv"]):
+            ofile.write("%f %f %f %f \n" % (lam, misfit, norm, gcv))
+    return
+
+
 def collect_curve_points_slippy(top_level_dir, config_file_name, results_file_name, misfitname):
     """ Harvest parameter values and misfit values from a bunch of l-curve directories. """
     other_dirs = glob.glob(top_level_dir+"/*")
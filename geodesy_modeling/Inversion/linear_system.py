@@ -0,0 +1,197 @@
+import numpy as np
+import scipy.sparse
+from . import inversion_tools
+
+
+class LinearSystem:
+    """
+    The assembled Green's matrix, observation vector, and sigmas of an inversion, along with the provenance of
+    every row: which observation point (station) and which component (0=E, 1=N, 2=U) it came from.
+    Filtering observations only changes an index array into the assembled rows, so an experiment that drops a region
+    or a station type reuses G instead of re-pairing and rebuilding it. Appending keeps G as a list of row blocks,
+    so the existing G is never copied; only the 1d per-row arrays (obs, sigmas, provenance) are concatenated.
+    Each access to the G property gathers the active rows from the blocks into a new array, so read it once per use.
+    Active rows are kept grouped by station, in station order, matching get_paired_obs().
+
+    :param G: assembled Green's matrix, dense array or scipy.sparse matrix, shape (n_rows, n_params),
+        or a list of such matrices stacked by rows
+    :type G: np.array
+    :param obs: observation vector, length n_rows
+    :type obs: np.array
+    :param sigmas: uncertainty vector, length n_rows
+    :type sigmas: np.array
+    :param row_station: index into obs_disp_points for each row
+    :type row_station: np.array of ints, length n_rows
+    :param row_component: component (0=E, 1=N, 2=U) for each row
+    :type row_component: np.array of ints, length n_rows
+    :param obs_disp_points: all observation points that were used to assemble G
+    :type obs_disp_points: list of Displacement_points
+    :param param_names: optional name of each model parameter (column)
+    :type param_names: list of strings
+    :param active_rows: optional indices of the assembled rows that are currently in use. Default is all rows
+    :type active_rows: np.array of ints
+    """
+
+    def __init__(self, G, obs, sigmas, row_station, row_component, obs_disp_points, param_names=None,
+                 active_rows=None):
+        self.G_blocks = list(G) if isinstance(G, list) else [G]
+        self.block_starts = np.cumsum([0] + [x.shape[0] for x in self.G_blocks])
+        self.obs_all = np.asarray(obs, dtype=float)
+        self.sigmas_all = np.asarray(sigmas, dtype=float)
+        self.row_station_all = np.asarray(row_station, dtype=int)
+        self.row_component_all = np.asarray(row_component, dtype=int)
+        self.obs_disp_points = obs_disp_points
+        self.param_names = list(param_names) if param_names is not None else ['' for _i in range(self.n_params)]
+        self.active_rows = np.arange(len(self.obs_all)) if active_rows is None else np.asarray(active_rows, dtype=int)
+        self.lons, self.lats = inversion_tools.get_disp_points_coords(obs_disp_points)
+        self.meas_types = np.array([x.meas_type for x in obs_disp_points], dtype=object)
+
+    @property
+    def n_params(self):
+        return self.G_blocks[0].shape[1]
+
+    @property
+    def G_all(self):
+        """All assembled rows as one matrix. Stacks the blocks the first time, if there are several."""
+        if len(self.G_blocks) > 1:
+            self.G_blocks = [_stack_rows(self.G_blocks)]
+            self.block_starts = np.array([0, self.G_blocks[0].shape[0]])
+        return self.G_blocks[0]
+
+    @property
+    def G(self):
+        """The active rows of G, gathered block by block without stacking all the assembled rows."""
+        if len(self.G_blocks) == 1:
+            return self.G_blocks[0][self.active_rows]
+        block_idx = np.searchsorted(self.block_starts, self.active_rows, side='right') - 1
+        order = np.argsort(block_idx, kind='stable')
+        pieces = [self.G_blocks[b][self.active_rows[order][block_idx[order] == b] - self.block_starts[b]]
+                  for b in np.unique(block_idx)]
+        G_active = _stack_rows(pieces) if len(pieces) > 0 else self.G_blocks[0][:0]
+        return G_active[np.argsort(order)] if np.any(np.diff(order) < 0) else G_active
+
+    @property
+    def obs(self):
+        return self.obs_all[self.active_rows]
+
+    @property
+    def sigmas(self):
+        return self.sigmas_all[self.active_rows]
+
+    @property
+    def row_station(self):
+        return self.row_station_all[self.active_rows]
+
+    @property
+    def row_component(self):
+        return self.row_component_all[self.active_rows]
+
+    @property
+    def n_rows(self):
+        return len(self.active_rows)
+
+    def _with_active_rows(self, active_rows):
+        return LinearSystem(self.G_blocks, self.obs_all, self.sigmas_all, self.row_station_all,
+                            self.row_component_all, self.obs_disp_points, self.param_names, active_rows)
+
+    def select_rows(self, selection):
+        """
+        Keep only some of the active rows, without touching G.
+
+        :param selection: boolean mask or integer indices over the active rows
+        """
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            return self._with_active_rows(self.active_rows[selection])
+        return self._with_active_rows(self.active_rows[np.sort(selection.astype(int))])
+
+    def select_stations(self, station_mask):
+        """
+        Keep only the rows that come from some of the observation points.
+
+        :param station_mask: boolean array over all obs_disp_points
+        """
+        station_mask = np.asarray(station_mask, dtype=bool)
+        if len(station_mask) != len(self.obs_disp_points):
+            raise ValueError("Error! Station mask has length %d, expected %d." % (len(station_mask),
+                                                                                 len(self.obs_disp_points)))
+        return self._with_active_rows(self.active_rows[station_mask[self.row_station]])
+
+    def select_kept_stations(self, kept_disp_points):
+        """
+        Keep only the stations that survived a filter on disp_points, such as the dpo.utilities filters.
+        Stations are matched by lon, lat, name, and meas_type.
+
+        :param kept_disp_points: list of disp_points, a subset of get_paired_obs()
+        """
+        kept_keys = set(_station_key(x) for x in kept_disp_points)
+        return self.select_stations([_station_key(x) in kept_keys for x in self.obs_disp_points])
+
+    def filter_to_meas_type(self, meas_type):
+        return self.select_stations(self.meas_types == meas_type)
+
+    def select_params(self, selection):
+        """Return a new LinearSystem with only some of the model parameters (columns)."""
+        idx = np.flatnonzero(selection) if np.asarray(selection).dtype == bool else np.asarray(selection, dtype=int)
+        return LinearSystem([x[:, idx] for x in self.G_blocks], self.obs_all, self.sigmas_all, self.row_station_all,
+                            self.row_component_all, self.obs_disp_points, [self.param_names[i] for i in idx],
+                            self.active_rows)
+
+    def append(self, other):
+        """
+        Append the active rows of another LinearSystem with the same model parameters, e.g. a newly added dataset.
+        The other system's stations are numbered after this system's stations.
+        The G blocks of both systems are shared, not copied.
+        """
+        if self.n_params != other.n_params:
+            raise ValueError("Error! Cannot append a system with %d parameters to one with %d." %
+                             (other.n_params, self.n_params))
+        return LinearSystem(self.G_blocks + other.G_blocks, np.concatenate((self.obs_all, other.obs_all)),
+                            np.concatenate((self.sigmas_all, other.sigmas_all)),
+                            np.concatenate((self.row_station_all, other.row_station_all + len(self.obs_disp_points))),
+                            np.concatenate((self.row_component_all, other.row_component_all)),
+                            self.obs_disp_points + other.obs_disp_points, self.param_names,
+                            np.concatenate((self.active_rows, other.active_rows + len(self.obs_all))))
+
+    def get_active_stations(self):
+        """Indices into obs_disp_points of the stations with at least one active row, in station order."""
+        return np.unique(self.row_station)
+
+    def get_row_index_table(self):
+        """
+        Lookup table from each active station (in get_paired_obs order) and component to its row in G.
+
+        :returns: integer array, shape (n_active_stations, 3). -1 where a component has no active row.
+        """
+        stations = self.get_active_stations()
+        row_index_table = np.full((len(stations), 3), -1, dtype=int)
+        row_index_table[np.searchsorted(stations, self.row_station), self.row_component] = np.arange(self.n_rows)
+        return row_index_table
+
+    def get_paired_obs(self):
+        """The observation points that still contribute rows, in the same order as the rows."""
+        return [self.obs_disp_points[i] for i in self.get_active_stations()]
+
+
+def build_linear_system(paired_obs, paired_gfs):
+    """
+    Assemble G, obs, and sigmas from paired observations and GFs, and record the provenance of each row.
+
+    :param paired_obs: list of disp_points, length n
+    :param paired_gfs: list of paired GfElement objects (one per column), or a paired GfMatrix
+    :returns: LinearSystem
+    """
+    G, obs, sigmas = inversion_tools.build_G_and_obs_vector(paired_obs, paired_gfs)
+    row_station, row_component = inversion_tools.get_row_provenance(paired_obs)
+    return LinearSystem(G, obs, sigmas, row_station, row_component, paired_obs,
+                        inversion_tools.get_param_names(paired_gfs))
+
+
+def _stack_rows(blocks):
+    if any(scipy.sparse.issparse(x) for x in blocks):
+        return scipy.sparse.vstack(blocks, format='csr')
+    return np.vstack(blocks)
+
+
+def _station_key(disp_point):
+    return disp_point.lon, disp_point.lat, disp_point.name, disp_point.meas_type
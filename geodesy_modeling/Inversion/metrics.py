@@ -1,5 +1,6 @@
 import numpy as np
 from elastic_stresses_py.PyCoulomb.disp_points_object import utilities, compute_rms
+from . import inversion_tools
 
 # The usual metrics for the whole project are done with operations on displacement point objects
 
@@ -70,3 +71,16 @@ def obs_vs_model_L2_vertical(obs_disp_points, model_disp_points):
     rms_m, reported_chi2 = compute_rms.L2_on_vector(resid_data, resid_sigma)
     rms_mm = np.multiply(rms_m, 1000)
     return rms_mm, reported_chi2
+
+
+def stacked_vectors_L2(pred_vector, obs_vector, sigma_vector, row_ranges):
+    """
+    L2 norm on the data rows of a stacked system, whose regularization rows were recorded in row_ranges by
+    solvers.stack_regularized_system or inversion_tools.build_smoothing/build_slip_penalty.
+    Only the data block is used; no per-row scan.
+    """
+    data_rows = inversion_tools.get_data_row_mask(len(obs_vector), row_ranges)
+    resid_data = np.subtract(obs_vector, pred_vector)[data_rows]
+    rms_m, reported_chi2 = compute_rms.L2_on_vector(list(resid_data), list(np.asarray(sigma_vector)[data_rows]))
+    rms_mm = np.multiply(rms_m, 1000)
+    return rms_mm, reported_chi2
@@ -0,0 +1,61 @@
+"""
+Random noise realizations for synthetic tests and Monte-Carlo runs, drawn with numpy.random.Generator.
+Whole vectors, or batches of K realizations as a K x n matrix, come from a single call.
+"""
+
+import numpy as np
+import scipy.linalg
+
+
+def get_rng(seed=None):
+    """Return a np.random.Generator. seed may be None, an int, a SeedSequence, or an existing Generator."""
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def uncorrelated_noise(sigmas, n_realizations=None, seed=None):
+    """
+    Independent Gaussian noise with a standard deviation for each element.
+
+    :param sigmas: array of standard deviations, length n
+    :param n_realizations: optional int K. If given, returns K realizations
+    :param seed: None, int, SeedSequence, or np.random.Generator
+    :returns: array of shape (n,), or (K, n)
+    """
+    sigmas = np.asarray(sigmas, dtype=float)
+    size = np.shape(sigmas) if n_realizations is None else (n_realizations,) + np.shape(sigmas)
+    return get_rng(seed).standard_normal(size) * sigmas
+
+
+class CorrelatedNoise:
+    """
+    Gaussian noise with a full covariance matrix, such as spatially correlated InSAR noise.
+    The Cholesky factor is computed on the first draw and reused for every later draw.
+
+    :param covariance: symmetric positive-definite array, shape (n, n)
+    :type covariance: np.array
+    """
+
+    def __init__(self, covariance):
+        self.covariance = np.asarray(covariance, dtype=float)
+        self.cholesky_factor = None
+
+    def get_cholesky_factor(self):
+        """Lower-triangular L with L L^T = covariance."""
+        if self.cholesky_factor is None:
+            try:
+                self.cholesky_factor = scipy.linalg.cholesky(self.covariance, lower=True)
+            except np.linalg.LinAlgError:
+                raise ValueError("Error! Covariance matrix for correlated noise is not positive definite.")
+        return self.cholesky_factor
+
+    def draw(self, n_realizations=None, seed=None):
+        """
+        :param n_realizations: optional int K. If given, returns K realizations
+        :param seed: None, int, SeedSequence, or np.random.Generator
+        :returns: array of shape (n,), or (K, n)
+        """
+        L = self.get_cholesky_factor()
+        size = (len(L),) if n_realizations is None else (n_realizations, len(L))
+        return get_rng(seed).standard_normal(size).dot(L.T)
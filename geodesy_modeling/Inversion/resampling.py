@@ -0,0 +1,265 @@
+"""
+Resampling estimates of parameter uncertainty for bounded inversions.
+Each realization perturbs the weighted data, either with Gaussian noise scaled by the data uncertainties or by
+a bootstrap resampling of the data rows, and is re-solved with bounds.
+Realizations whose solver did not converge are counted and left out of the statistics.
+Statistics are updated as realizations arrive, so memory does not grow with the number of realizations.
+"""
+
+import concurrent.futures
+import os
+import numpy as np
+import scipy.sparse
+from . import noise, solvers
+
+
+_problem = None   # the weighted system and solver settings, set once inside each worker process
+
+
+def _set_problem(problem):
+    global _problem
+    _problem = problem
+
+
+class RunningStats:
+    """
+    Streaming statistics for each model parameter: running mean and variance (Welford/Chan updates), and a
+    fixed-bin histogram for percentiles. The histogram spans [lb, ub] where a bound is finite. Where it is not,
+    the range is set from the spread of the first batch of samples; later samples outside it go in the end bins.
+    n_unconverged counts the realizations that were left out because their solver did not converge.
+
+    :param lb: lower bounds, one for each model parameter
+    :param ub: upper bounds, one for each model parameter
+    :param n_bins: number of histogram bins per parameter, which sets the resolution of the percentiles
+    """
+
+    def __init__(self, lb, ub, n_bins=1000):
+        self.lb = np.asarray(lb, dtype=float)
+        self.ub = np.asarray(ub, dtype=float)
+        self.n_bins = n_bins
+        self.count = 0
+        self.n_unconverged = 0
+        self.mean = np.zeros(np.shape(self.lb))
+        self.M2 = np.zeros(np.shape(self.lb))
+        self.bin_lo, self.bin_hi = None, None
+        self.histogram = np.zeros((len(self.lb), n_bins), dtype=np.int64)
+
+    def _set_bin_edges(self, samples):
+        lo, hi = np.min(samples, axis=0), np.max(samples, axis=0)
+        pad = np.maximum(2 * (hi - lo), 0.1 * np.maximum(np.abs(lo), np.abs(hi))) + 1e-12
+        self.bin_lo = np.where(np.isfinite(self.lb), self.lb, lo - pad)
+        self.bin_hi = np.where(np.isfinite(self.ub), self.ub, hi + pad)
+        self.bin_hi = np.where(self.bin_hi > self.bin_lo, self.bin_hi, self.bin_lo + 1e-12)
+        return
+
+    def update(self, samples):
+        """
+        :param samples: array of shape (n_samples, n_params), one model per row
+        """
+        samples = np.atleast_2d(np.asarray(samples, dtype=float))
+        if self.bin_lo is None:
+            self._set_bin_edges(samples)
+        n_batch = len(samples)
+        batch_mean = np.mean(samples, axis=0)
+        batch_M2 = np.sum((samples - batch_mean) ** 2, axis=0)
+        n_total = self.count + n_batch
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * n_batch / n_total
+        self.M2 = self.M2 + batch_M2 + delta ** 2 * self.count * n_batch / n_total
+        self.count = n_total
+
+        bins = np.floor((samples - self.bin_lo) / (self.bin_hi - self.bin_lo) * self.n_bins).astype(int)
+        bins = np.clip(bins, 0, self.n_bins - 1)
+        param_idx = np.broadcast_to(np.arange(len(self.lb)), np.shape(bins))
+        np.add.at(self.histogram, (param_idx, bins), 1)
+        return
+
+    def get_mean(self):
+        return self.mean
+
+    def get_std(self, ddof=1):
+        if self.count <= ddof:
+            return np.full(np.shape(self.mean), np.nan)
+        return np.sqrt(self.M2 / (self.count - ddof))
+
+    def get_percentiles(self, q):
+        """
+        :param q: sequence of percentiles, between 0 and 100
+        :returns: array of shape (len(q), n_params), accurate to one histogram bin
+        """
+        if self.bin_lo is None:
+            return np.full((len(np.atleast_1d(q)), len(self.lb)), np.nan)
+        cdf = np.cumsum(self.histogram, axis=1) / max(self.count, 1)
+        width = (self.bin_hi - self.bin_lo) / self.n_bins
+        results = []
+        for percentile in np.atleast_1d(q):
+            idx = np.minimum(np.sum(cdf < percentile / 100.0, axis=1), self.n_bins - 1)
+            results.append(self.bin_lo + (idx + 0.5) * width)
+        return np.array(results)
+
+
+def perturb_system(G, d, noise_sigmas, data_rows, method, rng):
+    """
+    One realization of the weighted system.
+    'noise' adds Gaussian noise with standard deviation noise_sigmas to the data rows.
+    'bootstrap' resamples the data rows with replacement. A row drawn k times is weighted by sqrt(k), which gives the
+    same least-squares problem as repeating it, so G keeps its shape. Regularization rows are never changed.
+
+    :param G: weighted G matrix, dense or sparse, including any regularization rows
+    :param d: weighted data vector, including zeros for regularization rows
+    :param noise_sigmas: standard deviation of the noise on each row of d, in weighted units
+    :param data_rows: boolean mask, True for data rows and False for regularization rows
+    :param method: 'noise' or 'bootstrap'
+    :param rng: np.random.Generator
+    :returns: G_k, d_k
+    """
+    if method == 'noise':
+        return G, d + noise.uncorrelated_noise(noise_sigmas, seed=rng)
+    if method == 'bootstrap':
+        n_data = int(np.sum(data_rows))
+        row_weights = np.ones(len(d))
+        row_weights[data_rows] = np.sqrt(rng.multinomial(n_data, np.ones(n_data) / n_data))
+        if scipy.sparse.issparse(G):
+            return scipy.sparse.diags(row_weights).dot(G).tocsr(), row_weights * d
+        return G * row_weights[:, None], row_weights * d
+    raise ValueError("Error! Unrecognized resampling method %s " % method)
+
+
+def _solve_realizations(seeds):
+    """
+    Worker: solve a batch of perturbed systems, one seed per realization.
+    Returns the models and a boolean mask of the realizations whose solver converged. A solver status of 0 (iteration
+    limit) or below (failure) is unconverged; lsq_linear reports convergence with status 1, 2, or 3.
+    """
+    problem = _problem
+    models = np.zeros((len(seeds), len(problem["m_best"])))
+    converged = np.zeros((len(seeds),), dtype=bool)
+    for k, seed_k in enumerate(seeds):
+        G_k, d_k = perturb_system(problem["G"], problem["d"], problem["noise_sigmas"], problem["data_rows"],
+                                  problem["method"], np.random.default_rng(seed_k))
+        response = solvers.bounded_least_squares(G_k, d_k, problem["lb"], problem["ub"], solver=problem["solver"],
+                                                 max_iter=problem["max_iter"], x0=problem["m_best"], verbose=False)
+        models[k] = response.x
+        converged[k] = response.status > 0
+    return models, converged
+
+
+def _update_stats(stats, models, converged):
+    """Add the converged realizations of one batch to the running statistics, and count the rest."""
+    stats.n_unconverged += int(np.sum(~converged))
+    if np.any(converged):
+        stats.update(models[converged])
+    return
+
+
+def run_resampling(G, d, lb, ub, m_best, noise_sigmas=None, data_rows=None, method='noise', n_realizations=100,
+                   solver='auto', max_iter=1500, num_workers=None, batch_size=10, seed=0, n_bins=1000):
+    """
+    Parameter uncertainties of a bounded inversion from many perturbed re-inversions, run across a process pool.
+    Every realization gets its own child of one SeedSequence, and the batches are a fixed size, with the histogram
+    range always from the first batch, so results are reproducible for a given seed regardless of the number of workers.
+    Realizations whose solver does not converge within max_iter are left out of the statistics and counted in
+    the n_unconverged of the returned RunningStats.
+
+    :param G: weighted G matrix that was solved, dense or sparse, including any regularization rows
+    :param d: weighted data vector that was solved
+    :param lb: lower bounds, one for each model parameter
+    :param ub: upper bounds, one for each model parameter
+    :param m_best: best-fitting model, the starting point of every re-inversion with the 'projected' or 'admm' solver
+    :param noise_sigmas: standard deviation of the noise on each row of d, in weighted units.
+        Default is 1 on the data rows (data weighted by their own sigmas) and 0 on regularization rows
+    :param data_rows: boolean mask, True for data rows, such as from inversion_tools.get_data_row_mask. Default all
+    :param method: 'noise' for noise realizations, or 'bootstrap' to resample the data rows
+    :param n_realizations: int
+    :param solver: any solver accepted by solvers.bounded_least_squares. Default 'auto' is BVLS or trf, which solve
+        each realization to convergence; the warm-started 'projected' solver often needs more than max_iter
+    :param max_iter: maximum number of iterations for each solve
+    :param num_workers: number of processes. Default is os.cpu_count(). 1 runs in this process
+    :param batch_size: number of realizations sent to a worker at once
+    :param seed: int, seed of the SeedSequence
+    :param n_bins: number of histogram bins for the percentiles
+    :returns: RunningStats
+    """
+    data_rows = np.ones(len(d), dtype=bool) if data_rows is None else np.asarray(data_rows, dtype=bool)
+    if noise_sigmas is None:
+        noise_sigmas = data_rows.astype(float)
+    noise_sigmas = np.where(data_rows, noise_sigmas, 0)
+    problem = {"G": G, "d": np.asarray(d, dtype=float), "lb": lb, "ub": ub, "m_best": np.asarray(m_best, dtype=float),
+               "noise_sigmas": noise_sigmas, "data_rows": data_rows, "method": method, "solver": solver,
+               "max_iter": max_iter}
+    if method not in ('noise', 'bootstrap'):
+        raise ValueError("Error! Unrecognized resampling method %s " % method)
+
+    num_workers = min(num_workers or os.cpu_count() or 1, n_realizations)
+    seeds = np.random.SeedSequence(seed).spawn(n_realizations)
+    batches = [seeds[start:start + batch_size] for start in range(0, n_realizations, batch_size)]
+    stats = RunningStats(np.broadcast_to(np.asarray(lb, dtype=float), np.shape(m_best)),
+                         np.broadcast_to(np.asarray(ub, dtype=float), np.shape(m_best)), n_bins=n_bins)
+
+    if num_workers <= 1:
+        _set_problem(problem)
+        for batch in batches:
+            _update_stats(stats, *_solve_realizations(batch))
+            print("Finished %d of %d realizations" % (stats.count + stats.n_unconverged, n_realizations))
+        _report_unconverged(stats, n_realizations)
+        return stats
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_set_problem,
+                                                initargs=(problem,)) as executor:
+        futures = {executor.submit(_solve_realizations, batch): k for k, batch in enumerate(batches)}
+        waiting = {}   # batches that finished before batch 0, which sets the histogram range
+        first_done = False
+        for future in concurrent.futures.as_completed(futures):
+            waiting[futures[future]] = future.result()
+            first_done = first_done or 0 in waiting
+            if first_done:
+                for k in sorted(waiting.keys()):
+                    _update_stats(stats, *waiting.pop(k))
+                print("Finished %d of %d realizations" % (stats.count + stats.n_unconverged, n_realizations))
+    _report_unconverged(stats, n_realizations)
+    return stats
+
+
+def _report_unconverged(stats, n_realizations):
+    if stats.n_unconverged > 0:
+        print("Warning! %d of %d realizations did not converge and were left out of the statistics. "
+              "Consider a larger max_iter or another solver." % (stats.n_unconverged, n_realizations))
+    return
+
+
+def write_uncertainty_params(stats, outfile, GF_elements, ignore_faults=(), message='', percentiles=(2.5, 97.5)):
+    """
+    Write a human-readable uncertainty file in the layout of inversion_tools.write_summary_params:
+    one line per parameter with the mean, standard deviation, and a percentile interval.
+
+    :param stats: RunningStats from run_resampling
+    :param outfile: string
+    :param GF_elements: list of GfElement objects
+    :param ignore_faults: list of strings
+    :param message: optional message about how the realizations were made
+    :param percentiles: the two percentiles of the reported interval
+    """
+    mean, std = stats.get_mean(), stats.get_std()
+    low, high = stats.get_percentiles(percentiles)
+    print("Writing %s" % outfile)
+    ofile = open(outfile, 'w')
+    for i in range(len(mean)):
+        if GF_elements[i].param_name in ignore_faults:
+            continue
+        ofile.write(GF_elements[i].param_name + ": ")
+        if GF_elements[i].units == "cm/yr":   # converting fault slip rates into mm/yr for convenience
+            units = 'mm/yr'
+            multiplier = 10
+        else:
+            units = GF_elements[i].units
+            multiplier = 1
+        ofile.write("%.5f +/- %.5f %s" % (mean[i]*multiplier, std[i]*multiplier, units))
+        ofile.write('  [%g-%g percentiles: %.3f to %.3f]' % (percentiles[0], percentiles[1], low[i]*multiplier,
+                                                              high[i]*multiplier))
+        ofile.write("\n")
+    report_string = "\nWith %d observations\n" % (len(GF_elements[0].disp_points))
+    ofile.write(report_string)
+    ofile.write("With %d realizations (%d more left out, unconverged)\n" % (stats.count, stats.n_unconverged))
+    ofile.write("Message: "+message+"\n")
+    ofile.close()
+    return
@@ -0,0 +1,131 @@
+"""
+Model resolution and posterior uncertainties of a regularized least-squares inversion (Menke, 1989),
+without forming the pseudo-inverse of G.
+The inversion solves G_ext m = d_ext, where the first num_obs rows of G_ext are weighted data and the rest are
+regularization. With P = pinv(G_ext), the resolution matrix is R = P G_data (G_data is G_ext with its regularization
+rows set to zero), and the model covariance is C = P P^T.
+The diagonals come from a thin or randomized SVD of G_ext, or from Hutchinson's stochastic diagonal estimator,
+which only needs LSQR solves with G_ext and works directly on sparse matrices.
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from . import noise, solvers
+
+
+def estimate_model_resolution(G, num_obs, method='auto', n_probes=100, rank=None, size_threshold=2000, seed=0):
+    """
+    Diagonal of the model resolution matrix and the posterior standard deviation of each model parameter.
+
+    :param G: weighted G matrix with regularization rows, dense or scipy.sparse, shape (n, p)
+    :param num_obs: number of data rows, which come before the regularization rows
+    :param method: 'auto', 'exact', 'randomized', or 'hutchinson'
+    :param n_probes: number of random probe vectors in the hutchinson method
+    :param rank: number of singular vectors kept in the randomized method
+    :param size_threshold: 'auto' uses the hutchinson method when the number of model parameters exceeds this
+    :param seed: seed for the random probes or the randomized SVD
+    :returns: diag(R), model standard deviations; arrays of length p
+    """
+    p = np.shape(G)[1]
+    if method == 'auto':
+        method = 'hutchinson' if p > size_threshold else 'exact'
+    if method == 'exact':
+        return svd_resolution(G, num_obs)
+    if method == 'randomized':
+        return svd_resolution(G, num_obs, rank=rank if rank is not None else min(size_threshold, p), seed=seed)
+    if method == 'hutchinson':
+        return hutchinson_resolution(G, num_obs, n_probes=n_probes, seed=seed)
+    raise ValueError("Error! Unrecognized model resolution method %s." % method)
+
+
+def get_pseudoinverse_svd(G, rank=None, seed=0, rcond=None):
+    """
+    Singular triplets of G that the pseudo-inverse keeps. Like scipy.linalg.pinv, singular values below
+    rcond * s_max are dropped, with rcond = max(n, p) * machine epsilon by default.
+
+    :param G: dense array or scipy.sparse matrix, shape (n, p)
+    :param rank: optional number of singular triplets from a randomized SVD. Default is the full thin SVD
+    :param seed: seed for the randomized SVD
+    :param rcond: optional relative cutoff on the singular values
+    :returns: U (n, k), s (k), Vt (k, p)
+    """
+    if rank is None or rank >= min(np.shape(G)):
+        U, s, Vt = np.linalg.svd(solvers._dense(G), full_matrices=False)
+    else:
+        U, s, Vt = solvers.randomized_svd(G, rank, seed=seed)
+    rcond = rcond if rcond is not None else max(np.shape(G)) * np.finfo(float).eps
+    keep = s > rcond * s[0]
+    return U[:, keep], s[keep], Vt[keep, :]
+
+
+def svd_resolution(G, num_obs, rank=None, seed=0):
+    """
+    diag(R) and model standard deviations from the SVD G = U S V^T, so P = V S^-1 U^T.
+    With the full thin SVD, this matches pinv exactly. A randomized SVD of a given rank gives the truncated-SVD
+    resolution and covariance, which only describe the model space that the kept singular vectors span.
+
+    :param G: weighted G matrix with regularization rows, dense or scipy.sparse, shape (n, p)
+    :param num_obs: number of data rows
+    :param rank: optional number of singular vectors, from a randomized SVD
+    :param seed: seed for the randomized SVD
+    :returns: diag(R), model standard deviations
+    """
+    U, s, Vt = get_pseudoinverse_svd(G, rank=rank, seed=seed)
+    UtG_data = np.asarray(_data_rows(G, num_obs).T.dot(U[:num_obs])).T   # U^T G_data, shape (k, p)
+    r_diag = np.einsum('ki,k,ki->i', Vt, 1.0 / s, UtG_data)
+    model_std = np.sqrt(np.sum((Vt / s[:, None]) ** 2, axis=0))
+    return r_diag, model_std
+
+
+def hutchinson_resolution(G, num_obs, n_probes=100, seed=0, atol=1e-10, btol=1e-10, iter_lim=None):
+    """
+    Hutchinson's stochastic estimates of diag(R) and diag(C), from Rademacher probe vectors z and w:
+    diag(R) = E[z * (P G_data z)] and diag(C) = E[(P w)^2]. Each product with P is one LSQR solve,
+    since LSQR started from zero converges to the minimum-norm least-squares solution, P b.
+    Memory stays at the size of G. The relative error of each element falls as 1/sqrt(n_probes).
+
+    :param G: weighted G matrix with regularization rows, dense or scipy.sparse, shape (n, p)
+    :param num_obs: number of data rows
+    :param n_probes: number of probe vectors
+    :param seed: None, int, SeedSequence, or np.random.Generator
+    :param atol: LSQR stopping tolerance
+    :param btol: LSQR stopping tolerance
+    :param iter_lim: optional maximum number of LSQR iterations for each solve
+    :returns: diag(R), model standard deviations
+    """
+    G = scipy.sparse.csr_matrix(G) if scipy.sparse.issparse(G) else np.asarray(G, dtype=float)
+    G_data = _data_rows(G, num_obs)
+    n, p = np.shape(G)
+    rng = noise.get_rng(seed)
+    r_sum, c_sum = np.zeros((p,)), np.zeros((p,))
+    for k in range(n_probes):
+        z = rng.choice([-1.0, 1.0], size=p)
+        b = np.concatenate((G_data.dot(z), np.zeros((n - num_obs,))))
+        r_sum += z * scipy.sparse.linalg.lsqr(G, b, atol=atol, btol=btol, iter_lim=iter_lim)[0]
+        w = rng.choice([-1.0, 1.0], size=n)
+        c_sum += scipy.sparse.linalg.lsqr(G, w, atol=atol, btol=btol, iter_lim=iter_lim)[0] ** 2
+        if (k + 1) % max(1, n_probes // 10) == 0:
+            print("Finished %d of %d resolution probes" % (k + 1, n_probes))
+    return r_sum / n_probes, np.sqrt(c_sum / n_probes)
+
+
+def model_resolution_matrix(G, num_obs, rank=None, seed=0):
+    """
+    The full resolution matrix R, shape (p, p). Only form it when it is really needed, such as for an image of R.
+
+    :param G: weighted G matrix with regularization rows, dense or scipy.sparse, shape (n, p)
+    :param num_obs: number of data rows
+    :param rank: optional number of singular vectors, from a randomized SVD
+    :param seed: seed for the randomized SVD
+    :returns: dense array, shape (p, p)
+    """
+    U, s, Vt = get_pseudoinverse_svd(G, rank=rank, seed=seed)
+    UtG_data = np.asarray(_data_rows(G, num_obs).T.dot(U[:num_obs])).T
+    return Vt.T.dot(UtG_data / s[:, None])
+
+
+def _data_rows(G, num_obs):
+    if scipy.sparse.issparse(G):
+        return scipy.sparse.csr_matrix(G)[:num_obs]
+    return np.asarray(G, dtype=float)[:num_obs]
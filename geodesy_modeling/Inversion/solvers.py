@@ -0,0 +1,388 @@
+"""
+Bounded least-squares solvers for the single-epoch inversions: min ||Gm - d|| subject to lb <= m <= ub.
+Small problems go to dense BVLS, which is what the drivers have always used.
+Large problems keep the regularization rows sparse and go to a sparse-capable solver.
+"""
+
+import time
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def stack_regularized_system(G, d, reg_blocks=(), sparse=True, labels=None, row_ranges=None):
+    """
+    Append regularization blocks (smoothing, slip penalty, ...) beneath the weighted data matrix.
+    Zeros are appended to the data vector for each regularization row.
+    Blocks that are all zeros, such as a smoothing block with strength 0, add no rows.
+    If a row_ranges list is given, (label, start, stop) is appended for each block that was stacked, as in
+    inversion_tools.build_smoothing, so misfits can be computed on the data rows only.
+
+    :param G: weighted data matrix, dense or scipy.sparse, n_obs x n_params
+    :param d: weighted data vector, length n_obs
+    :param reg_blocks: sequence of matrices with n_params columns, already scaled by their strength
+    :param sparse: bool, return a scipy.sparse csr matrix (True) or a dense array (False)
+    :param labels: optional name of each block in reg_blocks, such as 'smoothing'. Default 'reg0', 'reg1', ...
+    :param row_ranges: optional list, where the row range of each stacked block is recorded
+    :returns: G_ext, d_ext
+    """
+    labels = ['reg%d' % i for i in range(len(reg_blocks))] if labels is None else labels
+    blocks = [G]
+    for label, block in zip(labels, reg_blocks):
+        if block is None or _count_nonzero(block) == 0:
+            continue
+        start = sum(x.shape[0] for x in blocks)
+        if row_ranges is not None:
+            row_ranges.append((label, start, start + block.shape[0]))
+        blocks.append(block)
+    num_reg_rows = sum(x.shape[0] for x in blocks[1:])
+    d_ext = np.concatenate((d, np.zeros((num_reg_rows,))))
+    if sparse:
+        G_ext = scipy.sparse.vstack([scipy.sparse.csr_matrix(x) for x in blocks], format='csr')
+    else:
+        G_ext = np.vstack([x.toarray() if scipy.sparse.issparse(x) else x for x in blocks])
+    return G_ext, d_ext
+
+
+def choose_solver(G, size_threshold=2000):
+    """Dense BVLS for small problems, sparse trust-region reflective (with lsmr) once n_params is large."""
+    if np.shape(G)[1] < size_threshold:
+        return 'bvls'
+    return 'trf'
+
+
+def bounded_least_squares(G, d, lb, ub, solver='auto', max_iter=1500, size_threshold=2000, x0=None, verbose=True):
+    """
+    Solve min ||Gm - d|| subject to lb <= m <= ub, and report which solver was used, how long, and how many
+    iterations it took.
+
+    :param G: dense array or scipy.sparse matrix
+    :param d: data vector
+    :param lb: lower bounds, one for each model parameter
+    :param ub: upper bounds, one for each model parameter
+    :param solver: 'auto', 'bvls', 'trf', 'projected', or 'admm'
+    :param max_iter: maximum number of iterations
+    :param size_threshold: number of model parameters above which 'auto' leaves dense BVLS
+    :param x0: optional starting model, used by the 'projected' and 'admm' solvers
+    :param verbose: bool, print the solver report
+    :returns: scipy.optimize.OptimizeResult, with additional fields 'solver' and 'solve_time' (seconds)
+    """
+    if solver == 'auto':
+        solver = choose_solver(G, size_threshold)
+    start = time.perf_counter()
+    if solver == 'bvls':
+        G_dense = G.toarray() if scipy.sparse.issparse(G) else G
+        response = scipy.optimize.lsq_linear(G_dense, d, bounds=(lb, ub), max_iter=max_iter, method='bvls')
+    elif solver == 'trf':
+        response = scipy.optimize.lsq_linear(G, d, bounds=(lb, ub), max_iter=max_iter, method='trf',
+                                             lsq_solver='lsmr', lsmr_tol='auto')
+    elif solver == 'projected':
+        response = projected_gradient_lsq(G, d, lb, ub, x0=x0, max_iter=max_iter)
+    elif solver == 'admm':
+        response = AdmmSolver(G).solve(d, lb, ub, x0=x0, max_iter=max_iter)
+    else:
+        raise ValueError("Error! Unrecognized solver %s " % solver)
+    response.solver = solver
+    response.solve_time = time.perf_counter() - start
+    if verbose:
+        print(format_solver_report(response, G))
+    return response
+
+
+def solve_regularized_system(G, d, lb, ub, reg_blocks=(), solver='auto', max_iter=1500, size_threshold=2000,
+                             verbose=True, labels=None, row_ranges=None):
+    """
+    Inversion entry point: keep the regularization rows sparse, then solve with bounds.
+    Dense BVLS receives a dense stacked matrix; the other solvers operate on the sparse stacked matrix.
+
+    :param G: weighted data matrix, n_obs x n_params
+    :param d: weighted data vector, length n_obs
+    :param lb: lower bounds, one for each model parameter
+    :param ub: upper bounds, one for each model parameter
+    :param reg_blocks: sequence of scaled regularization matrices, such as from build_smoothing_matrix
+    :param solver: 'auto', 'bvls', 'trf', 'projected', or 'admm', as in bounded_least_squares
+    :param max_iter: maximum number of iterations
+    :param size_threshold: number of model parameters above which 'auto' leaves dense BVLS
+    :param verbose: bool, print the solver report
+    :param labels: optional name of each block in reg_blocks
+    :param row_ranges: optional list, where (label, start, stop) is recorded for each stacked block
+    :returns: OptimizeResult, G_ext, d_ext
+    """
+    if solver == 'auto':
+        solver = choose_solver(G, size_threshold)
+    G_ext, d_ext = stack_regularized_system(G, d, reg_blocks, sparse=(solver != 'bvls'), labels=labels,
+                                            row_ranges=row_ranges)
+    response = bounded_least_squares(G_ext, d_ext, lb, ub, solver=solver, max_iter=max_iter, verbose=verbose)
+    return response, G_ext, d_ext
+
+
+class NormalEquationsSolver:
+    """
+    Fast path for repeated solves of the same G where only the regularization strengths change (L-curve sweeps).
+    G^T G, G^T d, L^T L, and P^T P are computed once. Each (lam, alpha) then costs one Cholesky factorization
+    R^T R = G^T G + lam^2 L^T L + alpha^2 P^T P of an n_params x n_params matrix. Only the most recent factor is
+    kept, since a sweep visits each (lam, alpha) once.
+    If the unbounded solution violates the bounds, the same factor gives the equivalent bounded problem
+    min ||R m - R^-T G^T d||, which has only n_params rows, so BVLS never goes back to the full stacked system.
+
+    :param G: weighted data matrix, dense or scipy.sparse, n_obs x n_params
+    :param d: weighted data vector, length n_obs
+    :param L: smoothing matrix (unscaled), n_params columns, optional
+    :param P: slip-penalty matrix (unscaled), n_params columns, optional. Default is the identity.
+    :param lb: lower bounds, optional
+    :param ub: upper bounds, optional
+    """
+
+    def __init__(self, G, d, L=None, P=None, lb=None, ub=None):
+        n_params = np.shape(G)[1]
+        self.G, self.d = G, np.asarray(d, dtype=float)
+        self.L = L if L is not None else scipy.sparse.csr_matrix((0, n_params))
+        self.P = P if P is not None else scipy.sparse.identity(n_params, format='csr')
+        self.lb = np.full((n_params,), -np.inf) if lb is None else np.broadcast_to(np.asarray(lb, dtype=float),
+                                                                                  (n_params,))
+        self.ub = np.full((n_params,), np.inf) if ub is None else np.broadcast_to(np.asarray(ub, dtype=float),
+                                                                                 (n_params,))
+        self.GtG = _dense(G.T @ G)
+        self.Gtd = np.asarray(G.T @ self.d).ravel()
+        self.dtd = float(np.dot(self.d, self.d))
+        self.LtL = _dense(self.L.T @ self.L)
+        self.PtP = _dense(self.P.T @ self.P)
+        self.factor_key, self.factor = None, None
+
+    def factorize(self, lam, alpha):
+        """Upper-triangular Cholesky factor R of the regularized normal matrix, kept for the last (lam, alpha)."""
+        key = (float(lam), float(alpha))
+        if key != self.factor_key:
+            A = self.GtG + lam**2 * self.LtL + alpha**2 * self.PtP
+            self.factor_key, self.factor = None, None
+            self.factor = scipy.linalg.cholesky(A, lower=False, check_finite=False)
+            self.factor_key = key
+        return self.factor
+
+    def bounds_active(self, m, tol=1e-10):
+        """True if the model m falls outside the bounds."""
+        return bool(np.any(m < self.lb - tol) or np.any(m > self.ub + tol))
+
+    def solve(self, lam, alpha, fallback_solver='auto', max_iter=1500, verbose=True):
+        """
+        Solve for one pair of regularization strengths.
+        The reported cost is that of the stacked system, 0.5 * (||Gm - d||^2 + lam^2 ||Lm||^2 + alpha^2 ||Pm||^2),
+        and fun is the data residual Gm - d.
+
+        :param lam: smoothing strength (multiplies L)
+        :param alpha: slip-penalty strength (multiplies P)
+        :param fallback_solver: solver passed to solve_regularized_system if the normal matrix is not positive
+            definite
+        :param max_iter: maximum number of iterations for the bounded solve
+        :param verbose: bool, print the solver report
+        :returns: scipy.optimize.OptimizeResult with x, solver, solve_time, nit, message, bounds_active
+        """
+        start = time.perf_counter()
+        try:
+            R = self.factorize(lam, alpha)
+        except np.linalg.LinAlgError:
+            R = None  # normal matrix not positive definite; let the stacked solver handle it
+        if R is None:
+            reg_blocks = [lam * self.L, alpha * self.P]
+            response, _, _ = solve_regularized_system(self.G, self.d, self.lb, self.ub, reg_blocks,
+                                                      solver=fallback_solver, max_iter=max_iter, verbose=False)
+            response.bounds_active = bool(np.any(response.active_mask != 0)) if 'active_mask' in response else True
+        else:
+            m = scipy.linalg.cho_solve((R, False), self.Gtd, check_finite=False)
+            if not self.bounds_active(m):
+                response = scipy.optimize.OptimizeResult(x=m, nit=0, status=1, success=True, bounds_active=False,
+                                                         message="Cholesky solution of the normal equations.")
+                response.solver = 'cholesky'
+            else:
+                c = scipy.linalg.solve_triangular(R, self.Gtd, trans='T', lower=False, check_finite=False)
+                response = scipy.optimize.lsq_linear(R, c, bounds=(self.lb, self.ub), max_iter=max_iter,
+                                                     method='bvls')
+                response.bounds_active = True
+                response.solver = 'cholesky+bvls'
+        m = response.x
+        normal_product = self.GtG.dot(m) + lam**2 * self.LtL.dot(m) + alpha**2 * self.PtP.dot(m)
+        response.cost = 0.5 * max(np.dot(m, normal_product) - 2 * np.dot(m, self.Gtd) + self.dtd, 0)
+        response.fun = self.G.dot(m) - self.d
+        response.solve_time = time.perf_counter() - start
+        if verbose:
+            print(format_solver_report(response, self.G))
+        return response
+
+    def solve_many(self, lam_alpha_pairs, **kwargs):
+        """Solve for a sequence of (lam, alpha) pairs, reusing the cached products. Returns a list of results."""
+        return [self.solve(lam, alpha, **kwargs) for lam, alpha in lam_alpha_pairs]
+
+
+def _count_nonzero(matrix):
+    return matrix.count_nonzero() if scipy.sparse.issparse(matrix) else np.count_nonzero(matrix)
+
+
+def _dense(matrix):
+    """Return a dense ndarray from a dense or sparse matrix."""
+    return matrix.toarray() if scipy.sparse.issparse(matrix) else np.asarray(matrix)
+
+
+def projected_gradient_lsq(G, d, lb, ub, x0=None, max_iter=5000, tol=1e-10):
+    """
+    Accelerated projected gradient (FISTA) for bounded least squares. Only needs products with G and G^T,
+    so it works directly on sparse matrices, and it can be warm-started from a nearby model.
+
+    :param G: dense array or scipy.sparse matrix
+    :param d: data vector
+    :param lb: lower bounds
+    :param ub: upper bounds
+    :param x0: optional starting model (projected into the bounds)
+    :param max_iter: maximum number of iterations
+    :param tol: stop when the relative change in the model falls below tol
+    :returns: scipy.optimize.OptimizeResult with x, cost, nit, status, message, success
+    """
+    n_params = np.shape(G)[1]
+    lb = np.broadcast_to(np.asarray(lb, dtype=float), (n_params,))
+    ub = np.broadcast_to(np.asarray(ub, dtype=float), (n_params,))
+    lipschitz = largest_singular_value(G) ** 2
+    step = 1.0 / lipschitz if lipschitz > 0 else 1.0
+    x = np.zeros((n_params,)) if x0 is None else np.array(x0, dtype=float)
+    x = np.clip(x, lb, ub)
+    y, t = x.copy(), 1.0
+    status, nit = 0, 0
+    for nit in range(1, max_iter + 1):
+        gradient = G.T.dot(G.dot(y) - d)
+        x_new = np.clip(y - step * gradient, lb, ub)
+        t_new = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        y = x_new + ((t - 1) / t_new) * (x_new - x)
+        change = np.linalg.norm(x_new - x) / max(np.linalg.norm(x_new), 1e-30)
+        x, t = x_new, t_new
+        if change < tol:
+            status = 1
+            break
+    residual = G.dot(x) - d
+    message = "Projected gradient converged." if status == 1 else \
+        "The maximum number of iterations is exceeded."
+    return scipy.optimize.OptimizeResult(x=x, cost=0.5 * np.dot(residual, residual), fun=residual, nit=nit,
+                                         status=status, message=message, success=(status == 1))
+
+
+class AdmmSolver:
+    """
+    ADMM for bounded least squares, min ||Gm - d|| subject to lb <= m <= ub (Boyd et al., 2011).
+    Each iteration solves (G^T G + rho I) x = G^T d + rho (z - u) and projects onto the bounds.
+    The factor of G^T G + rho I is computed once, so many data vectors can be solved against the same G,
+    each warm-started from a nearby model (checkerboard tests, noise realizations).
+    A dense G gets a dense Cholesky factor. A sparse G keeps G^T G sparse and gets a sparse LU factor.
+
+    :param G: dense array or scipy.sparse matrix, n_obs x n_params
+    :param rho: optional penalty parameter. Default is the mean of the diagonal of G^T G
+    """
+
+    def __init__(self, G, rho=None):
+        self.G = G
+        GtG = G.T.dot(G)
+        self.rho = float(np.mean(GtG.diagonal())) if rho is None else float(rho)
+        if self.rho <= 0:
+            self.rho = 1.0
+        if scipy.sparse.issparse(GtG):
+            A = scipy.sparse.csc_matrix(GtG + self.rho * scipy.sparse.identity(GtG.shape[0]))
+            self.factor = scipy.sparse.linalg.splu(A)
+        else:
+            self.factor = scipy.linalg.cho_factor(GtG + self.rho * np.identity(len(GtG)), check_finite=False)
+
+    def _factor_solve(self, rhs):
+        if isinstance(self.factor, scipy.sparse.linalg.SuperLU):
+            return self.factor.solve(rhs)
+        return scipy.linalg.cho_solve(self.factor, rhs, check_finite=False)
+
+    def solve(self, d, lb, ub, x0=None, max_iter=5000, tol=1e-8):
+        """
+        :param d: data vector
+        :param lb: lower bounds
+        :param ub: upper bounds
+        :param x0: optional starting model (projected into the bounds)
+        :param max_iter: maximum number of iterations
+        :param tol: relative tolerance on the primal and dual residuals
+        :returns: scipy.optimize.OptimizeResult with x, cost, nit, status, message, success
+        """
+        n_params = np.shape(self.G)[1]
+        lb = np.broadcast_to(np.asarray(lb, dtype=float), (n_params,))
+        ub = np.broadcast_to(np.asarray(ub, dtype=float), (n_params,))
+        Gtd = np.asarray(self.G.T.dot(d)).ravel()
+        z = np.clip(np.zeros((n_params,)) if x0 is None else np.array(x0, dtype=float), lb, ub)
+        u = np.zeros((n_params,))
+        status, nit = 0, 0
+        for nit in range(1, max_iter + 1):
+            x = self._factor_solve(Gtd + self.rho * (z - u))
+            z_new = np.clip(x + u, lb, ub)
+            u = u + x - z_new
+            primal = np.linalg.norm(x - z_new)
+            dual = self.rho * np.linalg.norm(z_new - z)
+            z = z_new
+            scale = max(np.linalg.norm(x), np.linalg.norm(z), 1e-30)
+            if primal < tol * scale and dual < tol * max(self.rho * np.linalg.norm(u), np.linalg.norm(Gtd), 1e-30):
+                status = 1
+                break
+        residual = self.G.dot(z) - d
+        message = "ADMM converged." if status == 1 else "The maximum number of iterations is exceeded."
+        return scipy.optimize.OptimizeResult(x=z, cost=0.5 * np.dot(residual, residual), fun=residual, nit=nit,
+                                             status=status, message=message, success=(status == 1))
+
+
+def largest_singular_value(G, n_iter=100, tol=1e-6, seed=0):
+    """Estimate the largest singular value of G by power iteration on G^T G."""
+    rng = np.random.default_rng(seed)
+    v = rng.standard_normal(np.shape(G)[1])
+    v /= np.linalg.norm(v)
+    sigma = 0
+    for _i in range(n_iter):
+        w = G.T.dot(G.dot(v))
+        norm_w = np.linalg.norm(w)
+        if norm_w == 0:
+            return 0
+        v = w / norm_w
+        new_sigma = np.sqrt(norm_w)
+        if abs(new_sigma - sigma) < tol * new_sigma:
+            return new_sigma * (1 + 1e-3)  # small safety margin for the step size
+        sigma = new_sigma
+    return sigma * (1 + 1e-3)
+
+
+def randomized_svd(G, rank, n_oversamples=10, n_iter=4, seed=0):
+    """
+    Truncated SVD of G from a randomized range finder (Halko et al., 2011).
+    Only needs products with G and G^T, so it works directly on sparse matrices.
+
+    :param G: dense array or scipy.sparse matrix, shape (n, p)
+    :param rank: number of singular triplets to return
+    :param n_oversamples: extra random vectors used to capture the range of G
+    :param n_iter: number of power iterations, which sharpen the spectrum for slowly decaying singular values
+    :param seed: seed for the random test matrix
+    :returns: U (n, rank), s (rank), Vt (rank, p)
+    """
+    n, p = np.shape(G)
+    rank = min(rank, n, p)
+    n_random = min(rank + n_oversamples, n, p)
+    rng = np.random.default_rng(seed)
+    Q = np.linalg.qr(np.asarray(G.dot(rng.standard_normal((p, n_random)))))[0]
+    for _i in range(n_iter):
+        Q = np.linalg.qr(np.asarray(G.T.dot(Q)))[0]
+        Q = np.linalg.qr(np.asarray(G.dot(Q)))[0]
+    B = np.asarray(G.T.dot(Q)).T  # Q^T G, shape (n_random, p)
+    U_small, s, Vt = np.linalg.svd(B, full_matrices=False)
+    U = Q.dot(U_small)
+    return U[:, :rank], s[:rank], Vt[:rank, :]
+
+
+def format_solver_report(response, G=None):
+    """One line describing solver choice, iterations, and solve time."""
+    shape_string = " for G of shape %s" % str(np.shape(G)) if G is not None else ""
+    return "Solver %s%s: %d iterations, %.3f seconds. %s" % (response.solver, shape_string, response.nit,
+                                                             response.solve_time, response.message)
+
+
+def write_solver_report(response, outfile, G=None):
+    """Write the solver report into a text file in the output directory, for comparing solvers."""
+    print("Writing %s" % outfile)
+    with open(outfile, 'w') as ofile:
+        ofile.write(format_solver_report(response, G) + "\n")
+        ofile.write("Cost: %f\n" % response.cost)
+    return
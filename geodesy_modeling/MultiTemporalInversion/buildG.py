@@ -1,7 +1,10 @@
 import numpy as np
 import matplotlib.pyplot as plt
+import hashlib
 import json
 import os
+import pickle
+import time
 import slippy.xyz2geo as plotting_library
 import slippy.basis
 import slippy.patch
@@ -9,12 +12,72 @@ import slippy.tikhonov
 import slippy.gbuild
 import scipy.optimize
 import scipy.linalg
+import scipy.sparse
 import slippy.io
 from . import resolution_tests
+from ..Inversion import solvers
 
 
 def reg_nnls(Gext, dext):
-    return scipy.optimize.nnls(Gext, dext)[0]
+    """Non-negative least squares on a dense or sparse Gext, with the default solver choice."""
+    return solve_nnls(Gext, dext, verbose=False).x
+
+
+def solve_nnls(Gext, dext, solver='auto', x0=None, max_iter=5000, admm_solver=None, verbose=True):
+    """
+    Non-negative least squares with a choice of solver, timed, for the multitemporal inversion.
+
+    :param Gext: dense or sparse matrix
+    :param dext: data vector
+    :param solver: 'auto', 'nnls', 'bvls', 'trf_sparse', or 'admm'.
+        'auto' is nnls for small systems and trf_sparse for large sparse systems.
+        'nnls' is scipy's Lawson-Hanson active set on a dense copy of Gext.
+        'trf_sparse' is trust-region reflective with lsmr, only using products with the sparse Gext.
+        'admm' reuses one factor of Gext^T Gext + rho I, and can be warm-started.
+    :param x0: optional starting model, used only by 'admm'. The other solvers ignore it, with a warning
+    :param max_iter: maximum number of iterations for the iterative solvers
+    :param admm_solver: optional solvers.AdmmSolver already built for Gext, so its factor is reused
+    :param verbose: bool, print the solver report
+    :returns: scipy.optimize.OptimizeResult with x, cost, nit, message, solver, and solve_time (seconds)
+    """
+    if solver == 'auto':
+        use_nnls = not scipy.sparse.issparse(Gext) or solvers.choose_solver(Gext) == 'bvls'
+        solver = 'nnls' if use_nnls else 'trf_sparse'
+    if x0 is not None and solver != 'admm':
+        print("Warning! Solver %s does not use a starting model; ignoring x0" % solver)
+    start = time.perf_counter()
+    if solver == 'nnls':
+        x, rnorm = scipy.optimize.nnls(Gext.toarray() if scipy.sparse.issparse(Gext) else Gext, dext)
+        response = scipy.optimize.OptimizeResult(x=x, cost=0.5 * rnorm**2, nit=0, status=1, success=True,
+                                                 message="Lawson-Hanson active set.")
+    elif solver == 'bvls' or solver == 'trf_sparse':
+        response = solvers.bounded_least_squares(Gext, dext, 0, np.inf, solver=solver.replace('_sparse', ''),
+                                                 max_iter=max_iter, verbose=False)
+    elif solver == 'admm':
+        admm_solver = admm_solver if admm_solver is not None else solvers.AdmmSolver(Gext)
+        response = admm_solver.solve(dext, 0, np.inf, x0=x0, max_iter=max_iter)
+    else:
+        raise ValueError("Error! Unrecognized solver %s " % solver)
+    response.solver = solver
+    response.solve_time = time.perf_counter() - start
+    if verbose:
+        print(solvers.format_solver_report(response, Gext))
+    return response
+
+
+def write_solver_diagnostics(diagnostics, outfile):
+    """
+    Timing and convergence of each solve in a run, for comparing solvers.
+
+    :param diagnostics: list of (label, OptimizeResult from solve_nnls, G matrix)
+    :param outfile: string
+    """
+    print("Writing %s" % outfile)
+    with open(outfile, 'w') as ofile:
+        for label, response, G in diagnostics:
+            ofile.write("%s: %s\n" % (label, solvers.format_solver_report(response, G)))
+            ofile.write("%s: cost %f, converged %s\n" % (label, response.cost, response.success))
+    return
 
 
 def G_with_smoothing(G, L, alpha, d, num_params, n_epochs):
@@ -22,26 +85,61 @@ def G_with_smoothing(G, L, alpha, d, num_params, n_epochs):
     L: Add smoothing regularization
     Alpha: Add minimum-norm regularization (Aster and Thurber, Equation 4.5) (0th order tikhonov regularization)
     d: Expand the data vector to match the new size of G
+    The regularization rows are kron(I_epochs, [L; alpha*I]): one copy of [L; alpha*I] for each epoch, along the
+    block diagonal, in the same row order as before. Returns a scipy.sparse csr matrix.
     """
-    Gext = G.copy()
-    dext = d.copy()
-    for i in range(n_epochs):
-        new_l_rowblock = np.zeros((len(L), num_params*n_epochs))
-        new_l_rowblock[:, i*num_params:(i+1)*num_params] = L
-        Gext = np.vstack((Gext, new_l_rowblock))
-        zero_vector = np.zeros((len(L),))
-        dext = np.concatenate((dext, zero_vector))
-        if alpha > 0:  # Minimum norm solution. Aster and Thurber, Equation 4.5.
-            new_alpha_rowblock = np.zeros((len(L), num_params*n_epochs))
-            alphaI = alpha * np.identity(len(L))
-            alphaI[-1, -1] = 0  # for leveling, we don't want the offset term to be constrained with smoothing.
-            new_alpha_rowblock[:, i * num_params:(i + 1) * num_params] = alphaI
-            Gext = np.vstack((Gext, new_alpha_rowblock))
-            zero_vector = np.zeros((len(alphaI),))
-            dext = np.concatenate((dext, zero_vector))
+    reg_block = scipy.sparse.csr_matrix(L)
+    if alpha > 0:  # Minimum norm solution. Aster and Thurber, Equation 4.5.
+        alpha_diag = alpha * np.ones((len(L),))
+        alpha_diag[-1] = 0  # for leveling, we don't want the offset term to be constrained with smoothing.
+        reg_block = scipy.sparse.vstack((reg_block, scipy.sparse.diags(alpha_diag, shape=(len(L), num_params))))
+    reg_rows = scipy.sparse.kron(scipy.sparse.identity(n_epochs), reg_block, format='csr')
+    Gext = scipy.sparse.vstack((scipy.sparse.csr_matrix(G), reg_rows), format='csr')
+    dext = np.concatenate((d, np.zeros((reg_rows.shape[0],))))
     return Gext, dext
 
 
+def assemble_multiepoch_G(G_list, epoch_masks):
+    """
+    Block-sparse G for all datasets and epochs. Each dataset's G is placed in the column-block of every epoch that
+    the dataset spans (like the "1" in SBAS). Each G is converted to sparse once, and that one block is shared by
+    all of its epochs in scipy.sparse.bmat, which copies it only into the assembled matrix. Zero blocks are empty.
+
+    :param G_list: list of weighted G matrices, one for each dataset, each n_obs x n_model_params
+    :param epoch_masks: list of boolean lists, one for each dataset, True for each epoch the dataset spans
+    :returns: scipy.sparse csr matrix, shape (total n_obs, n_epochs * n_model_params)
+    """
+    blocks = []
+    for G, mask in zip(G_list, epoch_masks):
+        G_block, zero_block = scipy.sparse.csr_matrix(G), scipy.sparse.csr_matrix(np.shape(G))
+        blocks.append([G_block if in_epoch else zero_block for in_epoch in mask])
+    return scipy.sparse.bmat(blocks, format='csr')
+
+
+def build_offset_columns(num_rows, row_span_list, signs_list):
+    """
+    Sparse columns for the offset parameters (like leveling offsets), one for each dataset with a nonzero offset sign.
+    The column holds the sign on every row of its dataset, rows [top, bottom) from row_span_list, and zero elsewhere.
+    Rows below the data, such as smoothing rows, are always zero.
+    Before this was vectorized, the first row of each dataset was left out of its offset column in G_ext (the test
+    was top < i < bottom), and the column in G_nosmooth was placed by a running count of leveling rows only, which
+    was only right when the leveling datasets came first. Both columns now cover exactly the rows of the dataset.
+
+    :param num_rows: number of rows in the matrix that the columns will be appended to
+    :param row_span_list: list of [top, bottom) row spans, one for each dataset
+    :param signs_list: list of offset signs, one for each dataset. 0 means no offset parameter
+    :returns: scipy.sparse csr matrix, num_rows x number of nonzero signs
+    """
+    spans = [(span, sign) for span, sign in zip(row_span_list, signs_list) if sign != 0]
+    if len(spans) == 0:
+        return scipy.sparse.csr_matrix((num_rows, 0))
+    rows = [np.arange(span[0], span[1]) for span, _sign in spans]
+    cols = [np.full(span[1] - span[0], k) for k, (span, _sign) in enumerate(spans)]
+    values = [np.full(span[1] - span[0], float(sign)) for span, sign in spans]
+    return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(num_rows, len(spans)))
+
+
 def normalized_vector(vector):
     norm = np.sqrt(np.square(vector[0]) + np.square(vector[1]) + np.square(vector[2]))
     return np.divide(vector, norm)
@@ -104,21 +202,19 @@ def input_insar_file(filename):
     return [obs_disp_f, obs_sigma_f, obs_basis_f, obs_pos_geo_f, Ninsar]
 
 
-def input_all_obs_data(input_file_list, data_type_list, strengths_list):
+def input_all_obs_data(input_file_list, data_type_list):
     nums_obs_list = []    # list that holds number of data points in each dataset (3ngps, ninsar, etc.)
     pos_obs_list = []     # list of [llh] for each observation, (ninsar + nlev + 3ngps)
     pos_basis_list = []    # lists of look vectors or gps basis, (ninsar + nlev + 3ngps)
-    obs_disp_f_list, obs_sigma_f_list, obs_weighting_f_list = [], [], []
+    obs_disp_f_list, obs_sigma_f_list = [], []
 
     # START THE INPUT LOOP
     for filenum in range(len(input_file_list)):
         filename = input_file_list[filenum]
         if data_type_list[filenum] == 'gps':
-            [obs_disp_f, obs_sigma_f, obs_basis_f, obs_pos_geo_f, Ngps] = input_gps_file(filename)
-            obs_weighting_f = (1 / strengths_list[filenum]) * np.ones((Ngps * 3,))
+            [obs_disp_f, obs_sigma_f, obs_basis_f, obs_pos_geo_f, _Ngps] = input_gps_file(filename)
         elif data_type_list[filenum] == 'insar' or data_type_list[filenum] == "leveling":
-            [obs_disp_f, obs_sigma_f, obs_basis_f, obs_pos_geo_f, Ninsar] = input_insar_file(filename)
-            obs_weighting_f = (1 / strengths_list[filenum]) * np.ones((Ninsar,))
+            [obs_disp_f, obs_sigma_f, obs_basis_f, obs_pos_geo_f, _Ninsar] = input_insar_file(filename)
         else:
             print("ERROR! Unrecognized data type %s " % data_type_list[filenum])
             continue
@@ -129,9 +225,8 @@ def input_all_obs_data(input_file_list, data_type_list, strengths_list):
         nums_obs_list.append(len(obs_disp_f))    # list append: number of obs in this dataset (ninsar, 3ngps, etc)
         obs_disp_f_list.append(obs_disp_f)  # observed displacements
         obs_sigma_f_list.append(obs_sigma_f)  # uncertainties
-        obs_weighting_f_list.append(obs_weighting_f)   # extra weighting factor
     # End input loop
-    return [pos_obs_list, pos_basis_list, nums_obs_list, obs_disp_f_list, obs_sigma_f_list, obs_weighting_f_list]
+    return [pos_obs_list, pos_basis_list, nums_obs_list, obs_disp_f_list, obs_sigma_f_list]
 
 
 def input_faults(config):
@@ -167,11 +262,15 @@ def input_faults(config):
 
 
 def graph_big_G(config, G):
-    # Show big-G matrix for all times, all data
+    # Show big-G matrix for all times, all data. A sparse G is drawn as its sparsity pattern, without making it dense
     plt.figure(figsize=(12, 8), dpi=300)
-    plt.imshow(G, vmin=-0.2, vmax=0.2, aspect=1/5)
-    plt.colorbar()
+    if scipy.sparse.issparse(G):
+        plt.spy(G, markersize=0.1, aspect='auto')
+    else:
+        plt.imshow(G, vmin=-0.2, vmax=0.2, aspect=1/5)
+        plt.colorbar()
     plt.savefig(os.path.join(config['output_dir'], "image_of_G.png"))
+    plt.close()
     return
 
 
@@ -213,14 +312,54 @@ def parse_disp_outputs(pred_disp_f, num_obs):
 
 
 def beginning_calc(config):
+    """The full multitemporal inversion: build G and data, then regularize, invert, and write outputs."""
+    system = build_inversion_system(config)
+    solve_and_write_outputs(config, system)
+    return
 
-    with open(os.path.join(config['output_dir'], 'config.json'), 'w') as fp:
-        json.dump(config, fp, indent="  ")   # save copy of config file in outdir, for record-keeping
 
-    fault_list = input_faults(config)
-    alpha = config['alpha']  # a parameter to produce Minimum norm solution (optional)
+def get_cache_dir(config):
+    """Directory for the on-disk stage cache. Set "cache_dir" in the config to share it between experiments."""
+    default_dir = os.path.join(config.get("output_dir", config.get("output_dir_lcurve", ".")), "stage_cache")
+    return config.get("cache_dir", default_dir)
+
+
+def get_stage_key(stage_name, config_subset, filenames=()):
+    """Hash of the config entries and the contents of the input files that a stage depends on."""
+    sha = hashlib.sha1(stage_name.encode())
+    sha.update(json.dumps(config_subset, sort_keys=True, default=str).encode())
+    for filename in filenames:
+        with open(filename, 'rb') as fp:
+            sha.update(hashlib.sha1(fp.read()).digest())
+    return sha.hexdigest()
 
-    # Setting up the basemap before we begin (using the first dataset as information)
+
+def cached_stage(cache_dir, stage_name, key, compute_function):
+    """
+    Return the output of a pipeline stage from the cache, or compute it and store it.
+    Written to a temporary file first, so an interrupted run never leaves a partial artifact.
+
+    :param cache_dir: string
+    :param stage_name: string, such as 'faults', 'data', or 'G'
+    :param key: string from get_stage_key
+    :param compute_function: function() -> the stage output, called only on a cache miss
+    """
+    filename = os.path.join(cache_dir, "%s_%s.pkl" % (stage_name, key))
+    if os.path.isfile(filename):
+        print("Using cached %s stage from %s" % (stage_name, filename))
+        with open(filename, 'rb') as fp:
+            return pickle.load(fp)
+    result = compute_function()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_filename = filename + ".%d.tmp" % os.getpid()
+    with open(tmp_filename, 'wb') as fp:
+        pickle.dump(result, fp)
+    os.replace(tmp_filename, filename)
+    return result
+
+
+def build_basemap(config):
+    """Set up the basemap (using the first dataset as information)."""
     first_dataset = list(config["data_files"].keys())[0]
     if config["data_files"][first_dataset]["type"] == "gps":
         first_input = slippy.io.read_gps_data(config["data_files"][first_dataset]["data_file"])  # gps
@@ -228,7 +367,15 @@ def beginning_calc(config):
         first_input = slippy.io.read_insar_data(config["data_files"][first_dataset]["data_file"])   # lev or insar
     obs_pos_geo = first_input[0]
     obs_pos_geo_basemap = obs_pos_geo[:, None, :].repeat(3, axis=1).reshape((len(first_input[0]) * 3, 3))  # reshape llh
-    bm = plotting_library.create_default_basemap(obs_pos_geo_basemap[:, 0], obs_pos_geo_basemap[:, 1])
+    return plotting_library.create_default_basemap(obs_pos_geo_basemap[:, 0], obs_pos_geo_basemap[:, 1])
+
+
+def discretize_faults(config, bm):
+    """
+    Faults stage: read the faults, discretize them into patches, make slip basis vectors for each patch,
+    and build the unscaled smoothing matrix for each fault.
+    """
+    fault_list = input_faults(config)
 
     # # ###################################################################
     # ### discretize the fault segments
@@ -241,7 +388,7 @@ def beginning_calc(config):
     patches_f = []  # patches repeated for each basis (for example, one for dip slip and one for strike slip)
     slip_basis_f = np.zeros((0, 3))   # basis functions repeated for each slip patch
     fault_names_array = []  # a list of fault names (integers) for each fault patch
-    L_array = []   # may hold several smoothing matrices, if using 2+ faults
+    L_array = []   # may hold several smoothing matrices, if using 2+ faults. Not yet multiplied by penalty.
 
     # # Fault processing
     for fault in fault_list:
@@ -273,23 +420,74 @@ def beginning_calc(config):
             connectivity = indices[:, i].reshape((fault["Nlength"], fault["Nwidth"]))
             Li = slippy.tikhonov.tikhonov_matrix(connectivity, 2, column_no=Ns * Ds)
             L = np.vstack((Li, L))
+        L_array.append(L)   # collecting full smoothing matrix for each fault, multiplied by penalty at solve time
 
-        L *= fault["penalty"]   # multiplying by smoothing strength for this fault
-        L_array.append(L)   # collecting full smoothing matrix for each fault
+    patches_pos_cart = [i.patch_to_user([0.5, 1.0, 0.0]) for i in patches]
+    faults = {
+        "fault_list": fault_list,
+        "Ds": Ds,
+        "patches": patches,
+        "patches_f": patches_f,
+        "slip_basis_f": slip_basis_f,
+        "total_fault_slip_basis": total_fault_slip_basis,
+        "fault_names_array": fault_names_array,
+        "L_array": L_array,
+        "patches_pos_geo": plotting_library.cartesian_to_geodetic(patches_pos_cart, bm),
+    }
+    return faults
+
+
+def build_dataset_G(pos_obs, pos_basis, patches_f, slip_basis_f, bm):
+    """G stage: the unweighted system matrix for one dataset."""
+    # # Geodetic to Cartesian coordinates for this dataset
+    obs_pos_cart_f = plotting_library.geodetic_to_cartesian(pos_obs, bm)
+
+    # BUILD SYSTEM MATRIX FOR THIS SET OF OBSERVATIONS
+    # here, leveling=False because we'll add leveling manually later
+    ###################################################################
+    return slippy.gbuild.build_system_matrix(obs_pos_cart_f, patches_f, pos_basis, slip_basis_f, leveling=False)
+
+
+def build_inversion_system(config):
+    """
+    Everything that does not depend on the regularization strengths (alpha, fault penalties) or on the output
+    directory: fault discretization, unscaled smoothing matrices, data, and the unregularized G.
+    The result can be reused for many solves, such as the points of an L-curve.
+
+    :param config: dictionary
+    :returns: dictionary holding the unregularized system and the metadata needed for outputs
+    """
+    cache_dir = get_cache_dir(config)
+    first_dataset = config["data_files"][list(config["data_files"].keys())[0]]
+    basemap_file, basemap_type = first_dataset["data_file"], first_dataset["type"]
+    basemap = []   # built only if some stage is not in the cache
+
+    def get_basemap():
+        if len(basemap) == 0:
+            basemap.append(build_basemap(config))
+        return basemap[0]
+
+    # FAULTS STAGE: depends on the fault files and on the basemap, but not on the penalties
+    fault_files = [config["faults"][key]["filename"] for key in config["faults"].keys()]
+    fault_key = get_stage_key("faults", [list(config["faults"].keys()), basemap_type], fault_files + [basemap_file])
+    faults = cached_stage(cache_dir, "faults", fault_key, lambda: discretize_faults(config, get_basemap()))
+    fault_list, Ds, patches = faults["fault_list"], faults["Ds"], faults["patches"]
+    patches_f, slip_basis_f = faults["patches_f"], faults["slip_basis_f"]
+    total_fault_slip_basis, fault_names_array = faults["total_fault_slip_basis"], faults["fault_names_array"]
+    L_array = faults["L_array"]
+    for fault, key in zip(fault_list, config["faults"].keys()):
+        fault["penalty"] = config["faults"][key]["penalty"]   # penalties are not part of the cached stage
 
-    L = scipy.linalg.block_diag(*L_array)  # For 2+ faults: Make block diagonal matrix for tikhonov regularization
     Ns_total = len(patches)  # number of total patches (regardless of basis vectors)
 
     # PARSE HOW MANY EPOCHS WE ARE USING
-    # Tell us how many epochs, model parameters total, and output files we need.
+    # Tell us how many epochs and model parameters total we need.
     n_epochs = 0
-    total_spans, span_output_files = [], []
+    total_spans = []
     for epoch in config["epochs"].keys():
         n_epochs = n_epochs + 1
         total_spans.append(config["epochs"][epoch]["name"])
-        span_output_files.append(config["output_dir"]+config["epochs"][epoch]["slip_output_file"])
-    n_model_params = np.shape(L)[0]    # model parameters that aren't leveling offset
-    n_cols_bigG = n_model_params * n_epochs  # the total number of fault-related model parameters across all time
+    n_model_params = sum(np.shape(x)[0] for x in L_array)    # model parameters that aren't leveling offset
     print("Finding fault model for: %d epochs " % n_epochs)
     print("Number of fault-model parameters per epoch: %d" % n_model_params)
     print("Number of all fault-model parameters: %d" % (n_model_params * n_epochs))
@@ -298,10 +496,10 @@ def beginning_calc(config):
     d_total = np.zeros((0,))         # data vector
     sig_total = np.zeros((0,))       # uncertainties vector
     weight_total = np.zeros((0,))    # weights vector
-    G_nosmooth = np.zeros((0, n_epochs * n_model_params))  # does not contain leveling offsets
+    G_list, epoch_masks = [], []     # each dataset's G is stored once, with the epochs it spans
 
     # INITIAL DATA SCOPING: HOW MANY FILES WILL NEED TO BE READ?
-    input_file_list, output_file_list = [], []
+    input_file_list = []
     spans_list, strengths_list, signs_list = [], [], []  # signs is for offset parameter, like for leveling
     data_type_list, row_span_list = [], []
     print("Available data indicated in json file: ")
@@ -309,17 +507,19 @@ def beginning_calc(config):
     # Unpacking metadata from config file
     for data_file in config["data_files"].keys():
         input_file_list.append(config["data_files"][data_file]["data_file"])  # 'infile' expected of all data files
-        output_file_list.append(config["output_dir"]+config["data_files"][data_file]["outfile"])  # predicted outfile
         data_type_list.append(config["data_files"][data_file]["type"])       # 'type' expected of all data files
         spans_list.append(config["data_files"][data_file]["span"])           # 'span' expected of all data files
         strengths_list.append(config["data_files"][data_file]["strength"])   # 'strength' expected of all data files
         print(config["data_files"][data_file]["data_file"], " spans ", config["data_files"][data_file]["span"])
         signs_list.append(config["data_files"][data_file]["offset_sign"])  # if 0, don't create column for parameter
 
-    # Input many files of geodetic data
-    [pos_obs_list, pos_basis_list, nums_obs_list,
-     obs_disp_f_list_pure, obs_sigma_f_list, obs_weighting_f_list] = input_all_obs_data(input_file_list, data_type_list,
-                                                                                        strengths_list)
+    # DATA STAGE: input many files of geodetic data
+    data_key = get_stage_key("data", [data_type_list], input_file_list)
+    [pos_obs_list, pos_basis_list, nums_obs_list, obs_disp_f_list_pure, obs_sigma_f_list] = cached_stage(
+        cache_dir, "data", data_key, lambda: input_all_obs_data(input_file_list, data_type_list))
+    # extra weighting factor for each dataset, applied after the cached stage so changing a strength re-reads nothing
+    obs_weighting_f_list = [(1 / strength) * np.ones((num_obs,)) for strength, num_obs in
+                            zip(strengths_list, nums_obs_list)]
     obs_disp_f_list = obs_disp_f_list_pure.copy()  # keeping a copy without multiplying by sigma or weight
 
     for dataset in obs_sigma_f_list:
@@ -329,17 +529,12 @@ def beginning_calc(config):
 
     # Building G for each dataset
     for datanum, pos_obs in enumerate(pos_obs_list):
-        # # Geodetic to Cartesian coordinates for this dataset
-        obs_pos_cart_f = plotting_library.geodetic_to_cartesian(pos_obs, bm)
-
-        # BUILD SYSTEM MATRIX FOR THIS SET OF OBSERVATIONS
-        # here, leveling=False because we'll add leveling manually later
-        ###################################################################
-        G = slippy.gbuild.build_system_matrix(obs_pos_cart_f,
-                                              patches_f,
-                                              pos_basis_list[datanum],
-                                              slip_basis_f,
-                                              leveling=False)
+        # G STAGE: depends on the faults stage and on this dataset's positions and basis (not on its weighting)
+        G_key = get_stage_key("G", [fault_key, data_type_list[datanum]], [input_file_list[datanum], basemap_file])
+        G = cached_stage(cache_dir, "G", G_key,
+                         lambda: build_dataset_G(pos_obs, pos_basis_list[datanum], patches_f, slip_basis_f,
+                                                 get_basemap()))
+        G = np.array(G, dtype=float)   # a fresh copy, weighted below
 
         # ### weigh system matrix and data by the uncertainty
         # ###################################################################
@@ -354,26 +549,90 @@ def beginning_calc(config):
         sig_total = np.concatenate((sig_total, obs_sigma_f_list[datanum]))  # building total sigma vector
         weight_total = np.concatenate((weight_total, obs_weighting_f_list[datanum]))  # building total weighting vector
 
-        # APPEND TO THE BIGGER MATRIX AND DATA VECTOR (WITH THE CORRECT SPANS)
-        G_rowblock_obs = np.zeros((np.shape(G)[0], n_cols_bigG))     # one block per data file
-
         # Which spans does the data cover? This is like the "1" in SBAS
-        # One new "rowblock" for each data file (blocks that cross all the time spans)
-        count = 0
-        for epoch in total_spans:
-            col_limits = [count * n_model_params, (count + 1) * n_model_params]
-            if epoch in spans_list[datanum]:
-                G_rowblock_obs[:, col_limits[0]:col_limits[1]] = G   # fill rowblock with copies of G_ext block
-            count = count + 1
-
-        # APPEND NEW ROWBLOCK TO G_TOTAL
-        top_row_data = len(G_nosmooth)  # Where in the matrix rows is this data?
-        bottom_row_data = len(G_nosmooth) + len(G)  # Where in the matrix rows is this data?
-        row_span_list.append([top_row_data, bottom_row_data])
-        G_nosmooth = np.concatenate((G_nosmooth, G_rowblock_obs))
-        print("  Adding %d lines " % len(G_rowblock_obs))
+        G_list.append(G)
+        epoch_masks.append([epoch in spans_list[datanum] for epoch in total_spans])
+
+        # Where in the matrix rows is this data?
+        top_row_data = row_span_list[-1][1] if row_span_list else 0
+        row_span_list.append([top_row_data, top_row_data + len(G)])
+        print("  Adding %d lines " % len(G))
+    G_nosmooth = assemble_multiepoch_G(G_list, epoch_masks)  # does not contain leveling offsets
     # End Build_G stage
 
+    system = {
+        "fault_list": fault_list,
+        "fault_keys": list(config["faults"].keys()),
+        "L_array": L_array,
+        "Ds": Ds,
+        "Ns_total": Ns_total,
+        "patches_f": patches_f,
+        "total_fault_slip_basis": total_fault_slip_basis,
+        "fault_names_array": fault_names_array,
+        "patches_pos_geo": faults["patches_pos_geo"],
+        "patches_strike": [i.strike for i in patches],
+        "patches_dip": [i.dip for i in patches],
+        "patches_length": [i.length for i in patches],
+        "patches_width": [i.width for i in patches],
+        "n_epochs": n_epochs,
+        "n_model_params": n_model_params,
+        "G_nosmooth": G_nosmooth,
+        "d_total": d_total,
+        "sig_total": sig_total,
+        "weight_total": weight_total,
+        "row_span_list": row_span_list,
+        "input_file_list": input_file_list,
+        "data_type_list": data_type_list,
+        "signs_list": signs_list,
+        "pos_obs_list": pos_obs_list,
+        "pos_basis_list": pos_basis_list,
+        "nums_obs_list": nums_obs_list,
+        "obs_disp_f_list_pure": obs_disp_f_list_pure,
+        "obs_sigma_f_list": obs_sigma_f_list,
+    }
+    return system
+
+
+def build_smoothing_matrix(config, system):
+    """Multiply each fault's smoothing matrix by its penalty from config. Block diagonal for 2+ faults."""
+    L_array = []
+    for key, L in zip(system["fault_keys"], system["L_array"]):
+        L_array.append(L * config["faults"][key]["penalty"])   # multiplying by smoothing strength for this fault
+    return scipy.linalg.block_diag(*L_array)  # For 2+ faults: Make block diagonal matrix for tikhonov regularization
+
+
+def solve_and_write_outputs(config, system):
+    """
+    Regularize the system with alpha and the fault penalties from config, invert, and write outputs into
+    config['output_dir']. Does not modify the system, so it can be called many times with different configs.
+
+    :param config: dictionary
+    :param system: dictionary from build_inversion_system
+    """
+    with open(os.path.join(config['output_dir'], 'config.json'), 'w') as fp:
+        json.dump(config, fp, indent="  ")   # save copy of config file in outdir, for record-keeping
+
+    alpha = config['alpha']  # a parameter to produce Minimum norm solution (optional)
+    fault_list = system["fault_list"]
+    Ds, Ns_total, n_epochs = system["Ds"], system["Ns_total"], system["n_epochs"]
+    n_model_params = system["n_model_params"]
+    patches_f, total_fault_slip_basis = system["patches_f"], system["total_fault_slip_basis"]
+    fault_names_array = system["fault_names_array"]
+    G_nosmooth, d_total = system["G_nosmooth"], system["d_total"]
+    sig_total, weight_total = system["sig_total"], system["weight_total"]
+    row_span_list, signs_list = system["row_span_list"], system["signs_list"]
+    input_file_list, data_type_list = system["input_file_list"], system["data_type_list"]
+    pos_obs_list, pos_basis_list, nums_obs_list = system["pos_obs_list"], system["pos_basis_list"], \
+        system["nums_obs_list"]
+    obs_disp_f_list_pure, obs_sigma_f_list = system["obs_disp_f_list_pure"], system["obs_sigma_f_list"]
+    L = build_smoothing_matrix(config, system)
+
+    # Output files for this run
+    span_output_files = [config["output_dir"]+config["epochs"][epoch]["slip_output_file"]
+                         for epoch in config["epochs"].keys()]
+    output_file_list = [config["output_dir"]+config["data_files"][data_file]["outfile"]
+                        for data_file in config["data_files"].keys()]
+
     # Smoothing and slip penalty for each epoch.  (L DEPENDS ON FAULT GEOMETRY ONLY)
     G_ext, d_ext = G_with_smoothing(G_nosmooth, L, alpha, d_total, n_model_params, n_epochs)
     G_noa, d_noa = G_with_smoothing(G_nosmooth, L, 0, d_total, n_model_params, n_epochs)  # for resolution tests
@@ -381,34 +640,24 @@ def beginning_calc(config):
     print("Shape of Gext (G,L,alpha):", np.shape(G_ext))
 
     # ADDING COLUMNS FOR LEVELING OFFSETS TO G_TOTAL MATRIX (to corresponding data lines only)
-    num_leveling_params = 0
     print("------\nBefore adding lines for leveling offsets, shape(G): ", np.shape(G_nosmooth))
-    numrows = np.shape(G_ext)[0]
-    num_rows_nosmooth = np.shape(G_nosmooth)[0]
-    count = 0
     for datanum in range(len(pos_obs_list)):
-        leveling_sign = signs_list[datanum]
-        if leveling_sign != 0:
-            num_leveling_params += 1
-            newcol = np.zeros((numrows, 1))
-            for i in range(len(newcol)):
-                if row_span_list[datanum][0] < i < row_span_list[datanum][1]:
-                    newcol[i] = leveling_sign
-            G_ext = np.hstack((G_ext, newcol))  # adding column to G
+        if signs_list[datanum] != 0:
             print("Adding column for %s " % input_file_list[datanum])
-
-            # ADDING COLUMN TO G_NOSMOOTH_TOTAL
-            newcol_nosmooth = np.zeros((num_rows_nosmooth, 1))
-            for i in range(len(newcol_nosmooth)):
-                if count <= i < count + (row_span_list[datanum][1] - row_span_list[datanum][0]):
-                    newcol_nosmooth[i] = leveling_sign
-            count = count + (row_span_list[datanum][1] - row_span_list[datanum][0])
-            G_nosmooth = np.hstack((G_nosmooth, newcol_nosmooth))
+    num_leveling_params = sum(1 for x in signs_list if x != 0)
+    G_ext = scipy.sparse.hstack((G_ext, build_offset_columns(G_ext.shape[0], row_span_list, signs_list)),
+                                format='csr')
+    G_nosmooth = scipy.sparse.hstack((G_nosmooth, build_offset_columns(G_nosmooth.shape[0], row_span_list,
+                                                                       signs_list)), format='csr')
     print("After adding lines for leveling offsets, shape(G): ", np.shape(G_ext), "\n------")
 
     # INVERT BIG-G: estimate slip and compute predicted displacement
     #####################################################################
-    slip_f = reg_nnls(G_ext, d_ext)   # the model
+    solver = config.get("solver", "auto")   # nnls, bvls, trf_sparse, or admm
+    admm_solver = solvers.AdmmSolver(G_ext) if solver == 'admm' else None   # factor once, reuse for checkerboard
+    response = solve_nnls(G_ext, d_ext, solver, admm_solver=admm_solver)
+    slip_f = response.x   # the model
+    diagnostics = [("inversion", response, G_ext)]
     pred_disp_f = G_nosmooth.dot(slip_f) * sig_total * weight_total   # the forward prediction
     print("Results:  ")
     print("G_ext:", np.shape(G_ext))
@@ -430,12 +679,9 @@ def beginning_calc(config):
 
     # get slip patch data for outputs
     #####################################################################
-    patches_pos_cart = [i.patch_to_user([0.5, 1.0, 0.0]) for i in patches]
-    patches_pos_geo = plotting_library.cartesian_to_geodetic(patches_pos_cart, bm)
-    patches_strike = [i.strike for i in patches]
-    patches_dip = [i.dip for i in patches]
-    patches_length = [i.length for i in patches]
-    patches_width = [i.width for i in patches]
+    patches_pos_geo, patches_strike = system["patches_pos_geo"], system["patches_strike"]
+    patches_dip, patches_length, patches_width = system["patches_dip"], system["patches_length"], \
+        system["patches_width"]
 
     # OUTPUT EACH SLIP INTERVAL
     for i in range(n_epochs):
@@ -483,7 +729,7 @@ def beginning_calc(config):
                                        output_file_list[filenum])
             print("Writing file %s " % output_file_list[filenum])
 
-    # Running a resolution test if desired. Only works for a single time interval.
+    # Running a resolution test if desired. Only "R" works for several time intervals, with one file per epoch.
     def res_output_phase(cardinal_res, resolution_output_file):
         # Function to write resolution test outputs on faults
         slippy.io.write_slip_data(patches_pos_geo, patches_strike, patches_dip, patches_length, patches_width,
@@ -491,18 +737,31 @@ def beginning_calc(config):
         print("Writing file %s " % resolution_output_file)
         return
 
-    if "R" in config["resolution_test"].split(',') and n_epochs == 1:
+    if "R" in config["resolution_test"].split(','):
         # Resolution Matrix form of analysis
-        res_output_file = config["output_dir"] + 'diag_resolution.txt'
-        r_diag, m_sig = resolution_tests.analyze_model_resolution_matrix(G_ext, len(G_nosmooth), config["output_dir"])
-        total_cardinal_res = resolution_tests.parse_empirical_res_outputs(m_sig, Ns_total, Ds, num_leveling_params)
-        res_output_phase(total_cardinal_res, res_output_file)
+        r_diag, m_sig = resolution_tests.analyze_model_resolution_matrix(
+            G_ext, G_nosmooth.shape[0], config["output_dir"], method=config.get("resolution_method", "auto"),
+            n_probes=config.get("resolution_probes", 100), full_matrix=config.get("resolution_full_matrix", False),
+            write_images=config.get("resolution_images", False))
+        for i, epoch in enumerate(config["epochs"].keys()):
+            suffix = '' if n_epochs == 1 else '_' + str(epoch)
+            res_output_file = config["output_dir"] + 'diag_resolution' + suffix + '.txt'
+            total_cardinal_res = resolution_tests.parse_empirical_res_outputs(m_sig, Ns_total, Ds, num_leveling_params,
+                                                                              n_epochs=n_epochs, epoch=i)
+            res_output_phase(total_cardinal_res, res_output_file)
     if 'avg_response' in config["resolution_test"].split(',') and n_epochs == 1:
         # Average geodetic response form of analysis
         res_output_file = config["output_dir"] + 'empirical_resolution.txt'
-        model_res = resolution_tests.empirical_slip_resolution(G_ext, total_fault_slip_basis)
+        model_res = resolution_tests.empirical_slip_resolution(G_ext.toarray(), total_fault_slip_basis)
         total_cardinal_res = resolution_tests.parse_empirical_res_outputs(model_res, Ns_total, Ds, num_leveling_params)
         res_output_phase(total_cardinal_res, res_output_file)
+    if 'bootstrap' in config["resolution_test"].split(',') and n_epochs == 1:
+        # Noise-floor form of analysis: spread of the model over many noise realizations of the data
+        res_output_file = config["output_dir"] + 'bootstrap_resolution.txt'
+        m_sig, _stats = resolution_tests.bootstrapped_model_resolution(G_ext, G_nosmooth, d_total, sig_total,
+                                                                       weight_total)
+        total_cardinal_res = resolution_tests.parse_empirical_res_outputs(m_sig, Ns_total, Ds, num_leveling_params)
+        res_output_phase(total_cardinal_res, res_output_file)
     if "checkerboard" in config["resolution_test"].split(',') and n_epochs == 1:
         # checkerboard test for one fault segment
         use_slip_penalty = 1   # do we impose a zeroth-order minimum-norm penalty?
@@ -518,14 +777,20 @@ def beginning_calc(config):
         pred_disp_checkerboard = G_nosmooth.dot(checkerboard_model) * sig_total  # forward prediction
         pred_disp_checkerboard = pred_disp_checkerboard + resolution_tests.get_random_error_vector(sig_total)
 
+        warm_start = slip_f if solver == 'admm' else None   # only admm can start from the best-fitting model
         if use_slip_penalty:  # reviewer asked what happens if we impose regularization
             zero_vector = np.zeros((len(d_ext) - len(pred_disp_checkerboard),))  # add zeros to pred_d for smoothing
             pred_d_ext = np.concatenate((pred_disp_checkerboard/sig_total, zero_vector))
-            recovered_checkerboard = reg_nnls(G_ext, pred_d_ext)  # the inverse model.
+            response = solve_nnls(G_ext, pred_d_ext, solver, x0=warm_start, admm_solver=admm_solver)
+            recovered_checkerboard = response.x  # the inverse model.
+            diagnostics.append(("checkerboard", response, G_ext))
         else:
             zero_vector = np.zeros((len(d_noa) - len(pred_disp_checkerboard),))  # add zeros to pred_d for smoothing
             pred_d_ext = np.concatenate((pred_disp_checkerboard/sig_total, zero_vector))
-            recovered_checkerboard = reg_nnls(G_noa, pred_d_ext)  # the inverse model.
+            x0 = None if warm_start is None else warm_start[:G_noa.shape[1]]
+            response = solve_nnls(G_noa, pred_d_ext, solver, x0=x0)
+            recovered_checkerboard = response.x  # the inverse model.
+            diagnostics.append(("checkerboard", response, G_noa))
             num_leveling_params = 0
         total_cardinal_res = resolution_tests.parse_checkerboard_res_outputs(recovered_checkerboard, Ns_total, Ds,
                                                                              total_fault_slip_basis,
@@ -534,4 +799,5 @@ def beginning_calc(config):
 
     # MISC OUTPUTS: Graph of big G (with all smoothing parameters inside)
     graph_big_G(config, G_ext)
+    write_solver_diagnostics(diagnostics, os.path.join(config['output_dir'], "solver_diagnostics.txt"))
     return
@@ -10,42 +10,57 @@ Option 3: invert 100 iterations of the data, and take the standard deviation of
 
 import numpy as np
 import matplotlib.pyplot as plt
-import scipy
+import scipy.sparse
 import os
 import slippy.basis
+from ..Inversion import noise, resampling, resolution, solvers
 
 
-def analyze_model_resolution_matrix(G, num_obs, outdir):
+def analyze_model_resolution_matrix(G, num_obs, outdir, method='auto', n_probes=100, rank=None,
+                                    full_matrix=False, write_images=False, seed=0):
     """
     Simply analyze the resolution matrix R (Menke, 1989)
     Before leveling offsets have been added.
-    """
-    # Show big-G matrix for all times, all data
-    plt.figure(figsize=(12, 8), dpi=300)
-    plt.imshow(G, vmin=-0.02, vmax=0.02, aspect=1)
-    plt.savefig(os.path.join(outdir, "G_resolution.png"))
-
-    # Model Resolution Matrix
-    Ggi = np.array(scipy.linalg.pinv(G))  # Replace all smoothing with zeros for second half of this expression
-    G_nosmoothing = G.copy()
-    G_nosmoothing[num_obs:, :] = 0
-    Rmatrix = np.dot(Ggi, G_nosmoothing)  # R matrix
+    diag(R) and the model standard deviations come from Inversion.resolution without forming pinv(G).
+    The full R is only formed if full_matrix is True, and the large images of G and R are only written on request.
 
-    # Model Covariance values
-    covb_slip = np.dot(Ggi, Ggi.T)
-    sig_slipb = np.sqrt(np.diag(covb_slip))
+    :param G: weighted G matrix with smoothing rows, dense or sparse
+    :param num_obs: number of data rows, which come before the smoothing rows
+    :param outdir: output directory for the images
+    :param method: 'auto', 'exact', 'randomized', or 'hutchinson'; see resolution.estimate_model_resolution
+    :param n_probes: number of probe vectors for the hutchinson method
+    :param rank: number of singular vectors for the randomized method
+    :param full_matrix: bool, also form the full R matrix
+    :param write_images: bool, write 300-dpi images of G, and of R if it was formed
+    :param seed: seed for the random probes or randomized SVD
+    :returns: diag(R), model standard deviations
+    """
+    r_diag, sig_slipb = resolution.estimate_model_resolution(G, num_obs, method=method, n_probes=n_probes, rank=rank,
+                                                             seed=seed)
 
     # Viewing the diagonal elements of R (might be helpful?)
     plt.figure()
-    plt.plot(np.diag(Rmatrix))
+    plt.plot(r_diag)
     plt.savefig(os.path.join(outdir, 'model_resolution_diagonal.png'))
 
-    # Viewing the total picture of R: shows the model resolution along the diagonal.
-    plt.figure(figsize=(12, 8), dpi=300)
-    plt.imshow(Rmatrix, aspect=1)
-    plt.colorbar()
-    plt.savefig(os.path.join(outdir, "Rmatrix.png"))
-    return np.diag(Rmatrix), sig_slipb
+    if write_images:
+        # Show big-G matrix for all times, all data
+        plt.figure(figsize=(12, 8), dpi=300)
+        plt.imshow(G.toarray() if scipy.sparse.issparse(G) else G, vmin=-0.02, vmax=0.02, aspect=1)
+        plt.savefig(os.path.join(outdir, "G_resolution.png"))
+
+    if full_matrix:
+        Rmatrix = resolution.model_resolution_matrix(G, num_obs, rank=rank if method == 'randomized' else None,
+                                                     seed=seed)
+        print("Writing %s" % os.path.join(outdir, "Rmatrix.txt"))
+        np.savetxt(os.path.join(outdir, "Rmatrix.txt"), Rmatrix)
+        if write_images:
+            # Viewing the total picture of R: shows the model resolution along the diagonal.
+            plt.figure(figsize=(12, 8), dpi=300)
+            plt.imshow(Rmatrix, aspect=1)
+            plt.colorbar()
+            plt.savefig(os.path.join(outdir, "Rmatrix.png"))
+    return r_diag, sig_slipb
 
 
 def empirical_slip_resolution(G, total_fault_slip_basis):
@@ -79,7 +94,7 @@ def empirical_slip_resolution(G, total_fault_slip_basis):
     return resolution_vector
 
 
-def parse_empirical_res_outputs(res_f, Ns_total, Ds,  num_lev_offsets):
+def parse_empirical_res_outputs(res_f, Ns_total, Ds,  num_lev_offsets, n_epochs=1, epoch=0):
     """
     Rotate the resolution into dip slip and strike slip components.
     res_f: resolution vector
@@ -87,9 +102,11 @@ def parse_empirical_res_outputs(res_f, Ns_total, Ds,  num_lev_offsets):
     Ds: number of dimensions in the basis
     total_fault_slip_basis:
     num_lev_offsets: the last n model parameters are leveling offsets that don't get plotted on faults
+    n_epochs: number of epochs in res_f, each with its own block of fault params, as in parse_slip_outputs
+    epoch: index of the epoch to return
     """
-    n_params = int(len(res_f) - num_lev_offsets)  # num fault params
-    res = res_f[0:n_params].reshape((Ns_total, Ds))  # ASSUMES ALL FAULTS HAVE SAME NUMBER OF BASIS VECTORS
+    n_params = int((len(res_f) - num_lev_offsets) / n_epochs)  # num fault params in each epoch
+    res = res_f[epoch*n_params:(epoch+1)*n_params].reshape((Ns_total, Ds))  # ASSUMES SAME NUMBER OF BASIS VECTORS
     cardinal_res = np.hstack((res, np.zeros((len(res), 1))))  # adding the "tensile"
     return cardinal_res
 
@@ -109,18 +126,40 @@ def parse_checkerboard_res_outputs(res_f, Ns_total, Ds, total_fault_slip_basis,
     return cardinal_res
 
 
-def bootstrapped_model_resolution(_G_total, _G_nosmooth, _d, _sig, _weights):
+def bootstrapped_model_resolution(G_total, G_nosmooth, d, sig, weights, n_realizations=100, lb=0, ub=np.inf,
+                                  num_workers=None, seed=0):
     """
-    An absolute measure (in mm) of model resolution on faults
+    An absolute measure (in the units of the model) of model resolution on faults
     Run the model a hundred times with random noise realizations. Get the noise floor.
-    We probably need G_total to have smoothing here, while G_nosmooth does not.
-    Useful lines:
-    slip_f = reg_nnls(G_total, d_total)   # slip_f is the model
-    pred_disp_f = G_nosmooth_total.dot(slip_f) * sig_total * weight_total   # the forward prediction
-    I'm now thinking this is an interesting problem - not as useful as I thought
+    G_total has smoothing here, while G_nosmooth does not; only the data rows (the first len(G_nosmooth)) get noise.
+    The rows of G are divided by sig * weights, so the noise on each weighted data row has standard deviation 1/weight.
+    Each realization is re-solved with the same bounds as the best-fitting model (slip_f = reg_nnls(G_total, d_total)
+    by default bounds); realizations that do not converge are left out and counted in stats.n_unconverged.
     This depends on the input data
+
+    :param G_total: weighted G matrix with smoothing rows
+    :param G_nosmooth: weighted G matrix of the data rows only
+    :param d: weighted data vector, either for the data rows only or with zeros for the smoothing rows
+    :param sig: uncertainty of each data row
+    :param weights: weight of each data row
+    :param n_realizations: int
+    :param lb: lower bounds on the model, 0 for nnls
+    :param ub: upper bounds on the model
+    :returns: standard deviation of each model parameter, and the RunningStats of all realizations
     """
-    return
+    num_obs = np.shape(G_nosmooth)[0]
+    d_ext = np.concatenate((d, np.zeros((np.shape(G_total)[0] - len(d),))))
+    data_rows = np.arange(len(d_ext)) < num_obs
+    noise_sigmas = np.zeros(np.shape(d_ext))
+    noise_sigmas[:num_obs] = np.divide(1.0, weights, out=np.zeros(num_obs), where=np.asarray(weights) != 0)
+    print("Bootstrapping model resolution with %d noise realizations on %d data (median sigma %f)" %
+          (n_realizations, num_obs, np.median(sig)))
+    lb = np.broadcast_to(np.asarray(lb, dtype=float), (np.shape(G_total)[1],))
+    ub = np.broadcast_to(np.asarray(ub, dtype=float), (np.shape(G_total)[1],))
+    m_best = solvers.bounded_least_squares(G_total, d_ext, lb, ub, verbose=False).x
+    stats = resampling.run_resampling(G_total, d_ext, lb, ub, m_best, noise_sigmas=noise_sigmas, data_rows=data_rows,
+                                      n_realizations=n_realizations, num_workers=num_workers, seed=seed)
+    return stats.get_std(), stats
 
 
 def get_checkerboard_vector(patches_f, Ds, num_extra_params, num_width, fault_num_array, checker_width=3, fault_num=0):
@@ -216,9 +255,6 @@ def corner_checker_vector(patches_f, Ds, num_extra_params, num_width, fault_num_
     return checkerboard_vector
 
 
-def get_random_error_vector(sigma_vector):
+def get_random_error_vector(sigma_vector, seed=None):
     """Generate a vector of random numbers drawn from distributions with sigma from sigma vector"""
-    error_vector = np.zeros(np.shape(sigma_vector))
-    for i in range(len(sigma_vector)):
-        error_vector[i] = np.random.normal(scale=sigma_vector[i])
-    return error_vector
+    return noise.uncorrelated_noise(sigma_vector, seed=seed)
@@ -11,53 +11,68 @@ import elastic_stresses_py.PyCoulomb.inputs_object as inputs_object
 import geodesy_modeling.InSAR_1D_Object as InSAR_1D
 from geodesy_modeling.InSAR_1D_Object.class_model import Insar1dObject
 import geodesy_modeling.Inversion.inversion_tools as inv_tools
+import geodesy_modeling.Inversion.solvers as solvers
 import geodesy_modeling.Inversion.GfElement.rw_insar_gfs as rw_gf
-from geodesy_modeling.Inversion.GfElement.GfElement import GfElement
-import numpy as np
-import scipy.optimize
+from geodesy_modeling.Inversion.GfElement.gf_cache import GfCache
+import geodesy_modeling.Inversion.GfElement.gf_engine as gf_engine
 import matplotlib.pyplot as plt
+import numpy as np
+import scipy.sparse
 import argparse
+import functools
 import json
 import subprocess
 import os
 
+ELASTIC_PARAMS = {"code": "okada_dc3d", "mu": 30e9, "lame1": 30e9, "zerolon": -115.8, "zerolat": 33.1}
+
 
 def configure():
     p = argparse.ArgumentParser(description='''Inversion of geodetic data''')
     p.add_argument('--smoothing', type=float, help='''strength of Laplacian smoothing constraint''')
     p.add_argument('--outdir', type=str, help='''Output directory''')
+    p.add_argument('--gf_source', type=str, choices=['file', 'compute'], default='file',
+                   help='''Read pre-computed GFs from gf_file, or compute them (cached) and write gf_file first''')
     my_exp_dict = vars(p.parse_args())
     my_exp_dict["obs_desc"] = "../../_4_Downsample_unw/igram_sum/pixels_filtered_m.txt"
     my_exp_dict["fault_file"] = "../Get_Fault_Model/model_fault_patches.txt"
     my_exp_dict["smoothing_length"] = 6  # smooth adjacent patches with some wiggle room
+    my_exp_dict["gf_file"] = "desc_insar_gfs.npy"  # converted from desc_insar_gfs.txt on the first read
+    my_exp_dict["gf_cache_dir"] = "gf_cache"  # computed GF columns, reused when geometry and data are unchanged
     os.makedirs(my_exp_dict['outdir'], exist_ok=True)  # """Set up an experiment directory."""
     with open(my_exp_dict["outdir"] + "/configs_used.txt", 'w') as fp:
         json.dump(my_exp_dict, fp, indent=4)
     return my_exp_dict
 
 
-def compute_insar_gf_elements(fault_file: str, insar_object: Insar1dObject):
-    """Create a list of fault elements and their associated InSAR GF's for use in inversion. This is cool! """
-    insar_GF_elements = []
+def compute_enu_column(changed_slip_fault, all_disp_points):
+    """ENU displacement at every InSAR point due to unit slip on one patch, shape (n_points, 3)."""
+    pycoulomb_fault = changed_slip_fault.fault_object_to_coulomb_fault(zerolon_system=ELASTIC_PARAMS["zerolon"],
+                                                                       zerolat_system=ELASTIC_PARAMS["zerolat"])
+    inputs = inputs_object.input_obj.configure_default_displacement_input(source_object=[pycoulomb_fault],
+                                                                          zerolon=ELASTIC_PARAMS["zerolon"],
+                                                                          zerolat=ELASTIC_PARAMS["zerolat"], bbox=())
+    params = PyCoulomb.configure_calc.Params(mu=ELASTIC_PARAMS["mu"], lame1=ELASTIC_PARAMS["lame1"])
+    model_pts = PyCoulomb.run_dc3d.compute_ll_def(inputs, params, all_disp_points)
+    return np.array([[pt.dE_obs, pt.dN_obs, pt.dU_obs] for pt in model_pts])
+
+
+def compute_insar_gf_elements(fault_file: str, insar_object: Insar1dObject, cache_dir=None, num_workers=None):
+    """
+    Create a list of fault elements and their associated InSAR GF's for use in inversion. This is cool!
+    Patches are computed in parallel, and if cache_dir is given, only the patches not already cached get computed.
+    """
     fault_patches = fso.file_io.io_slippy.read_slippy_distribution(fault_file)
-    all_disp_points = insar_object.get_disp_points()   # get the locations of InSAR points
-
-    for patch in fault_patches:
-        changed_slip_fault = patch.change_fault_slip(new_slip=1, new_rake=180)
-        pycoulomb_fault = changed_slip_fault.fault_object_to_coulomb_fault(zerolon_system=-115.8, zerolat_system=33.1)
-        inputs = inputs_object.input_obj.configure_default_displacement_input(source_object=[pycoulomb_fault],
-                                                                              zerolon=-115.8, zerolat=33.1, bbox=())
-        params = PyCoulomb.configure_calc.Params(mu=30e9, lame1=30e9)
-        model_pts = PyCoulomb.run_dc3d.compute_ll_def(inputs, params, all_disp_points)
-
-        # PROJECT 3D DISPLACEMENTS INTO LOS. LIST OF FLOATS.
-        los_defo = [model_pts[i].project_into_los(insar_object.lkv_E[i], insar_object.lkv_N[i],
-                                                  insar_object.lkv_U[i]) for _i in range(len(all_disp_points))]
-
-        model_pts = dpo.utilities.with_easts_as(model_pts, los_defo)
-        model_pts = dpo.utilities.mult_disp_points_by(model_pts, -1)  # sign convention
-        insar_GF_elements.append(GfElement(disp_points=model_pts, fault_dict_list=[changed_slip_fault],
-                                           units='m', param_name='shf'))
+    unit_patches = [rw_gf.unit_slip_patch(patch) for patch in fault_patches]  # slip=1, rake=180
+    compute_function = functools.partial(compute_enu_column, all_disp_points=insar_object.get_disp_points())
+    cache = GfCache(cache_dir) if cache_dir is not None else None
+    enu_array = gf_engine.compute_gf_matrix(unit_patches, compute_function, insar_object.lon, insar_object.lat,
+                                            num_workers=num_workers, cache=cache, elastic_params=ELASTIC_PARAMS)
+    # PROJECT 3D DISPLACEMENTS INTO LOS, all patches at once: (n_patches, n_points, 3) -> (n_points, n_patches)
+    los_array = insar_object.project_enu_into_los(np.transpose(enu_array, (2, 0, 1)), sign=-1).T  # sign convention
+    insar_GF_elements = rw_gf.gf_elements_from_los_array(insar_object.lon, insar_object.lat, los_array,
+                                                         fault_patches, param_name='shf', lower_bound=0,
+                                                         upper_bound=0.05)
     print("Computed Green's functions for %d patches" % len(insar_GF_elements))
     return insar_GF_elements
 
@@ -66,8 +81,8 @@ def read_gf_elements(fault_file: str, gf_file: str):
     """Read a list of fault triangle elements and their associated GF's for use in inversion. """
     print("Reading pre-computed InSAR Green's functions.")
     fault_patches = fso.file_io.io_slippy.read_slippy_distribution(fault_file)
-    insar_GF_elements = rw_gf.read_insar_greens_functions(gf_file, fault_patches, param_name='shf', lower_bound=0,
-                                                          upper_bound=0.05)
+    insar_GF_elements = rw_gf.read_insar_gf_file(gf_file, fault_patches, param_name='shf', lower_bound=0,
+                                                 upper_bound=0.05)  # .txt or .npy
     return insar_GF_elements
 
 
@@ -77,30 +92,27 @@ if __name__ == "__main__":
     desc_insar = InSAR_1D.inputs.inputs_txt(exp_dict['obs_desc'])  # get list of insar data
     obs_disp_pts = desc_insar.get_disp_points()  # get locations and data of InSAR points
 
-    # ONE TIME: Compute the Green's Functions
-    # GF_elements = compute_insar_gf_elements(exp_dict['fault_file'], desc_insar)
-    # rw_gf.write_insar_greens_functions(GF_elements, "desc_insar_gfs.txt")
-
-    GF_elements = read_gf_elements(exp_dict['fault_file'], "desc_insar_gfs.txt")  # get GFs
+    if exp_dict['gf_source'] == 'compute':  # Compute the Green's Functions, reusing any in the GF cache
+        GF_elements = compute_insar_gf_elements(exp_dict['fault_file'], desc_insar, cache_dir=exp_dict['gf_cache_dir'])
+        rw_gf.write_insar_greens_functions_binary(GF_elements, exp_dict['gf_file'],
+                                                  (desc_insar.lkv_E, desc_insar.lkv_N, desc_insar.lkv_U))
+    else:
+        GF_elements = read_gf_elements(exp_dict['fault_file'], exp_dict['gf_file'])  # get pre-computed GFs
 
     # COMPUTE STAGE: INVERSE.
-    list_of_gf_columns = []
-    for gf in GF_elements:
-        G_one_col = inv_tools.buildG_column(gf.disp_points, obs_disp_pts)  # for one fault model parameter
-        list_of_gf_columns.append(G_one_col)
-    G = np.concatenate(tuple(list_of_gf_columns), axis=1)
-    obs, sigmas = inv_tools.build_obs_vector(obs_disp_pts)
+    G, obs, sigmas = inv_tools.build_G_and_obs_vector(obs_disp_pts, GF_elements)
     G /= sigmas[:, None]
     w_obs = obs / sigmas
-    G, w_obs, sigmas = inv_tools.build_smoothing(GF_elements, ('shf',), exp_dict["smoothing"],
-                                                 exp_dict["smoothing_length"], G, w_obs, sigmas)
-    plt.imshow(G, vmin=-3, vmax=3)
-    plt.savefig(outdir+"/G_matrix.png")
+    G_smoothing = inv_tools.build_smoothing_matrix(GF_elements, ('shf',), exp_dict["smoothing_length"])
+    G_smoothing = G_smoothing * exp_dict["smoothing"]  # sparse, appended beneath G by the solver
 
     # Money line: Constrained inversion
     lb, ub = [x.lower_bound for x in GF_elements], [x.upper_bound for x in GF_elements]
-    response = scipy.optimize.lsq_linear(G, w_obs, bounds=(lb, ub), max_iter=1500, method='bvls')
+    response, G_ext, _ = solvers.solve_regularized_system(G, w_obs, lb, ub, [G_smoothing],
+                                                         max_iter=1500)  # bvls unless very large
     M_opt = response.x  # parameters of best-fitting model
+    plt.imshow(G_ext.toarray() if scipy.sparse.issparse(G_ext) else G_ext, vmin=-3, vmax=3)
+    plt.savefig(outdir+"/G_matrix.png")
 
     model_disp_pts = inv_tools.forward_disp_points_predictions(G, M_opt, sigmas, obs_disp_pts)
     resid = dpo.utilities.subtract_disp_points(obs_disp_pts, model_disp_pts)   # make residual points
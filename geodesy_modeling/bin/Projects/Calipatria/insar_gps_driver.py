@@ -8,56 +8,67 @@ import elastic_stresses_py.PyCoulomb as PyCoulomb
 import elastic_stresses_py.PyCoulomb.fault_slip_triangle as fst
 import elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import geodesy_modeling.Inversion.inversion_tools as inv_tools
+import geodesy_modeling.Inversion.solvers as solvers
 import geodesy_modeling.InSAR_1D_Object as InSAR_1D
 import geodesy_modeling.Inversion.GfElement.GfElement as GF_element
 import geodesy_modeling.Inversion.GfElement.rw_insar_gfs as rw_insar_gfs
+from geodesy_modeling.Inversion.GfElement.gf_cache import GfCache
+import geodesy_modeling.Inversion.GfElement.gf_engine as gf_engine
 from geodesy_modeling.InSAR_1D_Object.class_model import Insar1dObject
 import Tectonic_Utils.seismo.moment_calculations as mo
-import numpy as np
-import scipy.optimize
 import matplotlib.pyplot as plt
+import numpy as np
+import scipy.sparse
 import argparse
+import functools
 import json
 import subprocess
 import os
 
+ELASTIC_PARAMS = {"code": "triangle_okada", "poisson_ratio": 0.25}
+
 
 def configure():
     p = argparse.ArgumentParser(description='''Inversion of geodetic data''')
     p.add_argument('--smoothing', type=float, help='''strength of Laplacian smoothing constraint''')
     p.add_argument('--outdir', type=str, help='''Output directory''')
+    p.add_argument('--gf_source', type=str, choices=['file', 'compute'], default='file',
+                   help='''Read pre-computed GFs from the .npy files, or compute them (cached) and write them first''')
     one_exp_dict = vars(p.parse_args())
     one_exp_dict["obs_desc"] = "../../../InSAR_Exps/sample_InSAR_on_roads/output/avg_desc.txt"
     one_exp_dict["obs_asc"] = "../../../InSAR_Exps/sample_InSAR_on_roads/output/avg_asc.txt"
     one_exp_dict["fault_file"] = "../../../../_Data/Lohman_Fault_Geom/forK.mat"
     one_exp_dict["smoothing_length"] = 2  # smooth adjacent patches with some wiggle room (2 for salton sea)
+    one_exp_dict["gf_cache_dir"] = "gf_cache"  # computed GF columns, reused when geometry and data are unchanged
     os.makedirs(one_exp_dict['outdir'], exist_ok=True)  # """Set up an experiment directory."""
     with open(one_exp_dict["outdir"] + "/configs_used.txt", 'w') as fp:
         json.dump(one_exp_dict, fp, indent=4)
     return one_exp_dict
 
 
-def compute_insar_gf_elements_kalin(fault_file: str, insar_object: Insar1dObject):
-    """Create a list of fault triangle elements and their associated InSAR GF's for use in inversion. """
-    tri_gf_elements = []
+def compute_enu_column_kalin(changed_slip, all_disp_points):
+    """ENU displacement at every InSAR point due to unit slip on one triangle, shape (n_points, 3)."""
+    model_pts = fst.triangle_okada.compute_disp_points_from_triangles([changed_slip], all_disp_points,
+                                                                      poisson_ratio=ELASTIC_PARAMS["poisson_ratio"])
+    return np.array([[pt.dE_obs, pt.dN_obs, pt.dU_obs] for pt in model_pts])
+
+
+def compute_insar_gf_elements_kalin(fault_file: str, insar_object: Insar1dObject, cache_dir=None, num_workers=None):
+    """
+    Create a list of fault triangle elements and their associated InSAR GF's for use in inversion.
+    Triangles are computed in parallel, and if cache_dir is given, only the triangles not already cached get computed.
+    """
     fault_tris = fst.file_io.io_other.read_brawley_lohman_2005(fault_file)
-    all_disp_points = insar_object.get_disp_points()   # get the locations of InSAR points
-    for tri in fault_tris:
-        changed_slip = tri.change_fault_slip(rtlat=1, dipslip=0, tensile=0)
-        changed_slip = changed_slip.change_reference_loc()
-        model_pts = fst.triangle_okada.compute_disp_points_from_triangles([changed_slip], all_disp_points,
-                                                                          poisson_ratio=0.25)
-        # PROJECT 3D DISPLACEMENTS INTO LOS
-        los_defo = []
-        for j in range(len(all_disp_points)):
-            x = model_pts[j].project_into_los(insar_object.lkv_E[j], insar_object.lkv_N[j], insar_object.lkv_U[j])
-            los_defo.append(x)
-
-        model_pts = dpo.utilities.with_easts_as(model_pts, los_defo)
-        model_pts = dpo.utilities.mult_disp_points_by(model_pts, -1)  # sign convention
-        tri_gf_elements.append(
-            GF_element.GfElement(disp_points=model_pts, fault_dict_list=[changed_slip], units='m',
-                                 param_name='kalin', lower_bound=-1, upper_bound=0, slip_penalty=0))
+    unit_tris = [rw_insar_gfs.unit_slip_patch(tri) for tri in fault_tris]
+    compute_function = functools.partial(compute_enu_column_kalin, all_disp_points=insar_object.get_disp_points())
+    cache = GfCache(cache_dir) if cache_dir is not None else None
+    enu_array = gf_engine.compute_gf_matrix(unit_tris, compute_function, insar_object.lon, insar_object.lat,
+                                            num_workers=num_workers, cache=cache, elastic_params=ELASTIC_PARAMS)
+    # PROJECT 3D DISPLACEMENTS INTO LOS, all patches at once: (n_patches, n_points, 3) -> (n_points, n_patches)
+    los_array = insar_object.project_enu_into_los(np.transpose(enu_array, (2, 0, 1)), sign=-1).T  # sign convention
+    tri_gf_elements = rw_insar_gfs.gf_elements_from_los_array(insar_object.lon, insar_object.lat, los_array,
+                                                              fault_tris, param_name='kalin', lower_bound=-1,
+                                                              upper_bound=0)
     print("Computed Green's functions for %d triangles" % len(tri_gf_elements))
     return tri_gf_elements
 
@@ -66,8 +77,8 @@ def read_gf_elements_kalin(fault_file: str, gf_file: str):
     """Read a list of fault triangle elements and their associated GF's for use in inversion. """
     print("Reading pre-computed InSAR Green's functions.")
     fault_tris = fst.file_io.io_other.read_brawley_lohman_2005(fault_file)
-    kalin_gf_elements = rw_insar_gfs.read_insar_greens_functions(gf_file, fault_tris, param_name='kalin',
-                                                                 lower_bound=-1, upper_bound=0)
+    kalin_gf_elements = rw_insar_gfs.read_insar_gf_file(gf_file, fault_tris, param_name='kalin', lower_bound=-1,
+                                                        upper_bound=0)  # .txt or .npy
     return kalin_gf_elements
 
 
@@ -85,10 +96,12 @@ def write_misfit_report(outfile, obs_pts, model_pts):
 
 def compute_all_the_GFS(desc_pts: Insar1dObject, asc_pts: Insar1dObject):
     """ One-time function to compute and write ascending and descending green's functions (takes a few minutes)."""
-    GF_elements_descend = compute_insar_gf_elements_kalin(exp_dict['fault_file'], desc_pts)
-    rw_insar_gfs.write_insar_greens_functions(GF_elements_descend, "desc_insar_gfs.txt")
-    GF_elements_ascend = compute_insar_gf_elements_kalin(exp_dict['fault_file'], asc_pts)
-    rw_insar_gfs.write_insar_greens_functions(GF_elements_ascend, "asc_insar_gfs.txt")
+    GF_elements_descend = compute_insar_gf_elements_kalin(exp_dict['fault_file'], desc_pts, exp_dict['gf_cache_dir'])
+    rw_insar_gfs.write_insar_greens_functions_binary(GF_elements_descend, "desc_insar_gfs.npy",
+                                                     (desc_pts.lkv_E, desc_pts.lkv_N, desc_pts.lkv_U))
+    GF_elements_ascend = compute_insar_gf_elements_kalin(exp_dict['fault_file'], asc_pts, exp_dict['gf_cache_dir'])
+    rw_insar_gfs.write_insar_greens_functions_binary(GF_elements_ascend, "asc_insar_gfs.npy",
+                                                     (asc_pts.lkv_E, asc_pts.lkv_N, asc_pts.lkv_U))
     return
 
 
@@ -111,31 +124,29 @@ if __name__ == "__main__":
     asc_insar = InSAR_1D.inputs.inputs_txt(exp_dict['obs_asc'])
     obs_disp_pts_desc = desc_insar.get_disp_points()  # get locations and data of InSAR points
     obs_disp_pts_asc = asc_insar.get_disp_points()
-    GF_elements_desc = read_gf_elements_kalin(exp_dict['fault_file'], "desc_insar_gfs.txt")  # get GFs
-    GF_elements_asc = read_gf_elements_kalin(exp_dict['fault_file'], "asc_insar_gfs.txt")
+    if exp_dict['gf_source'] == 'compute':
+        compute_all_the_GFS(desc_insar, asc_insar)  # writes the .npy files read below, reusing any in the GF cache
+    GF_elements_desc = read_gf_elements_kalin(exp_dict['fault_file'], "desc_insar_gfs.npy")  # .txt converted once
+    GF_elements_asc = read_gf_elements_kalin(exp_dict['fault_file'], "asc_insar_gfs.npy")
 
     # SWITCH: Determine which data goes inside the inversion
     GF_elements = combine_two_matching_lists_of_GF_elements(GF_elements_desc, GF_elements_asc)  # if multiple datasets
     obs_disp_pts = obs_disp_pts_desc + obs_disp_pts_asc  # if multiple datasets
 
     # # COMPUTE STAGE: INVERSE.
-    list_of_gf_columns = []
-    for gf in GF_elements:
-        G_one_col = inv_tools.buildG_column(gf.disp_points, gf.disp_points)  # for one fault model parameter
-        list_of_gf_columns.append(G_one_col)
-    G = np.concatenate(tuple(list_of_gf_columns), axis=1)
-    obs, sigmas = inv_tools.build_obs_vector(obs_disp_pts)
+    G, obs, sigmas = inv_tools.build_G_and_obs_vector(obs_disp_pts, GF_elements)
     G /= sigmas[:, None]
     w_obs = obs / sigmas
-    G, w_obs, sigmas = inv_tools.build_smoothing(GF_elements, ('kalin',), exp_dict["smoothing"],
-                                                 exp_dict["smoothing_length"], G, w_obs, sigmas)
-    plt.imshow(G, vmin=-3, vmax=3)
-    plt.savefig(outdir+"/G_matrix.png")
+    G_smoothing = inv_tools.build_smoothing_matrix(GF_elements, ('kalin',), exp_dict["smoothing_length"])
+    G_smoothing = G_smoothing * exp_dict["smoothing"]  # sparse, appended beneath G by the solver
 
     # Money line: Constrained inversion
     lb, ub = [x.lower_bound for x in GF_elements], [x.upper_bound for x in GF_elements]
-    response = scipy.optimize.lsq_linear(G, w_obs, bounds=(lb, ub), max_iter=1500, method='bvls')
+    response, G_ext, _ = solvers.solve_regularized_system(G, w_obs, lb, ub, [G_smoothing],
+                                                         max_iter=1500)  # bvls unless very large
     M_opt = response.x  # parameters of best-fitting model
+    plt.imshow(G_ext.toarray() if scipy.sparse.issparse(G_ext) else G_ext, vmin=-3, vmax=3)
+    plt.savefig(outdir+"/G_matrix.png")
     #
     model_disp_pts = inv_tools.forward_disp_points_predictions(G, M_opt, sigmas, obs_disp_pts)
     resid = dpo.utilities.subtract_disp_points(obs_disp_pts, model_disp_pts)   # make residual points
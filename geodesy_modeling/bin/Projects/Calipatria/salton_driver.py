@@ -9,10 +9,10 @@ import elastic_stresses_py.PyCoulomb.fault_slip_triangle as fst
 import elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import elastic_stresses_py.PyCoulomb.fault_slip_object as fso
 import geodesy_modeling.Inversion.inversion_tools as inv_tools
+import geodesy_modeling.Inversion.solvers as solvers
 import Tectonic_Utils.seismo.moment_calculations as mo
-import numpy as np
-import scipy.optimize
 import matplotlib.pyplot as plt
+import scipy.sparse
 import argparse
 import json
 import subprocess
@@ -67,23 +67,19 @@ if __name__ == "__main__":
     GF_elements = read_gf_elements_kalin(exp_dict["fault_file"], obs_disp_pts)
 
     # COMPUTE STAGE: INVERSE.
-    list_of_gf_columns = []
-    for gf in GF_elements:
-        G_one_col = inv_tools.buildG_column(gf.disp_points, obs_disp_pts)  # for one fault model parameter
-        list_of_gf_columns.append(G_one_col)
-    G = np.concatenate(tuple(list_of_gf_columns), axis=1)
-    obs, sigmas = inv_tools.build_obs_vector(obs_disp_pts)
+    G, obs, sigmas = inv_tools.build_G_and_obs_vector(obs_disp_pts, GF_elements)
     G /= sigmas[:, None]
     w_obs = obs / sigmas
-    G, w_obs, sigmas = inv_tools.build_smoothing(GF_elements, ('kalin',), exp_dict["smoothing"],
-                                                 exp_dict["smoothing_length"], G, w_obs, sigmas)
-    plt.imshow(G, vmin=-3, vmax=3)
-    plt.savefig(outdir+"/G_matrix.png")
+    G_smoothing = inv_tools.build_smoothing_matrix(GF_elements, ('kalin',), exp_dict["smoothing_length"])
+    G_smoothing = G_smoothing * exp_dict["smoothing"]  # sparse, appended beneath G by the solver
 
     # Money line: Constrained inversion
     lb, ub = [x.lower_bound for x in GF_elements], [x.upper_bound for x in GF_elements]
-    response = scipy.optimize.lsq_linear(G, w_obs, bounds=(lb, ub), max_iter=1500, method='bvls')
+    response, G_ext, _ = solvers.solve_regularized_system(G, w_obs, lb, ub, [G_smoothing],
+                                                         max_iter=1500)  # bvls unless very large
     M_opt = response.x  # parameters of best-fitting model
+    plt.imshow(G_ext.toarray() if scipy.sparse.issparse(G_ext) else G_ext, vmin=-3, vmax=3)
+    plt.savefig(outdir+"/G_matrix.png")
 
     model_disp_pts = inv_tools.forward_disp_points_predictions(G, M_opt, sigmas, obs_disp_pts)
     resid = dpo.utilities.subtract_disp_points(obs_disp_pts, model_disp_pts)   # make residual points
@@ -7,7 +7,6 @@ Depends on Humboldt Bay project code for some functions. It will not work on a d
 """
 
 import numpy as np
-import scipy.optimize
 import json
 import sys
 import argparse
@@ -15,7 +14,11 @@ import os
 import elastic_stresses_py.PyCoulomb.fault_slip_object as library
 import elastic_stresses_py.PyCoulomb as PyCoulomb
 import geodesy_modeling.Inversion.inversion_tools as inv_tools
+import geodesy_modeling.Inversion.solvers as solvers
+import geodesy_modeling.Inversion.linear_system as linear_system
+import geodesy_modeling.Inversion.resampling as resampling
 import geodesy_modeling.Inversion.metrics as metrics
+import geodesy_modeling.Inversion.l_curve as l_curve
 import elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import elastic_stresses_py.PyCoulomb.disp_points_object.io_gmt as dpo_out
 import geodesy_modeling.Inversion.GfElement.GfElement as GF_element
@@ -55,6 +58,8 @@ def configure():
     p.add_argument('--inverse_dir', type=str, help='''Way to get to the home directory of inverses''')
     p.add_argument('--lsfrev_min', type=str, help='''Constraint on little salmon reverse slip component, minimum cm''')
     p.add_argument('--ghost_transient_mult', type=str, help='''Ghost transient multiplier, cm''')
+    p.add_argument('--n_realizations', type=int, help='''Number of noise realizations for parameter uncertainties''')
+    p.add_argument('--smoothing_sweep', type=float, nargs='+', help='''Smoothing strengths for an L-curve''')
     exp_dict = vars(p.parse_args())
 
     if os.path.exists(exp_dict["configfile"]):
@@ -106,26 +111,24 @@ def read_hb_fault_gf_elements(exp_dict):
     for i in range(len(exp_dict["exp_faults"])):  # for each fault
         fault_name = exp_dict["exp_faults"][i]
         if fault_name == "CSZ_dist":  # Reading for distributed CSZ patches as unit slip.
-            csz_GF_elements, maxslip = gf_element_rw.read_distributed_GF_static1d(exp_dict["inverse_dir"] +
-                                                                                  exp_dict["faults"]["CSZ"]["GF"],
-                                                                                  exp_dict["inverse_dir"] +
-                                                                                  exp_dict["faults"]["CSZ"]["geometry"],
-                                                                                  exp_dict["lonlatfile"],
-                                                                                  unit_slip=True,
-                                                                                  latlonbox=(-127, -120, 38, 44.5))
-            for gf_element, max0 in zip(csz_GF_elements, maxslip):  # experimental steps
-                gf_element.set_lower_bound(exp_dict["faults"]["CSZ"]["slip_min"])  # default lower bound, probably zero
-                gf_element.set_upper_bound(max0 * 130)  # upper bound about 40 mm/yr from geometry units in cm
-                gf_element.set_param_name('CSZ_dist')
-                amount_of_slip_penalty = 1
-                patch = gf_element.fault_dict_list[0]
-                if patch.depth > exp_dict["max_depth_csz_slip"]:
-                    amount_of_slip_penalty = 100  # optionally: force CSZ slip to be above a certain depth
-                if patch.depth < exp_dict["depth_of_forced_coupling"]:
-                    gf_element.set_lower_bound(gf_element.upper_bound * 0.90)  # optionally: force shallow CSZ coupled
-                gf_element.set_slip_penalty(amount_of_slip_penalty)
-                gf_element.set_units('cm/yr')
-                gf_elements.append(gf_element)
+            csz_gf_matrix, maxslip = gf_element_rw.read_distributed_GF_static1d_matrix(
+                exp_dict["inverse_dir"] + exp_dict["faults"]["CSZ"]["GF"],
+                exp_dict["inverse_dir"] + exp_dict["faults"]["CSZ"]["geometry"], exp_dict["lonlatfile"],
+                unit_slip=True, latlonbox=(-127, -120, 38, 44.5))
+            # experimental steps, applied to all CSZ patches at once
+            depths = np.array([patch.depth for patch in csz_gf_matrix.fault_patches])
+            upper_bounds = np.array(maxslip) * 130  # upper bound about 40 mm/yr from geometry units in cm
+            lower_bounds = np.full(np.shape(upper_bounds), exp_dict["faults"]["CSZ"]["slip_min"])  # probably zero
+            forced_coupling = depths < exp_dict["depth_of_forced_coupling"]
+            lower_bounds[forced_coupling] = upper_bounds[forced_coupling] * 0.90  # optionally: force shallow coupling
+            # optionally: force CSZ slip to be above a certain depth
+            slip_penalties = np.where(depths > exp_dict["max_depth_csz_slip"], 100, 1)
+            csz_gf_matrix.set_upper_bounds(upper_bounds)
+            csz_gf_matrix.set_lower_bounds(lower_bounds)
+            csz_gf_matrix.set_param_names('CSZ_dist')
+            csz_gf_matrix.set_slip_penalties(slip_penalties)
+            csz_gf_matrix.set_units('cm/yr')
+            gf_elements = gf_elements + csz_gf_matrix.to_gf_elements()  # other faults use the GfElement API
         else:  # Reading for LSF, MRF, other fault cases
             fault_gf = exp_dict["inverse_dir"] + exp_dict["faults"][fault_name]["GF"]
             fault_geom = exp_dict["inverse_dir"] + exp_dict["faults"][fault_name]["geometry"]
@@ -161,15 +164,6 @@ def run_humboldt_inversion():
     # # INPUT stage: Read obs velocities as cc.Displacement_Points
     obs_disp_pts = hr.read_all_data_table(exp_dict["data_file"])  # all 783 points
     obs_disp_pts = correct_for_far_field_terms(exp_dict, obs_disp_pts)  # needed from Fred's work
-    # Experimental options:
-    if exp_dict["continuous_only"] == 1:
-        obs_disp_pts = dpo.utilities.filter_to_meas_type(obs_disp_pts, 'continuous')  # experimental design step
-    obs_disp_pts = inv_tools.remove_nearfault_pts(obs_disp_pts, exp_dict["inverse_dir"] +
-                                                  exp_dict["faults"]["Maa"]["points"])
-    obs_disp_pts = inv_tools.remove_nearfault_pts(obs_disp_pts, exp_dict["inverse_dir"] +
-                                                  exp_dict["faults"]["BSF"]["points"])
-    for excluded_region in exp_dict["exclude_regions"]:
-        obs_disp_pts = dpo.utilities.filter_to_exclude_bounding_box(obs_disp_pts, excluded_region)  # Lassen etc.
     obs_disp_pts = dpo.utilities.filter_by_bounding_box(obs_disp_pts, exp_dict["bbox"])  # north of 38.5
 
     # INPUT stage: Read GF models based on the configuration parameters
@@ -184,62 +178,99 @@ def run_humboldt_inversion():
     gf_element_lev = GF_element.get_GF_leveling_offset_element(obs_disp_pts)  # 1 element: lev reference frame
     gf_elements = gf_elements + gf_element_lev
 
-    # COMPUTE STAGE: Pairing is necessary in case you've filtered out any observations along the way.
+    # COMPUTE STAGE: Pair and assemble G once.  Reduces certain points to only-horizontal, only-vertical, etc.
     paired_obs, paired_gf_elements = inv_tools.pair_gf_elements_with_obs(obs_disp_pts, gf_elements)
+    system = linear_system.build_linear_system(paired_obs, paired_gf_elements)
 
-    outputs.visualize_GF_elements(paired_gf_elements, outdir, exclude_list='all')
+    # Experimental options: drop observations from the assembled system, without rebuilding G
+    if exp_dict["continuous_only"] == 1:
+        system = system.filter_to_meas_type('continuous')  # experimental design step
+    for fault_name in ["Maa", "BSF"]:
+        system = system.select_kept_stations(inv_tools.remove_nearfault_pts(system.get_paired_obs(),
+                                                                            exp_dict["inverse_dir"] +
+                                                                            exp_dict["faults"][fault_name]["points"]))
+    for excluded_region in exp_dict["exclude_regions"]:
+        system = system.select_kept_stations(dpo.utilities.filter_to_exclude_bounding_box(system.get_paired_obs(),
+                                                                                          excluded_region))  # Lassen
+    if not np.any(system.meas_types[system.get_active_stations()] == 'leveling'):
+        keep = [x.param_name != 'lev_offset' for x in paired_gf_elements]  # no leveling left to set its frame
+        system = system.select_params(keep)
+        paired_gf_elements = [x for x, k in zip(paired_gf_elements, keep) if k]
+    paired_obs = system.get_paired_obs()
+    row_index_table = system.get_row_index_table()  # station/component -> row of G, for unpacking predictions
+    paired_gf_elements = inv_tools.select_gf_element_points(paired_gf_elements, system.get_active_stations())
 
-    # COMPUTE STAGE: INVERSE.  Reduces certain points to only-horizontal, only-vertical, etc.
-    list_of_gf_columns = []
-    for paired_gf in paired_gf_elements:
-        G_one_col = inv_tools.buildG_column(paired_gf.disp_points, paired_obs)  # for one fault model parameter
-        list_of_gf_columns.append(G_one_col)
-    G = np.concatenate(tuple(list_of_gf_columns), axis=1)
+    outputs.visualize_GF_elements(paired_gf_elements, outdir, exclude_list='all')
 
-    # Build observation vector
-    obs, sigmas = inv_tools.build_obs_vector(paired_obs)
-    sigmas = np.divide(sigmas, np.nanmean(sigmas))  # normalizing so smoothing has same order-of-magnitude
+    # COMPUTE STAGE: INVERSE.
+    G, obs, data_sigmas = system.G, system.obs, system.sigmas
+    sigmas = np.divide(data_sigmas, np.nanmean(data_sigmas))  # normalizing so smoothing has same order-of-magnitude
     if exp_dict["unc_weighted"] == 0:
         sigmas = np.ones(np.shape(obs))
     G /= sigmas[:, None]
     weighted_obs = obs / sigmas
 
-    # Add optional smoothing penalty, overwriting old variables
-    if 'smoothing' in exp_dict.keys():
-        G, weighted_obs, sigmas = inv_tools.build_smoothing(paired_gf_elements, ('CSZ_dist',),
-                                                            exp_dict["smoothing"], exp_dict["smoothing_length"],
-                                                            G, weighted_obs, sigmas,
-                                                            distance_3d=False)
-    # Add optional slip weighting penalty, overwriting old variable
-    if 'slip_penalty' in exp_dict.keys():
-        G, weighted_obs, sigmas = inv_tools.build_slip_penalty(paired_gf_elements,
-                                                               exp_dict["slip_penalty"], G, weighted_obs, sigmas)
+    reg_blocks, reg_labels = [], []  # sparse regularization rows, appended beneath G by the solver
+    # Regularization matrices are only built when requested (argparse sets unused options to None)
+    use_smoothing = exp_dict.get("smoothing") is not None
+    use_slip_penalty = exp_dict.get("slip_penalty") is not None
+    L_smoothing, L_penalty = None, None
+    if use_smoothing or exp_dict.get("smoothing_sweep"):
+        L_smoothing = inv_tools.build_smoothing_matrix(paired_gf_elements, ('CSZ_dist',),
+                                                       exp_dict["smoothing_length"], distance_3d=False)
+    if use_slip_penalty:  # the sweep also uses it, at the same slip penalty
+        L_penalty = inv_tools.build_slip_penalty_matrix(paired_gf_elements)
+    # Add optional smoothing penalty
+    if use_smoothing:
+        reg_blocks.append(L_smoothing * exp_dict["smoothing"])
+        reg_labels.append('smoothing')
+    # Add optional slip weighting penalty
+    if use_slip_penalty:
+        reg_blocks.append(L_penalty * exp_dict["slip_penalty"])
+        reg_labels.append('slip_penalty')
 
     # Money line: Constrained inversion
     lb = [x.lower_bound for x in paired_gf_elements]
     ub = [x.upper_bound for x in paired_gf_elements]
-    response = scipy.optimize.lsq_linear(G, weighted_obs, bounds=(lb, ub), max_iter=1500, method='bvls')
+    if exp_dict.get("smoothing_sweep"):  # in-memory L-curve over smoothing, at the same slip penalty
+        sweep = l_curve.bounded_regularization_sweep(G, weighted_obs, L_smoothing, exp_dict["smoothing_sweep"],
+                                                     lb=lb, ub=ub, P=L_penalty,
+                                                     alpha=exp_dict.get("slip_penalty") or 0)
+        l_curve.write_regularization_sweep(sweep, outdir + '/smoothing_sweep.txt')
+        l_curve.glob_and_drive_1d_lcurve(target_dir=outdir, outname=outdir + '/smoothing_curve.png',
+                                         sweep_results=sweep)
+    row_ranges = []  # (label, start, stop) of each block of regularization rows in G_ext
+    response, G_ext, d_ext = solvers.solve_regularized_system(G, weighted_obs, lb, ub, reg_blocks, labels=reg_labels,
+                                                             row_ranges=row_ranges, max_iter=1500)  # bvls unless large
     M_opt = response.x  # parameters of best-fitting model
-    print(response.message)
+    solvers.write_solver_report(response, outdir + '/solver_report.txt', G_ext)
     if response.message == "The maximum number of iterations is exceeded.":
         print("Maximum number of iterations exceeded. Cannot trust this inversion. Exiting")
         sys.exit(0)
 
+    # Optional parameter uncertainties: re-invert noise realizations of the data, warm-started from M_opt
+    if exp_dict.get("n_realizations"):
+        data_rows = inv_tools.get_data_row_mask(len(d_ext), row_ranges)
+        noise_sigmas = np.zeros(np.shape(d_ext))
+        noise_sigmas[data_rows] = data_sigmas / sigmas  # data uncertainties, weighted
+        stats = resampling.run_resampling(G_ext, d_ext, lb, ub, M_opt, noise_sigmas=noise_sigmas,
+                                          data_rows=data_rows, n_realizations=exp_dict["n_realizations"])
+        resampling.write_uncertainty_params(stats, outdir + '/model_uncertainties_human.txt', paired_gf_elements,
+                                            ignore_faults=['CSZ_dist'], message="Noise realizations of the data")
+
     # Make forward predictions.  Work in disp_pts as soon as possible, not matrices.
     rotation_params = ("x_rot", "y_rot", "z_rot", 'ocb_x_rot', 'ocb_y_rot', 'ocb_z_rot')
     all_param_names = [x.param_name for x in paired_gf_elements]
-    M_csz = inv_tools.unpack_model_of_target_param(M_opt, all_param_names, ['CSZ_dist'])
-    M_LSF = inv_tools.unpack_model_of_target_param(M_opt, all_param_names, ['LSFRev'])
-    M_ocb = inv_tools.unpack_model_of_target_param(M_opt, all_param_names, ['ocb_x_rot', 'ocb_y_rot', 'ocb_z_rot'])
-    M_rot_only = inv_tools.unpack_model_of_target_param(M_opt, all_param_names, rotation_params)
-    M_no_rot = inv_tools.unpack_model_without_target_param(M_opt, all_param_names, rotation_params)
-
-    model_disp_pts = inv_tools.forward_disp_points_predictions(G, M_opt, sigmas, paired_obs)
-    rot_modeled_pts = inv_tools.forward_disp_points_predictions(G, M_rot_only, sigmas, paired_obs)
-    norot_modeled_pts = inv_tools.forward_disp_points_predictions(G, M_no_rot, sigmas, paired_obs)
-    ocb_modeld_pts = inv_tools.forward_disp_points_predictions(G, M_ocb, sigmas, paired_obs)
-    csz_modeled_pts = inv_tools.forward_disp_points_predictions(G, M_csz, sigmas, paired_obs)
-    lsf_modeled_pts = inv_tools.forward_disp_points_predictions(G, M_LSF, sigmas, paired_obs)
+    groups = {"full": all_param_names,
+              "rot_only": rotation_params,
+              "no_rot": [x for x in all_param_names if x not in rotation_params],
+              "ocb": ['ocb_x_rot', 'ocb_y_rot', 'ocb_z_rot'],
+              "csz": ['CSZ_dist'],
+              "lsf": ['LSFRev']}
+    group_pts = inv_tools.forward_disp_points_group_predictions(G, M_opt, sigmas, paired_obs, all_param_names,
+                                                                groups, row_index_table)
+    model_disp_pts, rot_modeled_pts, norot_modeled_pts = group_pts["full"], group_pts["rot_only"], group_pts["no_rot"]
+    ocb_modeld_pts, csz_modeled_pts, lsf_modeled_pts = group_pts["ocb"], group_pts["csz"], group_pts["lsf"]
 
     # Output stage
     rms_mm_h, rms_chi2_h = metrics.obs_vs_model_L2_horiz(paired_obs, model_disp_pts)
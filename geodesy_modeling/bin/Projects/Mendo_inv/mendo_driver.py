@@ -7,11 +7,14 @@ import elastic_stresses_py.PyCoulomb as PyCoulomb
 import elastic_stresses_py.PyCoulomb.fault_slip_triangle as fst
 import elastic_stresses_py.PyCoulomb.fault_slip_object as fso
 import geodesy_modeling.Inversion.inversion_tools as inv_tools
+import geodesy_modeling.Inversion.solvers as solvers
+import geodesy_modeling.Inversion.metrics as metrics
+import geodesy_modeling.Inversion.l_curve as l_curve
+import numpy as np
+import scipy.sparse
 import json
 import argparse
 import os
-import scipy.optimize
-import numpy as np
 import matplotlib.pyplot as plt
 
 filedict = {
@@ -31,6 +34,7 @@ def configure():
     p.add_argument('--smoothing', type=float, help='''strength of Laplacian smoothing constraint''', default=20)
     p.add_argument('--outdir', type=str, help='''Output directory''', default='test_output/')
     p.add_argument('--tikhonov0', type=float, help='''strength of minimum-norm penalty''', default=30)
+    p.add_argument('--smoothing_sweep', type=float, nargs='+', help='''smoothing strengths for an L-curve''')
     exp_dict = vars(p.parse_args())
     exp_dict["smoothing_length"] = 10  # smooth adjacent patches with some wiggle room
     os.makedirs(exp_dict['outdir'], exist_ok=True)  # """Set up an experiment directory."""
@@ -44,38 +48,46 @@ def run_main():
     outdir = exp_dict['outdir']
 
     # Reading step
-    GF_elements = gf_rw.read_GFs_matlab_CSZ(filedict['gf_file'])
-    GF_elements = [x for x in GF_elements if x.fault_dict_list[0].depth > -50]
-    for item in GF_elements:
-        item.set_lower_bound(0)
-        item.set_upper_bound(1)
-        item.set_slip_penalty(exp_dict['tikhonov0'] - 0.1*item.fault_dict_list[0].depth)
+    gf_matrix = gf_rw.read_GFs_matlab_CSZ_matrix(filedict['gf_file'])  # array-backed, no GfElement objects
+    depths = np.array([patch.depth for patch in gf_matrix.fault_patches])
+    gf_matrix = gf_matrix.select_params(depths > -50)
+    gf_matrix.set_lower_bounds(0)
+    gf_matrix.set_upper_bounds(1)
+    gf_matrix.set_slip_penalties(exp_dict['tikhonov0'] - 0.1*depths[depths > -50])
     obs_data_points = dpo.io_gmt.read_disp_points_gmt(filedict['data_file'])
     obs_data_points = dpo.utilities.filter_to_remove_nans(obs_data_points)
     obs_data_points = dpo.utilities.filter_by_bounding_box(obs_data_points, (-126, -122, 39.65, 41.5))
     obs_data_points = dpo.utilities.filter_to_remove_outliers(obs_data_points, 0.02, verbose=True)  # remove P335/P794
 
     # COMPUTE STAGE: INVERSE.
-    list_of_gf_columns = []
-    obs_data_points, GF_elements = inv_tools.pair_gf_elements_with_obs(obs_data_points, GF_elements, tol=0.014)
-    for gf in GF_elements:
-        G_one_col = inv_tools.buildG_column(gf.disp_points, obs_data_points)  # for one fault model parameter
-        list_of_gf_columns.append(G_one_col)
-    G = np.concatenate(tuple(list_of_gf_columns), axis=1)
-    obs, sigmas = inv_tools.build_obs_vector(obs_data_points)
+    obs_data_points, gf_matrix = inv_tools.pair_gf_matrix_with_obs(obs_data_points, gf_matrix, tol=0.014)
+    G, obs, sigmas = inv_tools.build_G_and_obs_vector(obs_data_points, gf_matrix)
     G /= sigmas[:, None]
     w_obs = obs / sigmas
-    smoothing_list = [x.param_name for x in GF_elements]
-    G, w_obs, sigmas = inv_tools.build_smoothing(GF_elements, smoothing_list, exp_dict["smoothing"],
-                                                 exp_dict["smoothing_length"], G, w_obs, sigmas)
-    G, w_obs, sigmas = inv_tools.build_slip_penalty(GF_elements, 1, G, w_obs, sigmas)
-    plt.imshow(G, vmin=-3, vmax=3)
-    plt.savefig(outdir+"/G_matrix.png")
+    smoothing_list = inv_tools.get_param_names(gf_matrix)
+    L_smoothing = inv_tools.build_smoothing_matrix(gf_matrix, smoothing_list, exp_dict["smoothing_length"])
+    G_smoothing = L_smoothing * exp_dict["smoothing"]
+    G_penalty = inv_tools.build_slip_penalty_matrix(gf_matrix)  # penalty strength 1
 
-    # Money line: Constrained inversion
-    lb, ub = [x.lower_bound for x in GF_elements], [x.upper_bound for x in GF_elements]
-    response = scipy.optimize.lsq_linear(G, w_obs, bounds=(lb, ub), max_iter=1500, method='bvls')
+    # Money line: Constrained inversion, with the regularization rows kept sparse until the solver
+    lb, ub = inv_tools.get_bounds(gf_matrix)
+    if exp_dict["smoothing_sweep"]:  # in-memory L-curve over smoothing, at the same slip penalty
+        sweep = l_curve.bounded_regularization_sweep(G, w_obs, L_smoothing, exp_dict["smoothing_sweep"], lb=lb,
+                                                     ub=ub, P=G_penalty, alpha=1)
+        l_curve.write_regularization_sweep(sweep, outdir + '/smoothing_sweep.txt')
+        l_curve.glob_and_drive_1d_lcurve(target_dir=outdir, outname=outdir + '/smoothing_curve.png',
+                                         sweep_results=sweep)
+    row_ranges = []  # (label, start, stop) of each block of regularization rows in G_ext
+    response, G_ext, d_ext = solvers.solve_regularized_system(G, w_obs, lb, ub, [G_smoothing, G_penalty],
+                                                             labels=['smoothing', 'slip_penalty'],
+                                                             row_ranges=row_ranges, max_iter=1500)  # bvls unless large
     M_opt = response.x  # parameters of best-fitting model
+    plt.imshow(G_ext.toarray() if scipy.sparse.issparse(G_ext) else G_ext, vmin=-3, vmax=3)
+    plt.savefig(outdir+"/G_matrix.png")
+    sigmas_ext = np.concatenate((sigmas, np.zeros((len(d_ext) - len(sigmas),))))  # undo the weighting of G_ext
+    rms_mm, _rms_chi2 = metrics.stacked_vectors_L2(G_ext.dot(M_opt) * sigmas_ext, d_ext * sigmas_ext, sigmas_ext,
+                                                   row_ranges)
+    print("RMS misfit: %f mm" % rms_mm)
 
     model_disp_pts = inv_tools.forward_disp_points_predictions(G, M_opt, sigmas, obs_data_points)
     _resid = dpo.utilities.subtract_disp_points(obs_data_points, model_disp_pts)   # make residual points
@@ -83,11 +95,7 @@ def run_main():
     PyCoulomb.io_additionals.write_disp_points_results(obs_data_points, outdir + '/obs_file.txt')
 
     # Unpack into a collection of fault triangles with optimal slip values
-    modeled_faults = []
-    for i in range(len(GF_elements)):
-        [new_fault] = GF_elements[i].fault_dict_list
-        new_fault = new_fault.change_fault_slip(rtlat=M_opt[i])
-        modeled_faults.append(new_fault)
+    modeled_faults = [patch.change_fault_slip(rtlat=m) for patch, m in zip(gf_matrix.fault_patches, M_opt)]
     total_moment = fst.fault_slip_triangle.get_total_moment(modeled_faults)
 
     fst.file_io.tri_outputs.write_gmt_plots_geographic(modeled_faults, outdir+"/slip_dist_outfile.txt",
@@ -9,6 +9,8 @@ import sys
 import json
 import os
 import shutil
+import copy
+import concurrent.futures
 from geodesy_modeling import MultiTemporalInversion
 from geodesy_modeling.Inversion import l_curve, l_curve_plots
 
@@ -29,6 +31,8 @@ def welcome_and_parse(argv):
         shutil.copy2(fault_file_name, os.path.join(config1['output_dir_lcurve'], fault_name))  # save fault files
     if 'G' not in config1.keys():
         config1['G'] = 30e9  # default shear modulus is 30 GPa
+    if 'solver' not in config1.keys():
+        config1['solver'] = 'auto'   # nnls, bvls, trf_sparse, or admm; auto picks nnls unless G is large
     if 'resolution_test' not in config1.keys():
         config1['resolution_test'] = ''   # default resolution test is none
     output_json = os.path.join(config1['output_dir_lcurve'], 'config.json')
@@ -37,39 +41,72 @@ def welcome_and_parse(argv):
     return config1
 
 
-def iterate_many_inversions(config):
+def get_sweep_points(config):
     """
-    A driver for looping multiple inversions depending on the experiment, testing the impact of alpha or smoothing.
+    List the (alpha, penalty, output directory) for each inversion in the experiment, testing the impact of alpha
+    or smoothing. A value of None means: keep the value from the config.
     """
+    points = []
     if not config["switch_alpha"] and not config["switch_penalty"]:   # no search at all.
         print("Check your configuration. Not searching through alpha or lambda.")
         sys.exit(0)
     elif config["switch_alpha"] and not config["switch_penalty"]:   # 1d search in slip penalty
         for alpha in config['range_alpha']:
-            config["alpha"] = alpha    # set the alpha
-            config["output_dir"] = os.path.join(config["output_dir_lcurve"], "alpha_"+str(alpha), "")
-            os.makedirs(config['output_dir'], exist_ok=True)  # set output dir
-            MultiTemporalInversion.buildG.beginning_calc(config)  # the guts of drive_slippy_multitemporal.py
-            MultiTemporalInversion.metrics.main_function(config)
+            points.append((alpha, None, os.path.join(config["output_dir_lcurve"], "alpha_"+str(alpha), "")))
     elif config["switch_penalty"] and not config["switch_alpha"]:   # 1d search in smoothing penalty
         for penalty in config['range_penalty']:
-            for key in config["faults"].keys():
-                config["faults"][key]["penalty"] = penalty    # set the smoothing penalty
-            config["output_dir"] = os.path.join(config['output_dir_lcurve'], "penalty_"+str(penalty), "")
-            os.makedirs(config['output_dir'], exist_ok=True)  # set output dir
-            MultiTemporalInversion.buildG.beginning_calc(config)
-            MultiTemporalInversion.metrics.main_function(config)
+            points.append((None, penalty, os.path.join(config['output_dir_lcurve'], "penalty_"+str(penalty), "")))
     else:  # 2d search for smoothing and slip penalty
         for alpha in config['range_alpha']:
             for penalty in config['range_penalty']:
-                for key in config["faults"].keys():
-                    config["faults"][key]["penalty"] = penalty  # set the smoothing penalty
-                config["alpha"] = alpha  # set the alpha
-                config["output_dir"] = os.path.join(config["output_dir_lcurve"],
-                                                    "alpha_"+str(alpha)+"_"+str(penalty), "")
-                os.makedirs(config['output_dir'], exist_ok=True)
-                MultiTemporalInversion.buildG.beginning_calc(config)
-                MultiTemporalInversion.metrics.main_function(config)
+                points.append((alpha, penalty, os.path.join(config["output_dir_lcurve"],
+                                                            "alpha_"+str(alpha)+"_"+str(penalty), "")))
+    return points
+
+
+def configure_sweep_point(config, alpha, penalty, output_dir):
+    """Make a private copy of the config for one inversion, so that workers never share a mutable config."""
+    point_config = copy.deepcopy(config)
+    if alpha is not None:
+        point_config["alpha"] = alpha    # set the alpha
+    if penalty is not None:
+        for key in point_config["faults"].keys():
+            point_config["faults"][key]["penalty"] = penalty    # set the smoothing penalty
+    point_config["output_dir"] = output_dir
+    os.makedirs(point_config['output_dir'], exist_ok=True)  # set output dir
+    return point_config
+
+
+_shared_system = None   # the unregularized system, set once inside each worker process
+
+
+def _set_shared_system(system):
+    global _shared_system
+    _shared_system = system
+
+
+def run_sweep_point(point_config):
+    """Regularize, invert, and compute metrics for one point of the L-curve, inside a worker."""
+    MultiTemporalInversion.buildG.solve_and_write_outputs(point_config, _shared_system)
+    MultiTemporalInversion.metrics.main_function(point_config)
+    return point_config["output_dir"]
+
+
+def iterate_many_inversions(config):
+    """
+    A driver for looping multiple inversions depending on the experiment, testing the impact of alpha or smoothing.
+    The unregularized G, data, and smoothing matrices are built once. The grid of (alpha, penalty) is then spread
+    across a process pool, with a copy of the config for each point. Set "num_workers" in the config to limit
+    the number of processes (default: number of cores).
+    """
+    points = get_sweep_points(config)
+    point_configs = [configure_sweep_point(config, alpha, penalty, outdir) for alpha, penalty, outdir in points]
+    system = MultiTemporalInversion.buildG.build_inversion_system(config)  # the guts of drive_slippy_multitemporal.py
+    num_workers = config.get("num_workers", None)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_set_shared_system,
+                                                initargs=(system,)) as executor:
+        for i, outdir in enumerate(executor.map(run_sweep_point, point_configs)):
+            print("Finished inversion %d of %d: %s" % (i+1, len(point_configs), outdir))
     return
 
 
@@ -28,6 +28,8 @@ def welcome_and_parse(argv):
         shutil.copy2(fault_file_name, os.path.join(config1['output_dir'], fault_name))  # save faults, record-keeping
     if 'G' not in config1.keys():
         config1['G'] = 30e9  # default shear modulus is 30 GPa
+    if 'solver' not in config1.keys():
+        config1['solver'] = 'auto'   # nnls, bvls, trf_sparse, or admm; auto picks nnls unless G is large
     return config1
 
 
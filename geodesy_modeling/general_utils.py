@@ -158,3 +158,17 @@ def get_los_and_flight_vectors(flight_heading, look_dir='right'):
     else:
         raise ValueError("Error! Invalid look_dir look_dir must be right or left.")
     return x_flight, y_flight, x_los, y_los
+
+
+def project_enu_into_los(enu, lkv_E, lkv_N, lkv_U):
+    """
+    Project ENU displacements into LOS with one batched dot product.
+
+    :param enu: array of shape (n_points, 3), or a stack of shape (n_patches, n_points, 3)
+    :param lkv_E: 1d array of east components of the look vector, length n_points
+    :param lkv_N: 1d array of north components of the look vector, length n_points
+    :param lkv_U: 1d array of up components of the look vector, length n_points
+    :returns: array of shape (n_points,), or (n_patches, n_points)
+    """
+    look_vectors = np.column_stack((lkv_E, lkv_N, lkv_U))
+    return np.einsum('...nc,nc->...n', enu, look_vectors)